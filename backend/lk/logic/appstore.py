@@ -160,11 +160,9 @@ def mark_not_interested_in_app(user, app, country):
 
 
 def my_apps(user, limit=50):
-  my_interests = AppStoreAppInterest.objects.filter(user=user, enabled=True).order_by('id').select_related('app')[:limit]
-  apps = []
-  for interest in my_interests:
-    appstore_app_info.decorate_app(interest.app, interest.country)
-    apps.append(interest.app)
+  my_interests = list(AppStoreAppInterest.objects.filter(user=user, enabled=True).order_by('id').select_related('app')[:limit])
+  appstore_app_info.decorate_apps([(interest.app, interest.country) for interest in my_interests])
+  apps = [interest.app for interest in my_interests]
 
   return sorted(apps, key=lambda a: a.name.lower())
 
@@ -175,10 +173,10 @@ def mark_app_should_track_reviews(app, country):
 
 
 def mark_should_track_reviews_for_my_apps(user):
-  interests = AppStoreAppInterest.objects.filter(user=user, enabled=True).select_related('app')
+  interests = list(AppStoreAppInterest.objects.filter(user=user, enabled=True).select_related('app'))
+  appstore_app_info.decorate_apps([(interest.app, interest.country) for interest in interests])
   my_apps = []
   for interest in interests:
-    appstore_app_info.decorate_app(interest.app, interest.country)
     mark_app_should_track_reviews(interest.app, interest.country)
     my_apps.append(interest.app)
   return my_apps
@@ -14,31 +14,92 @@
 # limitations under the License.
 #
 
+import cPickle as pickle
 import logging
 import time
 from datetime import datetime
 
 from Crypto.Random import random
+from django.db import IntegrityError
 from django.db import InternalError
-from redis import WatchError
 
 from backend.lk.logic import appstore_fetch
 from backend.lk.logic import redis_wrap
+from backend.lk.logic import work_queues
 from backend.lk.models import AppStoreApp
-from backend.lk.models import AppStoreAppInfo
+from backend.lk.models import AppStoreAppCurrentInfo
+from backend.lk.models import AppStoreAppInfoChange
 from backend.lk.models import AppStoreAppRating
 from backend import celery_app
 
 
-def decorate_app(app, country):
-  if app.decorated_info and app.decorated_country == country:
+# Current info changes at most every few hours per app, so a short shared
+# cache mostly saves queries for pages and tasks that decorate the same
+# apps over and over.
+APP_INFO_CACHE_SECONDS = 60
+APP_INFO_CACHE_KEY_FORMAT = 'appinfo;current;app-id=%s;country=%s'
+
+
+def _cached_current_app_infos(apps_countries):
+  redis = redis_wrap.client()
+  keys = [APP_INFO_CACHE_KEY_FORMAT % app_country for app_country in apps_countries]
+  cached = redis.mget(keys)
+
+  app_infos = {}
+  missing = []
+  for app_country, pickled in zip(apps_countries, cached):
+    if pickled:
+      app_infos[app_country] = pickle.loads(pickled)
+    else:
+      missing.append(app_country)
+
+  fetched = _current_app_infos(missing)
+  if fetched:
+    with redis.pipeline(transaction=False) as pipe:
+      for (app_id, country), app_info in fetched.items():
+        pipe.setex(APP_INFO_CACHE_KEY_FORMAT % (app_id, country), APP_INFO_CACHE_SECONDS,
+            pickle.dumps(app_info, pickle.HIGHEST_PROTOCOL))
+      pipe.execute()
+  app_infos.update(fetched)
+
+  return app_infos
+
+
+def _invalidate_cached_app_infos(app_infos):
+  if not app_infos:
     return
+  redis = redis_wrap.client()
+  redis.delete(*[APP_INFO_CACHE_KEY_FORMAT % (i.app_id, i.country) for i in app_infos])
+
 
-  app_info = _latest_app_info_by_id(app.id, country)
-  if not app_info:
-    raise ValueError('Could not find app info with that id+country (%s+%s)' % (app.id, country))
-  app.decorated_country = country
-  app.decorated_info = app_info
+def decorate_apps(apps_countries):
+  """Decorates each app in a list of (app, country) pairs with its current
+  info in that country.
+
+  NOTE: An app instance only holds info for one country at a time, so pass
+  separate instances to decorate the same app in several countries.
+  """
+  undecorated = [(app, country) for app, country in apps_countries
+                 if not (app.decorated_info and app.decorated_country == country)]
+  if not undecorated:
+    return
+
+  app_infos = _cached_current_app_infos(list(set((app.id, country) for app, country in undecorated)))
+  missing = []
+  for app, country in undecorated:
+    app_info = app_infos.get((app.id, country))
+    if not app_info:
+      missing.append('%s+%s' % (app.id, country))
+      continue
+    app.decorated_country = country
+    app.decorated_info = app_info
+
+  if missing:
+    raise ValueError('Could not find app info with that id+country (%s)' % ', '.join(missing))
+
+
+def decorate_app(app, country):
+  decorate_apps([(app, country)])
 
 
 PROPERTIES_TO_CHECK = [
@@ -86,19 +147,20 @@ PROPERTIES_CAUSING_RATING_UPDATE = [
   'current_version_reviews_count',
 ]
 
-PROPERTIES_CAUSING_UPDATE = PROPERTIES_CAUSING_RATING_UPDATE + [
+PROPERTIES_NOT_LOGGED = PROPERTIES_CAUSING_RATING_UPDATE + [
   # These change arbitrarily all the time with new "download URLs"
   'icon_60',
   'icon_100',
   'icon_512',
 ]
 
+# Ratings have their own history in AppStoreAppRating; the rest go in
+# AppStoreAppInfoChange when they change.
+PROPERTIES_TO_LOG = [p for p in PROPERTIES_TO_CHECK if p not in PROPERTIES_NOT_LOGGED]
 
-def _latest_app_info_by_id(app_id, country):
-  app_info = list(AppStoreAppInfo.objects.filter(app_id=app_id, country=country).order_by('-create_time')[:1])
-  if app_info:
-    return app_info[0]
-  return None
+
+def _current_app_info(app_id, country):
+  return _current_app_infos([(app_id, country)]).get((app_id, country))
 
 
 def fetch_info_and_maybe_update_app(app, country):
@@ -110,50 +172,107 @@ def fetch_info_and_maybe_update_app(app, country):
 
   try:
     update_app_info_with_fetched_data(app, fetched_app_info)
-  except InternalError as e:
+  except (InternalError, IntegrityError) as e:
     logging.info('Could not update app info: %s app info: %s', e, fetched_app_info.__dict__)
 
 
-def update_app_info_with_fetched_data(app, fetched_app_info):
-  saved_app_info = _latest_app_info_by_id(app.id, fetched_app_info.country)
+def _current_app_infos(apps_countries):
+  if not apps_countries:
+    return {}
+
+  app_infos = AppStoreAppCurrentInfo.objects.raw("""
+    SELECT *
+    FROM lk_appstoreappcurrentinfo
+    WHERE (app_id, country) IN %s
+  """, [tuple(apps_countries)])
+  return dict(((i.app_id, i.country), i) for i in app_infos)
+
 
-  insert, update, rating_update = False, False, False
-  changed_properties = []
+def _compare_app_info(app, current_app_info, fetched_app_info):
+  """Returns the current app info to save, if anything changed, along with
+  an AppStoreAppInfoChange and AppStoreAppRating to insert, if any.
+  """
+  if not current_app_info:
+    # No record yet; log everything as the starting point.
+    fetched_app_info.app = app
+    changed_properties = PROPERTIES_TO_CHECK
+    current_app_info = fetched_app_info
 
-  if not saved_app_info:
-    # No record yet.
-    insert = True
-    rating_update = True
   else:
+    changed_properties = []
     for prop in PROPERTIES_TO_CHECK:
-      if getattr(saved_app_info, prop) != getattr(fetched_app_info, prop):
+      fetched_value = getattr(fetched_app_info, prop)
+      if getattr(current_app_info, prop) != fetched_value:
         changed_properties.append(prop)
-        if prop in PROPERTIES_CAUSING_UPDATE:
-          setattr(saved_app_info, prop, getattr(fetched_app_info, prop))
-          update = True
-          if prop in PROPERTIES_CAUSING_RATING_UPDATE:
-            rating_update = True
-        else:
-          insert = True
-
-  if any([insert, update, rating_update]):
-    logging.info('Updated properties for app %s (%s): %s',
-        app.id, app.bundle_id, changed_properties)
-
-  if insert:
-    fetched_app_info.app = app
-    fetched_app_info.save()
+        setattr(current_app_info, prop, fetched_value)
+
+  if not changed_properties:
+    return None, None, None
 
-  elif update:
-    saved_app_info.save()
+  logging.info('Updated properties for app %s (%s): %s',
+      app.id, app.bundle_id, changed_properties)
 
-  if rating_update:
+  change = None
+  logged_properties = [p for p in changed_properties if p in PROPERTIES_TO_LOG]
+  if logged_properties:
+    change = AppStoreAppInfoChange(app=app, country=fetched_app_info.country)
+    change.changed_values = dict((p, getattr(fetched_app_info, p)) for p in logged_properties)
+
+  rating = None
+  if any(p in PROPERTIES_CAUSING_RATING_UPDATE for p in changed_properties):
     rating = AppStoreAppRating(app=app)
     for prop in PROPERTIES_CAUSING_RATING_UPDATE:
       setattr(rating, prop, getattr(fetched_app_info, prop))
+
+  return current_app_info, change, rating
+
+
+def update_app_info_with_fetched_data(app, fetched_app_info):
+  current_app_info = _current_app_info(app.id, fetched_app_info.country)
+  app_info, change, rating = _compare_app_info(app, current_app_info, fetched_app_info)
+
+  if app_info:
+    app_info.save()
+    _invalidate_cached_app_infos([app_info])
+
+  if change:
+    change.save()
+
+  if rating:
     rating.save()
 
-  return insert or update
+  return bool(app_info)
+
+
+def update_app_infos_with_fetched_data(apps_fetched_app_infos):
+  """Same as update_app_info_with_fetched_data() for a list of
+  (app, fetched app info) pairs, with a couple of bulk queries.
+  """
+  current_app_infos = _current_app_infos([(app.id, fetched_app_info.country)
+                                          for app, fetched_app_info in apps_fetched_app_infos])
+
+  inserts, updates, changes, ratings = [], [], [], []
+  for app, fetched_app_info in apps_fetched_app_infos:
+    current_app_info = current_app_infos.get((app.id, fetched_app_info.country))
+    app_info, change, rating = _compare_app_info(app, current_app_info, fetched_app_info)
+    if app_info and not current_app_info:
+      inserts.append(app_info)
+    elif app_info:
+      updates.append(app_info)
+    if change:
+      changes.append(change)
+    if rating:
+      ratings.append(rating)
+
+  AppStoreAppCurrentInfo.objects.bulk_create(inserts)
+  # These are mostly a few churning hstore properties.
+  for app_info in updates:
+    app_info.save()
+  _invalidate_cached_app_infos(inserts + updates)
+  AppStoreAppInfoChange.objects.bulk_create(changes)
+  AppStoreAppRating.objects.bulk_create(ratings)
+
+  return len(inserts) + len(updates)
 
 
 #
@@ -162,6 +281,11 @@ def update_app_info_with_fetched_data(app, fetched_app_info):
 
 
 APP_INFO_INGESTION_ZSET_KEY = 'info-ingestion-app-ids'
+APP_INFO_INGESTION_BATCH_SIZE = appstore_fetch.LOOKUP_BATCH_SIZE
+RATE_LIMITED_RETRY_SECONDS = 60 * 15
+
+APP_INFO_INGESTION_QUEUE = work_queues.WorkQueue('app-info-ingestion',
+    pending_key=APP_INFO_INGESTION_ZSET_KEY)
 
 
 def next_ingestion_time():
@@ -170,71 +294,59 @@ def next_ingestion_time():
 
 
 def mark_app_needs_info_ingestion(app):
-  target_time = time.time()
-
-  # ADD app.id TO ZSET AT target_time
-  redis = redis_wrap.client()
-  redis.zadd(APP_INFO_INGESTION_ZSET_KEY, target_time, app.id)
+  APP_INFO_INGESTION_QUEUE.schedule({app.id: time.time()})
 
 
 @celery_app.task(ignore_result=True, queue='appstore')
 def maybe_ingest_app_info(now_offset=0):
-  now_timestamp = time.time() + now_offset
-
-  app_ids_needing_ingestion = []
-
-  # Atomically find next app ids to check.
-  redis = redis_wrap.client()
-  while True:
-    with redis.pipeline() as pipe:
-      try:
-        pipe.watch(APP_INFO_INGESTION_ZSET_KEY)
-        app_ids_needing_ingestion = pipe.zrangebyscore(APP_INFO_INGESTION_ZSET_KEY,
-            0, now_timestamp,
-            start=0, num=30)
-
-        if app_ids_needing_ingestion:
-          rescored_app_ids = []
-          for app_id in app_ids_needing_ingestion:
-            rescored_app_ids.append(next_ingestion_time())
-            rescored_app_ids.append(app_id)
-          pipe.multi()
-          pipe.zadd(APP_INFO_INGESTION_ZSET_KEY, *rescored_app_ids)
-          pipe.execute()
-
-        break
-      except WatchError:
-        logging.info('Interrupted while fetching app ids to ingest...')
-
+  app_ids_needing_ingestion = APP_INFO_INGESTION_QUEUE.claim(APP_INFO_INGESTION_BATCH_SIZE,
+      now=time.time() + now_offset)
   if not app_ids_needing_ingestion:
     return
 
   logging.info('Ingesting app infos for %d app(s)...', len(app_ids_needing_ingestion))
-  for app_id in app_ids_needing_ingestion:
+  apps_by_id = AppStoreApp.objects.in_bulk([long(app_id) for app_id in app_ids_needing_ingestion])
+  deleted_app_ids = [app_id for app_id in app_ids_needing_ingestion if long(app_id) not in apps_by_id]
+  if deleted_app_ids:
+    logging.warn('Deleted app ids, removing from ingestion queue: %s', deleted_app_ids)
+    APP_INFO_INGESTION_QUEUE.ack(deleted_app_ids)
+
+  apps_by_country = {}
+  for app in apps_by_id.values():
+    # NOTE: This should be unique but it isn't right now for whatever reason.
+    for country in set(app.app_info_countries):
+      apps_by_country.setdefault(country, []).append(app)
+
+  for country, apps in apps_by_country.items():
     try:
-      app = AppStoreApp.objects.get(pk=app_id)
-    except AppStoreApp.DoesNotExist:
-      logging.warn('Deleted app id, removing from ingestion queue: %s', app_id)
-      redis.zrem(APP_INFO_INGESTION_ZSET_KEY, app_id)
-      continue
+      fetched_app_infos = appstore_fetch.app_infos_with_ids([app.itunes_id for app in apps], country)
 
-    # NOTE: This should be unique but it isn't right now for whatever reason.
-    unique_countries = set(app.app_info_countries)
-    for country in unique_countries:
-      try:
-        fetch_info_and_maybe_update_app(app, country)
+    except appstore_fetch.RateLimitedError:
+      # This is not likely to fix itself soon. Give up.
+      logging.info('Rate limited by App Store, giving up for now...')
+      retry_time = time.time() + RATE_LIMITED_RETRY_SECONDS
+      APP_INFO_INGESTION_QUEUE.ack(apps_by_id.keys(), reschedule_times=[retry_time] * len(apps_by_id))
+      return
 
-      except appstore_fetch.RateLimitedError:
-        # This is not likely to fix itself soon. Give up.
-        logging.info('Rate limited by App Store, giving up for now...')
-        time.sleep(15)
-        return
+    except Exception:
+      logging.exception('Problem ingesting app info for %d app(s) in %s', len(apps), country)
+      continue
 
-      except Exception:
-        logging.exception('Problem ingesting app info for app id: %s - %s (%s - %s)',
-            app.id, country, app.itunes_id, app.bundle_id)
+    apps_fetched_app_infos = []
+    for app in apps:
+      fetched_app_info = fetched_app_infos.get(app.itunes_id)
+      if not fetched_app_info:
+        # TODO(Taylor): Increment some counter or something so we can stop checking this thing eventually.
+        logging.info('App removed or otherwise not available: %s (%s)', app.itunes_id, app.bundle_id)
+        continue
+      apps_fetched_app_infos.append((app, fetched_app_info))
 
-    app.app_info_ingestion_time = datetime.now()
-    app.save(update_fields=['app_info_ingestion_time'])
+    try:
+      update_app_infos_with_fetched_data(apps_fetched_app_infos)
+    except (InternalError, IntegrityError) as e:
+      logging.info('Could not update app infos for %d app(s) in %s: %s', len(apps_fetched_app_infos), country, e)
 
     time.sleep(0.3333)
+
+  AppStoreApp.objects.filter(id__in=apps_by_id.keys()).update(app_info_ingestion_time=datetime.now())
+  APP_INFO_INGESTION_QUEUE.ack(apps_by_id.keys(), reschedule_times=[next_ingestion_time() for _ in apps_by_id])
@@ -20,7 +20,7 @@ import re
 import time
 from datetime import datetime
 
-from backend.lk.models import AppStoreAppInfo
+from backend.lk.models import AppStoreAppCurrentInfo
 from backend.lk.logic import urlfetch
 from backend.util import urlutil
 
@@ -39,7 +39,7 @@ SOFTWARE_ENTITIES = 'software,iPadSoftware,macSoftware'
 
 
 def model_from_dict(d, country):
-  info = AppStoreAppInfo(country=country)
+  info = AppStoreAppCurrentInfo(country=country)
 
   info.itunes_id = d['trackId']
   info.bundle_id = d['bundleId']
@@ -99,7 +99,7 @@ def _lookup_fetch(remote_url):
       time.sleep(0.333 * retry)
 
     code, headers, results_dict = urlfetch.fetch(remote_url, cache_seconds=(60 * 60),
-        should_cache_fn=lambda c, d: d and d.get('results'))
+        should_cache_fn=lambda c, d: d and d.get('results'), revalidate_seconds=(60 * 60 * 24))
 
     if code == 403:
       raise RateLimitedError()
@@ -130,6 +130,30 @@ def app_info_with_id(app_id, country):
   return model_from_dict(app_info, country)
 
 
+# The lookup API takes comma-separated ids, within reason.
+LOOKUP_BATCH_SIZE = 150
+
+
+def app_infos_with_ids(app_ids, country):
+  """Looks up apps LOOKUP_BATCH_SIZE at a time, and returns app infos by
+  itunes id string, to match AppStoreApp.itunes_id. Apps that aren't
+  available in country are left out.
+  """
+  app_infos_by_id = {}
+  app_ids = list(app_ids)
+  for i in range(0, len(app_ids), LOOKUP_BATCH_SIZE):
+    batch_ids = ','.join(str(app_id) for app_id in app_ids[i:i + LOOKUP_BATCH_SIZE])
+    # NOTE: Not using appendparams() here because it would escape the commas.
+    remote_url = '%s?id=%s' % (LOOKUP_URL % country, batch_ids)
+    for app_info in (_lookup_fetch(remote_url) or []):
+      if app_info.get('kind') not in ('software', 'mac-software'):
+        continue
+      info = model_from_dict(app_info, country)
+      app_infos_by_id[str(info.itunes_id)] = info
+
+  return app_infos_by_id
+
+
 def app_info_with_bundle_id(bundle_id, country):
   remote_url = urlutil.appendparams(LOOKUP_URL % country, bundleId=bundle_id)
   app_infos = _lookup_fetch(remote_url)
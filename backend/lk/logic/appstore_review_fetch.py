@@ -18,7 +18,9 @@
 import logging
 import re
 import time
+from cStringIO import StringIO
 from datetime import datetime
+from xml.etree import cElementTree as ElementTree
 
 from backend.lk.models import AppStoreReview
 from backend.lk.logic import urlfetch
@@ -31,13 +33,41 @@ class RateLimitedError(RuntimeError):
 
 WAIT_BETWEEN_RETRIES = 0.25
 
-REVIEWS_URL_FORMAT = 'http://itunes.apple.com/%(country)s/rss/customerreviews/id=%(app_id)s/page=%(page)s/sortBy=mostRecent/json'
+# Shared by every thread fetching reviews, so running many ingestions at once
+# doesn't hammer the site.
+REVIEWS_REQUESTS_PER_SECOND = 20
+REVIEWS_RATE_LIMITER = urlfetch.HostRateLimiter(REVIEWS_REQUESTS_PER_SECOND, burst=5)
+RATE_LIMITED_BACKOFF_SECONDS = 60
+
+# The first page is fetched on every ingestion and usually hasn't changed.
+FIRST_PAGE_REVALIDATE_SECONDS = 60 * 60 * 24
+
+REVIEWS_URL_FORMAT = 'http://itunes.apple.com/%(country)s/rss/customerreviews/id=%(app_id)s/page=%(page)s/sortBy=mostRecent/xml'
 MAX_FETCH_ATTEMPTS = 5
 
 PAGE_RE = re.compile(r'/page=(\d+)/')
 
+ATOM = '{http://www.w3.org/2005/Atom}'
+ITUNES = '{http://itunes.apple.com/rss}'
+
 
-def fetch_reviews(app, country='us', page=1):
+def _parse_reviews_feed(content):
+  # Parses incrementally, so callers can stop partway through a page
+  # without building elements for the rest of it. The response body itself
+  # is already in memory: urlfetch keeps it around for revalidation.
+  for _, element in ElementTree.iterparse(StringIO(content)):
+    if element.tag == ATOM + 'link' and element.get('rel') == 'last':
+      yield 'last', element.get('href')
+    elif element.tag == ATOM + 'entry':
+      yield 'entry', element
+      element.clear()
+
+
+def fetch_reviews(app, country='us', page=1, stop_at_review_id=None):
+  """Fetches a page of most recent reviews. If stop_at_review_id is given,
+  reviews from that one on are assumed to be known already: they are left
+  out, and has_next_page is False if any were found.
+  """
   has_next_page = False
   fetched_reviews = None
   i = 0
@@ -55,33 +85,58 @@ def fetch_reviews(app, country='us', page=1):
       time.sleep(WAIT_BETWEEN_RETRIES)
     i += 1
 
-    code, headers, result = urlfetch.fetch(url)
+    REVIEWS_RATE_LIMITER.wait(url)
+    code, headers, result = urlfetch.fetch(url, json_response=False,
+        revalidate_seconds=(FIRST_PAGE_REVALIDATE_SECONDS if page == 1 else None))
     if code != 200 or not result:
       if code == 403:
+        REVIEWS_RATE_LIMITER.pause(url, RATE_LIMITED_BACKOFF_SECONDS)
         raise RateLimitedError()
       else:
         continue
 
-    entry = result['feed'].get('entry')
-    if not entry:
+    last_page_link = None
+    any_entries = False
+    reached_known_review = False
+    reviews = []
+    try:
+      for kind, value in _parse_reviews_feed(result):
+        if kind == 'last':
+          last_page_link = value
+          continue
+
+        any_entries = True
+        if value.find(ITUNES + 'rating') is None:
+          # Successful response's first entry is a description of the app for some reason.
+          continue
+
+        review = review_from_entry(app, value, country)
+        if stop_at_review_id and review.appstore_review_id <= stop_at_review_id:
+          # These are sorted by most recent, so we've seen the rest already.
+          reached_known_review = True
+          break
+        reviews.append(review)
+
+    except ElementTree.ParseError:
+      logging.info('Unparseable reviews response for app: %s url: %s', app.bundle_id, url)
+      continue
+
+    if not any_entries:
       # This is either a "no reviews at all for this app on this page" case,
       # or a bad potentially cached result on the apple feed side.
       continue
 
-    if not isinstance(entry, list):
+    if not (reviews or reached_known_review):
       # This is an invalid response that sometimes happen, and it appears to be
       # non-recoverable.
       logging.info('Bad+invalid+non-recoverable response for app: %s url: %s', app.bundle_id, url)
       break
 
-    # Successful response's first entry is a description of the app for some reason.
-    fetched_reviews = entry[1:]
+    fetched_reviews = reviews
 
-    last_page_link = [link['attributes']['href']
-                      for link in result['feed']['link']
-                      if link['attributes']['rel'] == 'last'][0]
-    last_page_int = int(PAGE_RE.findall(last_page_link)[0])
-    has_next_page = last_page_int > int(page)
+    if not reached_known_review and last_page_link:
+      last_page_int = int(PAGE_RE.findall(last_page_link)[0])
+      has_next_page = last_page_int > int(page)
 
   if i > 1:
     if fetched_reviews is None:
@@ -89,84 +144,54 @@ def fetch_reviews(app, country='us', page=1):
     else:
       logging.info('SUCCESS fetching reviews. %s attempts. %s page %s', i, app.bundle_id, page)
 
-  if fetched_reviews:
-    fetched_reviews = [review_from_dict(app, d, country) for d in fetched_reviews]
-
   return has_next_page, fetched_reviews
 
 
 """
-{
-  author: {
-    uri: {
-      label: "https://itunes.apple.com/us/reviews/id106721045"
-    },
-    name: {
-      label: "Egas semag"
-    },
-    label: ""
-  },
-  im:version: {
-    label: "1.6"
-  },
-  im:rating: {
-    label: "5"
-  },
-  id: {
-    label: "688216376"
-  },
-  title: {
-    label: "This is fun and requires some thinking so five stars"
-  },
-  content: {
-    label: "Title says it all",
-    attributes: {
-      type: "text"
-    }
-  },
-  link: {
-    attributes: {
-      rel: "related",
-      href: "https://itunes.apple.com/us/review?id=400274934&type=Purple%20Software"
-    }
-  },
-  im:voteSum: {
-    label: "0"
-  },
-  im:contentType: {
-    attributes: {
-      term: "Application",
-      label: "Application"
-    }
-  },
-  im:voteCount: {
-    label: "0"
-  }
-}
+<entry>
+  <updated>2016-03-01T12:13:14-07:00</updated>
+  <id>688216376</id>
+  <title>This is fun and requires some thinking so five stars</title>
+  <content type="text">Title says it all</content>
+  <im:contentType term="Application" label="Application"/>
+  <im:voteSum>0</im:voteSum>
+  <im:voteCount>0</im:voteCount>
+  <im:rating>5</im:rating>
+  <im:version>1.6</im:version>
+  <author>
+    <name>Egas semag</name>
+    <uri>https://itunes.apple.com/us/reviews/id106721045</uri>
+  </author>
+  <link rel="related" href="https://itunes.apple.com/us/review?id=400274934&amp;type=Purple%20Software"/>
+  <content type="html">...</content>
+</entry>
 """
 
 MAX_VERSION_LENGTH = 16
 
-def review_from_dict(app, d, country):
+def review_from_entry(app, entry, country):
   r = AppStoreReview(app=app)
-  r.appstore_review_id = long(d['id']['label'])
+  r.appstore_review_id = long(entry.findtext(ATOM + 'id'))
 
-  if 'im:version' in d:
-    version_string = (d['im:version']['label'])[:MAX_VERSION_LENGTH]
-    if version_string != '0':
-      r.app_version = version_string
+  version_string = entry.findtext(ITUNES + 'version')
+  if version_string and version_string != '0':
+    r.app_version = version_string[:MAX_VERSION_LENGTH]
   if not r.app_version:
     # If we don't know the version, use the latest version we know.
     r.app_version = (app.version and app.version[:MAX_VERSION_LENGTH]) or 'unknown'
 
-  r.title = d['title']['label']
-  r.body = d['content']['label']
-  r.rating = int(d['im:rating']['label'])
-  r.author_id = d['author']['uri']['label'].split('/reviews/id')[1]
-  r.author_title = d['author']['name']['label']
+  r.title = entry.findtext(ATOM + 'title') or ''
+  r.body = ''
+  for content in entry.findall(ATOM + 'content'):
+    if content.get('type') == 'text':
+      r.body = content.text or ''
+  r.rating = int(entry.findtext(ITUNES + 'rating'))
+
+  author = entry.find(ATOM + 'author')
+  r.author_id = author.findtext(ATOM + 'uri').split('/reviews/id')[1]
+  r.author_title = author.findtext(ATOM + 'name') or ''
   if len(r.author_title) > 64:
     logging.info('Long author title: %s (appstore_review_id %s)', r.author_title, r.appstore_review_id)
   r.country = country
 
   return r
-
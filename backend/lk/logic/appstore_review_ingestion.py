@@ -14,6 +14,7 @@
 # limitations under the License.
 #
 
+import copy
 import logging
 import math
 import time
@@ -26,13 +27,14 @@ from django.db import connection
 from django.db import transaction
 from django.db.models import F
 from django.db.models import Q
-from redis import WatchError
 
 from backend.lk.logic import appstore_app_info
 from backend.lk.logic import appstore_review_fetch
 from backend.lk.logic import appstore_review_notify
+from backend.lk.logic import bloom_filters
 from backend.lk.logic import emails
 from backend.lk.logic import redis_wrap
+from backend.lk.logic import work_queues
 from backend.lk.models import AppStoreApp
 from backend.lk.models import AppStoreAppInterest
 from backend.lk.models import AppStoreAppReviewTracker
@@ -41,19 +43,52 @@ from backend.lk.models import User
 from backend import celery_app
 
 
-WAIT_BETWEEN_PAGES = 0.5
-
-
 #
 # UPDATE REVIEW OBJECTS
 #
 
 
+KNOWN_REVIEW_IDS_BLOOM_KEY_FORMAT = 'reviews;known-ids-filter;app-id=%s'
+KNOWN_REVIEW_IDS_LOADING_KEY_FORMAT = 'reviews;known-ids-loading;app-id=%s'
+KNOWN_REVIEW_IDS_LOADING_SECONDS = 60 * 5
+# Room to grow before the filter has to be rebuilt.
+KNOWN_REVIEW_IDS_CAPACITY_MULTIPLIER = 2
+KNOWN_REVIEW_IDS_MIN_CAPACITY = 1000
+
+
+def _known_review_ids_key(appstore_app):
+  key = KNOWN_REVIEW_IDS_BLOOM_KEY_FORMAT % appstore_app.id
+  if not bloom_filters.is_full(key):
+    return key
+
+  # Ingestion for other countries might be (re)loading this app's filter
+  # right now; they keep using the old one, or the database, meanwhile.
+  redis = redis_wrap.client()
+  loading_key = KNOWN_REVIEW_IDS_LOADING_KEY_FORMAT % appstore_app.id
+  if not redis.set(loading_key, 1, nx=True, ex=KNOWN_REVIEW_IDS_LOADING_SECONDS):
+    return key
+
+  try:
+    review_ids = list(AppStoreReview.objects.filter(app_id=appstore_app.id
+        ).values_list('appstore_review_id', flat=True))
+    capacity = max(KNOWN_REVIEW_IDS_MIN_CAPACITY, len(review_ids) * KNOWN_REVIEW_IDS_CAPACITY_MULTIPLIER)
+    bloom_filters.create(key, review_ids, capacity)
+  finally:
+    redis.delete(loading_key)
+
+  return key
+
+
 def filter_new_reviews(appstore_app, fetched_reviews):
   review_ids = [review.appstore_review_id for review in fetched_reviews]
-  existing_review_ids = AppStoreReview.objects.filter(appstore_review_id__in=review_ids
-      ).values_list('appstore_review_id', flat=True).distinct()
-  existing_review_ids = set(existing_review_ids)
+
+  # Only ask the database about reviews the bloom filter isn't sure about.
+  maybe_existing_review_ids = bloom_filters.might_contain(_known_review_ids_key(appstore_app), review_ids)
+  existing_review_ids = set()
+  if maybe_existing_review_ids:
+    existing_review_ids = AppStoreReview.objects.filter(appstore_review_id__in=list(maybe_existing_review_ids)
+        ).values_list('appstore_review_id', flat=True).distinct()
+    existing_review_ids = set(existing_review_ids)
 
   return [r for r in fetched_reviews
           if r.appstore_review_id not in existing_review_ids]
@@ -74,12 +109,15 @@ def update_with_new_reviews(appstore_app, country):
   reviews_count = max(appstore_app.reviews_count, appstore_app.current_version_reviews_count)
   guessed_pages = int(math.ceil(reviews_count / 50.0))
 
-  for page in range(min(TOTAL_PAGES, guessed_pages)):
-    # Don't hammer the site esp on initial ingestion.
-    time.sleep(WAIT_BETWEEN_PAGES)
+  stop_at_review_id = None
+  if tracker.has_had_full_ingestion:
+    stop_at_review_id = tracker.latest_appstore_review_id
 
+  for page in range(min(TOTAL_PAGES, guessed_pages)):
+    # NOTE: fetch_reviews() is rate limited, so this doesn't hammer the site
+    # on initial ingestion either.
     has_next_page, fetched_reviews = appstore_review_fetch.fetch_reviews(appstore_app,
-        country=country, page=(page + 1))
+        country=country, page=(page + 1), stop_at_review_id=stop_at_review_id)
 
     if fetched_reviews is None:
       failed_pages += 1
@@ -154,8 +192,14 @@ def update_with_new_reviews(appstore_app, country):
       AppStoreReview.objects.bulk_create(total_to_insert)
     except IntegrityError:
       logging.info('Bulk create got integrity problem, ignoring for now...')
+      # The known ids filter might have missed a review that was inserted
+      # while it was loading; start over with a fresh one next time.
+      bloom_filters.delete(KNOWN_REVIEW_IDS_BLOOM_KEY_FORMAT % appstore_app.id)
       return 0, 0
 
+    bloom_filters.add(KNOWN_REVIEW_IDS_BLOOM_KEY_FORMAT % appstore_app.id,
+        [r.appstore_review_id for r in total_to_insert])
+
     if author_ids:
       AppStoreReview.objects.filter(app_id=appstore_app.id, country=country, author_id__in=list(author_ids),
           invalidated_time__isnull=True).update(invalidated_time=datetime.now())
@@ -178,23 +222,170 @@ def update_with_new_reviews(appstore_app, country):
 APP_REVIEWS_INGESTION_ZSET_KEY = 'review-ingestion-app-ids-countries'
 HOUR = (60.0 * 60.0)
 
+# Full ingestions of big apps can take a while.
+INGESTION_LEASE_SECONDS = HOUR / 2
+FAILED_INGESTION_RETRY_SECONDS = HOUR / 4
 
-def next_ingestion_time(app, country):
-  appstore_app_info.decorate_app(app, country)
-  reviews_count = app.reviews_count or 0
-
-  if reviews_count < 100:
-    # Few times a day, ish.
-    base_wait = HOUR * 6
-  elif reviews_count < 1000:
-    # Every 3 hours, ish.
-    base_wait = HOUR * 2
+INGESTION_QUEUE = work_queues.WorkQueue('review-ingestion',
+    pending_key=APP_REVIEWS_INGESTION_ZSET_KEY,
+    lease_seconds=INGESTION_LEASE_SECONDS)
+
+
+#
+# INGESTION SCHEDULING
+#
+# Each app/country is polled about as often as it takes to expect
+# TARGET_NEW_REVIEWS_PER_INGESTION new reviews, based on a decaying average
+# of how fast new reviews have been showing up for it. If that adds up to
+# more than FETCH_BUDGET_PER_HOUR ingestions overall, every wait is
+# stretched by the same factor.
+#
+
+
+ARRIVAL_RATES_KEY = 'review-ingestion-arrival-rates'
+POLL_RATES_KEY = 'review-ingestion-poll-rates'
+TOTAL_POLL_RATE_KEY = 'review-ingestion-total-poll-rate'
+
+TARGET_NEW_REVIEWS_PER_INGESTION = 5.0
+MIN_WAIT = HOUR / 4
+# Pairs with no new reviews seen yet wait as long as the slowest apps used
+# to, so a quiet app that takes off is noticed within hours; learned rates
+# move the wait either way from there.
+NO_ARRIVALS_WAIT = HOUR * 6
+# With jitter, this is about the longest the slowest apps used to wait.
+MAX_WAIT = HOUR * 10
+FETCH_BUDGET_PER_HOUR = 30000
+
+# Older observations count half as much after this long.
+ARRIVAL_RATE_HALF_LIFE = HOUR * 24 * 3
+BOOTSTRAP_DAYS = 14
+BOOTSTRAP_BATCH_SIZE = 500
+
+
+def _app_country_key(app_id, country):
+  return '%s:%s' % (app_id, country)
+
+
+def _bootstrap_arrival_rates(apps_countries):
+  # New (not initial ingestion) reviews per hour over the last couple weeks.
+  rates = dict((app_country, 0.0) for app_country in apps_countries)
+  for i in range(0, len(apps_countries), BOOTSTRAP_BATCH_SIZE):
+    cursor = connection.cursor()
+    cursor.execute("""
+      SELECT app_id, country, COUNT(*)
+      FROM lk_appstorereview
+      WHERE (app_id, country) IN %s
+        AND NOT initial_ingestion
+        AND create_time > NOW() - INTERVAL %s
+      GROUP BY app_id, country
+    """, [tuple(apps_countries[i:i + BOOTSTRAP_BATCH_SIZE]), '%s days' % BOOTSTRAP_DAYS])
+    for app_id, country, count in cursor.fetchall():
+      rates[(app_id, country)] = count / (BOOTSTRAP_DAYS * 24.0)
+  return rates
+
+
+def review_arrival_rates(apps_countries):
+  """Returns estimated new reviews per hour for each (app id, country)."""
+  apps_countries = list(apps_countries)
+  if not apps_countries:
+    return {}
+
+  redis = redis_wrap.client()
+  fields = [_app_country_key(app_id, country) for app_id, country in apps_countries]
+  stored = redis.hmget(ARRIVAL_RATES_KEY, fields)
+
+  rates = {}
+  missing = []
+  for app_country, value in zip(apps_countries, stored):
+    if value:
+      rates[app_country] = float(value.split(';')[0])
+    else:
+      missing.append(app_country)
+
+  if missing:
+    # These are only stored after an ingestion, so the time stored with
+    # them is always the last ingestion time.
+    rates.update(_bootstrap_arrival_rates(missing))
+
+  return rates
+
+
+def record_ingestion_outcome(app, country, inserted):
+  """Folds the number of new reviews found in an ingestion into the app's
+  estimated arrival rate.
+  """
+  if inserted < 0:
+    # Failed; we didn't learn anything.
+    return
+
+  now = time.time()
+  redis = redis_wrap.client()
+  field = _app_country_key(app.id, country)
+  stored = redis.hget(ARRIVAL_RATES_KEY, field)
+  if stored:
+    rate, last_time = [float(v) for v in stored.split(';')]
+    elapsed = max(now - last_time, 60.0)
+    observed_rate = inserted / (elapsed / HOUR)
+    # Weigh this observation by how long a period it covers.
+    weight = 1.0 - math.pow(0.5, elapsed / ARRIVAL_RATE_HALF_LIFE)
+    rate += weight * (observed_rate - rate)
   else:
-    # Every 1.5 hours, ish.
-    base_wait = HOUR
+    # Whatever was found is the initial backfill, which says nothing about
+    # the arrival rate; start from recent history instead.
+    rate = _bootstrap_arrival_rates([(app.id, country)])[(app.id, country)]
+
+  redis.hset(ARRIVAL_RATES_KEY, field, '%f;%f' % (rate, now))
+
+
+# Replaces poll rates and updates their total by the difference, all at
+# once, so ingestions rescheduled at the same time don't double count.
+# KEYS: poll rates hash, total poll rate
+# ARGV: field, polls per hour pairs
+UPDATE_POLL_RATES_SCRIPT = """
+local change = 0
+for i = 1, #ARGV, 2 do
+  local previous = tonumber(redis.call('hget', KEYS[1], ARGV[i]) or 0)
+  redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+  change = change + tonumber(ARGV[i + 1]) - previous
+end
+return redis.call('incrbyfloat', KEYS[2], tostring(change))
+"""
+
+
+def next_ingestion_times(apps_countries, arrival_rates=None):
+  """Returns the next ingestion timestamp for each (app id, country)."""
+  apps_countries = list(apps_countries)
+  if not apps_countries:
+    return {}
+  if arrival_rates is None:
+    arrival_rates = review_arrival_rates(apps_countries)
+
+  base_waits = {}
+  for app_country in apps_countries:
+    arrival_rate = arrival_rates[app_country]
+    if arrival_rate > 0:
+      base_waits[app_country] = min(max(TARGET_NEW_REVIEWS_PER_INGESTION / arrival_rate * HOUR, MIN_WAIT), MAX_WAIT)
+    else:
+      base_waits[app_country] = NO_ARRIVALS_WAIT
+
+  # Keep track of how many ingestions per hour all of these waits add up to.
+  polls_per_hour = dict((_app_country_key(*app_country), HOUR / base_wait)
+                        for app_country, base_wait in base_waits.items())
+  redis = redis_wrap.client()
+  update_poll_rates = redis.register_script(UPDATE_POLL_RATES_SCRIPT)
+  total_polls_per_hour = update_poll_rates(keys=[POLL_RATES_KEY, TOTAL_POLL_RATE_KEY],
+      args=[v for field_rate in polls_per_hour.items() for v in field_rate])
+
+  over_budget = max(float(total_polls_per_hour) / FETCH_BUDGET_PER_HOUR, 1.0)
 
-  wait = base_wait + (base_wait * (random.randint(0, 100) / 100.0))
-  return time.time() + wait
+  now = time.time()
+  target_times = {}
+  for app_country, base_wait in base_waits.items():
+    wait = base_wait * over_budget
+    # Spread things out a bit so pairs scheduled together don't stay together.
+    wait += wait * (random.randint(0, 20) / 100.0)
+    target_times[app_country] = now + wait
+  return target_times
 
 
 def mark_app_needs_ingestion(app, country, force=False):
@@ -203,21 +394,32 @@ def mark_app_needs_ingestion(app, country, force=False):
     return
 
   # If it needs ingestion, do it now.
-  target_time = time.time()
+  schedule_ingestion(app, country, time.time())
 
-  # ADD app.id TO ZSET AT target_time
-  redis = redis_wrap.client()
-  redis.zadd(APP_REVIEWS_INGESTION_ZSET_KEY, target_time, '%s:%s' % (app.id, country))
+
+def schedule_ingestion(app, country, target_time):
+  INGESTION_QUEUE.schedule({_app_country_key(app.id, country): target_time})
+
+
+def reschedule_ingestion(app, country, target_time):
+  """Finishes a claimed ingestion without doing it, trying again at target_time."""
+  INGESTION_QUEUE.ack([_app_country_key(app.id, country)], reschedule_times=[target_time])
+
+
+def ingestion_failed(app, country):
+  INGESTION_QUEUE.fail([_app_country_key(app.id, country)], FAILED_INGESTION_RETRY_SECONDS)
 
 
 def add_all_apps_to_ingestion_queue():
   apps_countries = list(AppStoreAppReviewTracker.objects.all().values_list('app_id', 'country'))
   redis = redis_wrap.client()
-  for app_id, country in apps_countries:
-    app = AppStoreApp.objects.get(pk=app_id)
-    appstore_app_info.decorate_app(app, country)
-    target_time = next_ingestion_time(app, country)
-    redis.zadd(APP_REVIEWS_INGESTION_ZSET_KEY, target_time, '%s:%s' % (app_id, country))
+  # Poll rates are rebuilt below, dropping any for apps no longer tracked.
+  redis.delete(POLL_RATES_KEY, TOTAL_POLL_RATE_KEY)
+
+  for i in range(0, len(apps_countries), BOOTSTRAP_BATCH_SIZE):
+    target_times = next_ingestion_times(apps_countries[i:i + BOOTSTRAP_BATCH_SIZE])
+    INGESTION_QUEUE.schedule(dict((_app_country_key(app_id, country), target_time)
+                                  for (app_id, country), target_time in target_times.items()))
 
 
 def ingest_app(app, country):
@@ -238,12 +440,15 @@ def ingest_app(app, country):
     except Exception:
       logging.exception('Problem ingesting reviews for app id: %s (%s - %s)',
           app.id, app.itunes_id, app.bundle_id)
+      ingestion_failed(app, country)
       return
 
   else:
     # No reviews in the store, no need to check.
     inserted = 0
 
+  record_ingestion_outcome(app, country, inserted)
+
   tracker_qs = AppStoreAppReviewTracker.objects.filter(app_id=app.id, country=country)
   if inserted < 0:
     # A value of -1 indicates that something went wrong and ingestion failed.
@@ -255,50 +460,41 @@ def ingest_app(app, country):
         successful_ingestion_attempts=F('successful_ingestion_attempts') + 1,
         last_ingestion_time=datetime.now())
 
+  target_time = next_ingestion_times([(app.id, country)])[(app.id, country)]
+  INGESTION_QUEUE.ack([_app_country_key(app.id, country)], reschedule_times=[target_time])
+
 
 def apps_countries_to_ingest(limit, now_offset=0):
-  now_timestamp = time.time() + now_offset
+  """Claims up to limit app/countries that are due for ingestion; each one
+  is rescheduled by ingest_app(), reschedule_ingestion() or
+  ingestion_failed().
+  """
+  app_ids_countries = []
+  for ac in INGESTION_QUEUE.claim(limit, now=time.time() + now_offset):
+    app_id, country = ac.split(':')
+    app_ids_countries.append((long(app_id), country))
+
+  apps_by_id = AppStoreApp.objects.in_bulk([app_id for app_id, _ in app_ids_countries])
+  apps_countries = []
+  deleted_apps_countries = []
+  for app_id, country in app_ids_countries:
+    if app_id not in apps_by_id:
+      deleted_apps_countries.append(_app_country_key(app_id, country))
+    else:
+      # Separate instances so the same app can be decorated for several countries.
+      apps_countries.append((copy.copy(apps_by_id[app_id]), country))
 
-  apps_needing_ingestion = []
-  countries = []
+  if deleted_apps_countries:
+    logging.warn('Deleted app ids, removing from ingestion queue: %s', deleted_apps_countries)
+    INGESTION_QUEUE.ack(deleted_apps_countries)
 
-  # Atomically find next app ids to check.
-  redis = redis_wrap.client()
-  while True:
-    with redis.pipeline() as pipe:
-      try:
-        pipe.watch(APP_REVIEWS_INGESTION_ZSET_KEY)
-        app_ids_countries_needing_ingestion = pipe.zrangebyscore(APP_REVIEWS_INGESTION_ZSET_KEY,
-            0, now_timestamp,
-            start=0, num=limit)
-
-        if app_ids_countries_needing_ingestion:
-          app_ids = []
-          countries = []
-          for ac in app_ids_countries_needing_ingestion:
-            app_id, country = ac.split(':')
-            app_id = long(app_id)
-            app_ids.append(app_id)
-            countries.append(country)
-
-          apps_by_id = dict((a.id, a) for a in AppStoreApp.objects.filter(id__in=app_ids))
-          apps_needing_ingestion = [apps_by_id[app_id] for app_id in app_ids]
-
-          rescored_app_ids = []
-          for app, country in zip(apps_needing_ingestion, countries):
-            rescored_app_ids.append(next_ingestion_time(app, country))
-            rescored_app_ids.append('%s:%s' % (app.id, country))
-
-          if rescored_app_ids:
-            pipe.multi()
-            pipe.zadd(APP_REVIEWS_INGESTION_ZSET_KEY, *rescored_app_ids)
-            pipe.execute()
+  try:
+    appstore_app_info.decorate_apps(apps_countries)
+  except ValueError as e:
+    # ingest_app() tries these again one at a time.
+    logging.warn('Could not decorate apps to ingest: %s', e)
 
-        break
-      except WatchError:
-        logging.info('Interrupted while fetching app ids to ingest...')
-
-  for app, country in zip(apps_needing_ingestion, countries):
+  for app, country in apps_countries:
     yield app, country
 
 
@@ -359,11 +555,9 @@ def send_reviews_ready_email(user_id, app_ids_countries):
   app_ids = [app_id for app_id, _ in app_ids_countries]
   apps_by_id = dict((a.id, a) for a in AppStoreApp.objects.filter(id__in=app_ids))
 
-  apps = []
-  for app_id, country in app_ids_countries:
-    app = apps_by_id[app_id]
-    appstore_app_info.decorate_app(app, country)
-    apps.append(app)
+  apps_countries = [(copy.copy(apps_by_id[app_id]), country) for app_id, country in app_ids_countries]
+  appstore_app_info.decorate_apps(apps_countries)
+  apps = [app for app, _ in apps_countries]
 
   messsage = emails.create_reviews_ready_email(user, apps)
   emails.send_all([messsage])
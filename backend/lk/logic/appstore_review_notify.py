@@ -21,9 +21,9 @@ from backend.util import text
 
 from django.conf import settings
 from django.contrib.staticfiles.templatetags.staticfiles import static
-from django.db.models import Count
-from django.db.models import Max
+from django.db import connection
 from django.db.models import Q
+from django.utils.html import escape
 
 from backend.lk.logic import appstore_app_info
 from backend.lk.logic import emails
@@ -36,6 +36,7 @@ from backend.lk.models import AppStoreReview
 from backend.lk.models import AppStoreReviewNotification
 from backend.lk.models import AppStoreReviewSubscription
 from backend.lk.models import User
+from backend.util import bulksql
 from backend.util import urlutil
 from backend import celery_app
 
@@ -49,39 +50,79 @@ def notify_subscriptions_for_app(app, country):
   _maybe_notify_subscriptions_for_app_id.delay(app.id, country)
 
 
+def _top_reviews_by_sub_id(app, country, subs):
+  # Each sub gets the reviews after its last notification that pass its
+  # rating filter; rank and count them for every sub in one query.
+  rows = []
+  for sub in subs:
+    min_rating = 0
+    if sub.filter_good:
+      min_rating = 4
+    if sub.filter_very_good:
+      min_rating = 5
+    rows.append((sub.id, sub.last_notification_time or sub.create_time, min_rating))
+
+  cursor = connection.cursor()
+  cursor.execute("""
+    SELECT sub_id, review_id, reviews_count, max_create_time FROM (
+      SELECT
+          subs.sub_id,
+          r.id AS review_id,
+          ROW_NUMBER() OVER (PARTITION BY subs.sub_id ORDER BY r.rating DESC, r.create_time DESC) AS rank,
+          COUNT(*) OVER (PARTITION BY subs.sub_id) AS reviews_count,
+          MAX(r.create_time) OVER (PARTITION BY subs.sub_id) AS max_create_time
+      FROM (VALUES %s) AS subs(sub_id, since, min_rating)
+      JOIN lk_appstorereview r ON
+          r.app_id = %%s AND r.country = %%s AND NOT r.initial_ingestion
+          AND r.create_time > subs.since AND r.rating >= subs.min_rating
+    ) ranked
+    WHERE rank <= 10
+    ORDER BY sub_id, rank
+  """ % bulksql.values_sql(len(rows), 3), [v for row in rows for v in row] + [app.id, country])
+  ranked = cursor.fetchall()
+
+  reviews_by_id = AppStoreReview.objects.in_bulk(list(set(review_id for _, review_id, _, _ in ranked)))
+
+  top_reviews_by_sub_id = {}
+  for sub_id, review_id, reviews_count, max_create_time in ranked:
+    if sub_id not in top_reviews_by_sub_id:
+      top_reviews_by_sub_id[sub_id] = (reviews_count, max_create_time, [])
+    top_reviews_by_sub_id[sub_id][2].append(reviews_by_id[review_id])
+  return top_reviews_by_sub_id
+
+
+UNSUBSCRIBE_URL_PLACEHOLDER = 'https://lk-unsubscribe-url-placeholder/'
+
+
 @celery_app.task(ignore_result=True)
 def _maybe_notify_subscriptions_for_app_id(app_id, country):
   app = AppStoreApp.objects.get(pk=app_id)
   appstore_app_info.decorate_app(app, country)
 
   interested_parties = AppStoreAppInterest.objects.filter(app_id=app.id, country=country, enabled=True).values_list('user_id', flat=True)
-  subs = AppStoreReviewSubscription.objects.filter(user__in=interested_parties, enabled=True).select_related('user')
+  subs = AppStoreReviewSubscription.objects.filter(user__in=interested_parties, enabled=True).select_related('user', 'twitter_connection')
   # Restrict subs to unfiltered or filtered just for this app.
-  subs = subs.filter(Q(filter_app_id__isnull=True) | Q(filter_app_id=app_id))
+  subs = list(subs.filter(Q(filter_app_id__isnull=True) | Q(filter_app_id=app_id)))
+  if not subs:
+    return
 
-  if subs.count() > 100:
-    logging.warn('Optimize subscription sending for app: %s (%s - %s)',
-        app.id, app.itunes_id, app.bundle_id)
+  top_reviews_by_sub_id = _top_reviews_by_sub_id(app, country, subs)
 
   email_messages = []
   notifications = []
+  notification_times = []
 
-  for sub in subs:
-    reviews = AppStoreReview.objects.filter(app=app, initial_ingestion=False,
-        create_time__gt=(sub.last_notification_time or sub.create_time),
-        country=country)
-    if sub.filter_good:
-      reviews = reviews.filter(rating__gte=4)
-    if sub.filter_very_good:
-      reviews = reviews.filter(rating=5)
+  # Many subs end up with the same reviews, so render each distinct message once.
+  rendered_email_html = {}
+  rendered_slack_json = {}
 
-    reviews_stats = reviews.aggregate(max_create_time=Max('create_time'), count=Count('id'))
-    reviews_count = reviews_stats['count']
-    reviews_max_create_time = reviews_stats['max_create_time']
-    if not reviews_count:
+  for sub in subs:
+    if sub.id not in top_reviews_by_sub_id:
       continue
 
-    reviews = list(reviews.order_by('-rating', '-create_time')[:10])
+    reviews_count, reviews_max_create_time, reviews = top_reviews_by_sub_id[sub.id]
+    reviews_key = (reviews_count, tuple(r.id for r in reviews))
+
     n = AppStoreReviewNotification(app=app, user=sub.user)
     n.reviews_count = reviews_count
 
@@ -93,18 +134,25 @@ def _maybe_notify_subscriptions_for_app_id(app_id, country):
         created_user = sub.user
         email = sub.email
 
+      html_key = (created_user and created_user.id, reviews_key)
+      if html_key not in rendered_email_html:
+        rendered_email_html[html_key] = emails.create_review_email(email, app, reviews_count, reviews,
+            UNSUBSCRIBE_URL_PLACEHOLDER, created_user=created_user).render_html()
+
       unsub_url = unsubscribe_url_for_subscription(sub)
+      html = rendered_email_html[html_key].replace(UNSUBSCRIBE_URL_PLACEHOLDER, escape(unsub_url))
       email_messages.append(
           emails.create_review_email(email, app, reviews_count, reviews, unsub_url,
-              created_user=created_user))
+              created_user=created_user, html=html))
 
       n.email = email
       if sub.my_email:
         n.my_email = True
 
     elif sub.slack_channel_name or sub.slack_url:
-      slack_json = slack_review_json(app, reviews_count, reviews)
-      slack.post_message_to_slack_subscription(sub, slack_json)
+      if reviews_key not in rendered_slack_json:
+        rendered_slack_json[reviews_key] = slack_review_json(app, reviews_count, reviews)
+      slack.post_message_to_slack_subscription(sub, rendered_slack_json[reviews_key])
 
       if sub.slack_url:
         n.slack_webhook = True
@@ -123,10 +171,14 @@ def _maybe_notify_subscriptions_for_app_id(app_id, country):
 
     # NOTE: This is not now() because now() might be different from max(create_time) of this batch,
     # and we use create_time as the filter for the next notification time.
-    sub.last_notification_time = reviews_max_create_time
-    sub.save(update_fields=['last_notification_time'])
+    notification_times.append((sub.id, reviews_max_create_time))
     notifications.append(n)
 
+  if notification_times:
+    bulksql.update_from_values(connection.cursor(), 'lk_appstorereviewsubscription',
+        ('id', 'last_notification_time'), ['last_notification_time = v.last_notification_time'],
+        sorted(notification_times))
+
   if email_messages:
     emails.send_all(email_messages)
 
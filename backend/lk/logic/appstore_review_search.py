@@ -0,0 +1,133 @@
+#
+# Copyright 2016 Cluster Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+
+from django.db import connection
+
+from backend.lk.logic import redis_wrap
+from backend import celery_app
+
+
+#
+# REVIEW SEARCH
+#
+# lk_appstorereview.search_vector holds the weighted title + body text
+# search vector for each review, kept up to date by a trigger (see
+# migration 0003) and GIN indexed. Titles also have a trigram index so
+# partial words in titles match too.
+#
+# The indexes are built CONCURRENTLY by create_search_indexes(), outside
+# of migrations, so review inserts aren't blocked while they build; run it
+# with "manage.py create_review_search_indexes". Reviews from before the
+# trigger get their vectors from backfill_search_vectors, which beat runs
+# until it reaches the end of the table.
+#
+
+
+SEARCH_CONFIG = 'english'
+
+SEARCH_INDEXES = [
+  ('lk_appstorereview_search_vector_gin', 'USING gin (search_vector)'),
+  ('lk_appstorereview_title_trgm', 'USING gin (title gin_trgm_ops)'),
+]
+
+BACKFILL_BATCH_SIZE = 10000
+BACKFILL_RUN_SECONDS = 20
+BACKFILL_AFTER_ID_KEY = 'reviews;search-backfill;after-id'
+BACKFILL_FINISHED_KEY = 'reviews;search-backfill;finished'
+BACKFILL_RUNNING_KEY = 'reviews;search-backfill;running'
+BACKFILL_RUNNING_SECONDS = 60 * 10
+
+
+def _escape_like(value):
+  return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_where(query):
+  """Returns a WHERE clause and params matching reviews for a search query."""
+  return ("(search_vector @@ plainto_tsquery('%s', %%s) OR title ILIKE %%s)" % SEARCH_CONFIG,
+          [query, '%%%s%%' % _escape_like(query)])
+
+
+def version_where(version):
+  """Returns a WHERE clause and params matching a version and its point
+  releases, eg. 4.2 matches 4.2 and 4.2.1 but not 4.20.
+  """
+  return ('(app_version = %s OR app_version LIKE %s)',
+          [version, '%s.%%' % _escape_like(version)])
+
+
+def create_search_indexes():
+  """Builds whichever search indexes don't exist yet. Must not be called
+  inside a transaction.
+  """
+  cursor = connection.cursor()
+  for name, definition in SEARCH_INDEXES:
+    cursor.execute("""
+      SELECT pg_index.indisvalid
+      FROM pg_class JOIN pg_index ON pg_index.indexrelid = pg_class.oid
+      WHERE pg_class.relname = %s
+    """, [name])
+    row = cursor.fetchone()
+    if row and row[0]:
+      continue
+    if row:
+      # A concurrent build that failed leaves an invalid index behind.
+      logging.info('Dropping invalid index %s...', name)
+      cursor.execute('DROP INDEX %s' % name)
+
+    logging.info('Creating index %s...', name)
+    cursor.execute('CREATE INDEX CONCURRENTLY %s ON lk_appstorereview %s' % (name, definition))
+
+
+@celery_app.task(ignore_result=True)
+def backfill_search_vectors():
+  """Fills in search vectors for reviews from before the trigger, a batch
+  at a time, picking up where the last run left off.
+  """
+  redis = redis_wrap.client()
+  if redis.get(BACKFILL_FINISHED_KEY):
+    return
+  if not redis.set(BACKFILL_RUNNING_KEY, 1, nx=True, ex=BACKFILL_RUNNING_SECONDS):
+    return
+
+  try:
+    after_id = long(redis.get(BACKFILL_AFTER_ID_KEY) or 0)
+    cursor = connection.cursor()
+    cursor.execute('SELECT MAX(id) FROM lk_appstorereview')
+    max_id, = cursor.fetchone()
+
+    start = time.time()
+    while time.time() - start < BACKFILL_RUN_SECONDS:
+      if not max_id or after_id >= max_id:
+        # Newer reviews get their vectors from the trigger.
+        logging.info('Finished backfilling review search vectors.')
+        redis.set(BACKFILL_FINISHED_KEY, 1)
+        return
+
+      last_id = after_id + BACKFILL_BATCH_SIZE
+      # Setting title fires the trigger, which computes the vector.
+      cursor.execute("""
+        UPDATE lk_appstorereview SET title = title
+        WHERE id > %s AND id <= %s AND search_vector IS NULL
+      """, [after_id, last_id])
+      redis.set(BACKFILL_AFTER_ID_KEY, last_id)
+      after_id = last_id
+
+  finally:
+    redis.delete(BACKFILL_RUNNING_KEY)
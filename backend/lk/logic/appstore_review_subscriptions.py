@@ -15,12 +15,14 @@
 # limitations under the License.
 #
 
+import copy
 import logging
 from datetime import datetime
 
 from backend.lk.logic import appstore
 from backend.lk.logic import appstore_app_info
 from backend.lk.logic import appstore_review_notify
+from backend.lk.logic import appstore_review_search
 from backend.lk.models import AppStoreApp
 from backend.lk.models import AppStoreAppInterest
 from backend.lk.models import AppStoreReview
@@ -210,15 +212,27 @@ def subscriptions_for_user(user):
       .filter(user=user, enabled=True)
       .select_related('filter_app', 'twitter_connection')
   )
-  for sub in my_subs:
-    if sub.filter_app_id:
-      # FIXME: Add "country" to filter_app subs.
-      interests = AppStoreAppInterest.objects.filter(user_id=user.id, app_id=sub.filter_app_id)[:1]
-      appstore_app_info.decorate_app(sub.filter_app, interests[0].country)
+  my_subs = list(my_subs)
+
+  filter_app_ids = [sub.filter_app_id for sub in my_subs if sub.filter_app_id]
+  if filter_app_ids:
+    # FIXME: Add "country" to filter_app subs.
+    countries_by_app_id = {}
+    interests = (AppStoreAppInterest.objects
+        .filter(user_id=user.id, app_id__in=filter_app_ids)
+        .order_by('id')
+        .values_list('app_id', 'country'))
+    for app_id, country in interests:
+      countries_by_app_id.setdefault(app_id, country)
+
+    appstore_app_info.decorate_apps([(sub.filter_app, countries_by_app_id[sub.filter_app_id])
+                                     for sub in my_subs if sub.filter_app_id])
+
   return my_subs
 
 
-def subscribed_reviews_for_user(user, app=None, start_review=None, rating=None, limit=None, country=None):
+def subscribed_reviews_for_user(user, app=None, start_review=None, rating=None, limit=None, country=None,
+    query=None, version=None, start_time=None, end_time=None):
   if not limit:
     limit = 25
 
@@ -250,27 +264,54 @@ def subscribed_reviews_for_user(user, app=None, start_review=None, rating=None,
     where += ' AND rating = %s'
     params.append(rating)
 
+  if query:
+    query_where, query_params = appstore_review_search.search_where(query)
+    where += ' AND ' + query_where
+    params += query_params
+
+  if version:
+    version_where, version_params = appstore_review_search.version_where(version)
+    where += ' AND ' + version_where
+    params += version_params
+
+  if start_time:
+    where += ' AND create_time >= %s'
+    params.append(start_time)
+
+  if end_time:
+    where += ' AND create_time < %s'
+    params.append(end_time)
+
+  # Keyset pagination: continue from the last review on the previous page.
   if start_review:
     where += ' AND appstore_review_id < %s'
     params.append(start_review.appstore_review_id)
 
   params.append(limit)
 
+  # Skip search_vector, which isn't a model field.
+  columns = ', '.join(f.column for f in AppStoreReview._meta.concrete_fields)
   reviews = AppStoreReview.objects.raw("""
-    WITH reviews AS (
-      SELECT * FROM lk_appstorereview WHERE
-        invalidated_time IS NULL AND (%s)
-    )
-    SELECT * FROM reviews ORDER BY appstore_review_id DESC LIMIT %%s
-  """ % where, params)
+    SELECT %s FROM lk_appstorereview
+    WHERE invalidated_time IS NULL AND (%s)
+    ORDER BY appstore_review_id DESC
+    LIMIT %%s
+  """ % (columns, where), params)
   reviews = list(reviews)
 
   app_ids = set(r.app_id for r in reviews)
   apps = AppStoreApp.objects.filter(id__in=list(app_ids))
   apps_by_id = dict((a.id, a) for a in apps)
 
+  # One instance per app+country, since each is decorated for a single country.
+  apps_by_id_country = {}
   for r in reviews:
-    r.app = apps_by_id[r.app_id]
-    appstore_app_info.decorate_app(r.app, r.country)
+    app_id_country = (r.app_id, r.country)
+    if app_id_country not in apps_by_id_country:
+      apps_by_id_country[app_id_country] = copy.copy(apps_by_id[r.app_id])
+    r.app = apps_by_id_country[app_id_country]
+
+  appstore_app_info.decorate_apps([(review_app, country)
+                                   for (_, country), review_app in apps_by_id_country.items()])
 
   return reviews
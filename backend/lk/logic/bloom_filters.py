@@ -0,0 +1,153 @@
+#
+# Copyright 2016 Cluster Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import math
+import struct
+import uuid
+
+from backend.lk.logic import redis_wrap
+
+
+#
+# REDIS BLOOM FILTERS
+#
+# A bitmap per filter; might_contain() never says no for a value that was
+# added, but can say yes for one that wasn't.
+#
+# Filters are sized for a capacity when they are created. The bitmap is
+# filled in under its own key, and only becomes visible once the filter
+# key (a hash describing the bitmap) is pointed at it, so readers never
+# see a half-loaded filter. A filter that doesn't exist yet might contain
+# anything.
+#
+
+
+NUM_HASHES = 7
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+CREATE_BATCH_SIZE = 1000
+
+# Readers that looked up the old bitmap just before a rebuild still get
+# to use it for a while.
+REPLACED_BITMAP_EXPIRE_SECONDS = 60
+
+
+def bits_for_capacity(capacity, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+  """m = -n * ln(p) / ln(2)^2, rounded up to a whole byte."""
+  num_bits = int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+  return max(8, (num_bits + 7) // 8 * 8)
+
+
+def _bit_offsets(value, num_bits):
+  digest = hashlib.md5(str(value)).digest()
+  h1, h2 = struct.unpack('<QQ', digest)
+  return [(h1 + i * h2) % num_bits for i in range(NUM_HASHES)]
+
+
+def _bitmap(key):
+  redis = redis_wrap.client()
+  bitmap_key, num_bits = redis.hmget(key, 'bitmap', 'bits')
+  if not bitmap_key:
+    return None, None
+  return bitmap_key, int(num_bits)
+
+
+def is_full(key):
+  """Whether the filter doesn't exist yet, or has had more values added than
+  it was sized for.
+  """
+  redis = redis_wrap.client()
+  capacity, count = redis.hmget(key, 'capacity', 'count')
+  return not capacity or int(count or 0) > int(capacity)
+
+
+def create(key, values, capacity, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+  """Builds a new filter with values, sized for capacity, and swaps it in
+  for whatever filter was at key.
+  """
+  values = list(values)
+  num_bits = bits_for_capacity(max(capacity, len(values), 1), false_positive_rate)
+  bitmap_key = '%s;bitmap=%s' % (key, uuid.uuid4().hex)
+
+  redis = redis_wrap.client()
+  # Allocate the whole bitmap up front.
+  redis.setbit(bitmap_key, num_bits - 1, 0)
+  for i in range(0, len(values), CREATE_BATCH_SIZE):
+    with redis.pipeline(transaction=False) as pipe:
+      for value in values[i:i + CREATE_BATCH_SIZE]:
+        for offset in _bit_offsets(value, num_bits):
+          pipe.setbit(bitmap_key, offset, 1)
+      pipe.execute()
+
+  old_bitmap_key, _ = _bitmap(key)
+  with redis.pipeline() as pipe:
+    pipe.delete(key)
+    pipe.hmset(key, {'bitmap': bitmap_key, 'bits': num_bits, 'capacity': capacity, 'count': len(values)})
+    if old_bitmap_key:
+      pipe.expire(old_bitmap_key, REPLACED_BITMAP_EXPIRE_SECONDS)
+    pipe.execute()
+
+
+def delete(key):
+  redis = redis_wrap.client()
+  bitmap_key, _ = _bitmap(key)
+  with redis.pipeline() as pipe:
+    pipe.delete(key)
+    if bitmap_key:
+      pipe.expire(bitmap_key, REPLACED_BITMAP_EXPIRE_SECONDS)
+    pipe.execute()
+
+
+def add(key, values):
+  if not values:
+    return
+
+  bitmap_key, num_bits = _bitmap(key)
+  if not bitmap_key:
+    # Whoever creates the filter loads these.
+    return
+
+  redis = redis_wrap.client()
+  with redis.pipeline(transaction=False) as pipe:
+    for value in values:
+      for offset in _bit_offsets(value, num_bits):
+        pipe.setbit(bitmap_key, offset, 1)
+    pipe.hincrby(key, 'count', len(values))
+    pipe.execute()
+
+
+def might_contain(key, values):
+  """Returns the subset of values that might have been added to key."""
+  values = list(values)
+  if not values:
+    return set()
+
+  bitmap_key, num_bits = _bitmap(key)
+  if not bitmap_key:
+    return set(values)
+
+  redis = redis_wrap.client()
+  with redis.pipeline(transaction=False) as pipe:
+    for value in values:
+      for offset in _bit_offsets(value, num_bits):
+        pipe.getbit(bitmap_key, offset)
+    bits = pipe.execute()
+
+  maybe = set()
+  for i, value in enumerate(values):
+    if all(bits[i * NUM_HASHES:(i + 1) * NUM_HASHES]):
+      maybe.add(value)
+  return maybe
@@ -33,7 +33,8 @@ class LKEmail(object):
       template_variables=None,
       from_name=None,
       from_address='noreply@%s' % settings.EMAIL_FROM_DOMAIN,
-      reply_to_address=None):
+      reply_to_address=None,
+      html=None):
 
     if from_name is None:
       from_name = 'Help'
@@ -48,6 +49,9 @@ class LKEmail(object):
     self.from_address = from_address
     self.reply_to_address = reply_to_address
 
+    # Already rendered HTML, if any, to use instead of the template.
+    self._html = html
+
     self._metadata = {}
 
   @property
@@ -55,6 +59,9 @@ class LKEmail(object):
     return template.Context(self.template_variables)
 
   def render_html(self):
+    if self._html is not None:
+      return self._html
+
     htmly = template.loader.get_template('emails/%s' % self.template_name)
     html = htmly.render(self._context)
     premailer = Premailer(html, remove_classes=False, strip_important=False)
@@ -264,7 +271,7 @@ def create_reviews_subscription_email(created_user, email, apps, unsubscribe_url
   return message
 
 
-def create_review_email(email, app_info, reviews_count, reviews, unsubscribe_url, created_user=None):
+def create_review_email(email, app_info, reviews_count, reviews, unsubscribe_url, created_user=None, html=None):
   if reviews_count == 1:
     subject = "%s has a new review!" % app_info.short_name
   else:
@@ -281,7 +288,8 @@ def create_review_email(email, app_info, reviews_count, reviews, unsubscribe_url
   message = LKEmail('reviews_reviews_found.html',
       subject, email,
       from_name='Review Monitor',
-      template_variables=template_variables)
+      template_variables=template_variables,
+      html=html)
   message.add_sendgrid_category('review-new')
 
   return message
@@ -15,23 +15,25 @@
 # limitations under the License.
 #
 
-import StringIO
 import collections
 import copy
 import csv
+import itertools
 import json
 import logging
-import math
 import pytz
 import time
 import zlib
 from datetime import datetime
 from datetime import timedelta
+from decimal import Decimal
 
 import requests
+from celery.exceptions import Ignore
 from celery.exceptions import TimeoutError
 from django.conf import settings
 from django.contrib.staticfiles.templatetags.staticfiles import static
+from django.db import connection
 from django.db import transaction
 from django.db.models import Q
 from django.core.cache import cache
@@ -40,15 +42,20 @@ from backend.lk.logic import appstore
 from backend.lk.logic import appstore_app_info
 from backend.lk.logic import crypto_hack
 from backend.lk.logic import emails
+from backend.lk.logic import redis_wrap
+from backend.lk.logic import sales_metrics
 from backend.lk.logic import slack
+from backend.lk.logic import work_queues
 from backend.lk.models import AppStoreApp
 from backend.lk.models import AppStoreSalesReport
+from backend.lk.models import AppStoreSalesReportDailyRollup
 from backend.lk.models import AppStoreSalesReportFetchedStatus
 from backend.lk.models import AppStoreSalesReportNotification
 from backend.lk.models import AppStoreSalesReportSubscription
 from backend.lk.models import ItunesConnectAccessToken
 from backend.lk.models import ItunesConnectVendor
 from backend.lk.models import User
+from backend.util import bulksql
 from backend.util import urlutil
 from backend import celery_app
 
@@ -278,9 +285,18 @@ def conversion_dict_for_currency(base_currency, force=False):
   return conversion_dict
 
 
-def get_freshest_sales_report_date():
+def _now_pacific():
   now = pytz.utc.localize(datetime.now())
-  now_pacific = now.astimezone(pytz.timezone('US/Pacific'))
+  return now.astimezone(pytz.timezone('US/Pacific'))
+
+
+def get_oldest_sales_report_date():
+  # Apple keeps daily reports for the past 365 days, counting today.
+  return _now_pacific().date() - timedelta(MAX_BACKFILL_DAYS - 1)
+
+
+def get_freshest_sales_report_date():
+  now_pacific = _now_pacific()
   freshest_date = now_pacific.date() - timedelta(1)
 
   # reports for the previous day only come out by 6 am in the territory of the report, and since US/Pacific
@@ -516,105 +532,302 @@ def _fetch_vendors(apple_id, password):
   return vendors_response(vendors=vendors)
 
 
-def _create_reports_from_tsv(tsv_file, vendor_id):
+#
+# SALES REPORT LOADING
+#
+# Reports are streamed from Apple, decompressed and parsed a chunk of rows
+# at a time and COPYed into lk_appstoresalesreport, so memory use doesn't
+# grow with report size and no transaction is held open while loading.
+#
+# Rows for iTunes ids we don't have apps for yet are set aside in redis,
+# and _load_unknown_app_sales_reports looks those apps up and loads them
+# afterwards. The report is only marked fetched once every row is loaded.
+#
+
+
+SALES_REPORT_COLUMNS = (
+  'app_id', 'vendor_id', 'create_time',
+  'begin_date', 'end_date',
+  'product_type_identifier', 'units',
+  'customer_currency', 'country_code',
+  'developer_proceeds', 'proceeds_currency',
+  'provider', 'provider_country',
+  'sku', 'title', 'version',
+  'customer_price', 'promo_code',
+  'subscription', 'period',
+  'parent_identifier', 'category', 'cmb',
+)
+APP_ID_COLUMN = SALES_REPORT_COLUMNS.index('app_id')
+END_DATE_COLUMN = SALES_REPORT_COLUMNS.index('end_date')
+PRODUCT_TYPE_COLUMN = SALES_REPORT_COLUMNS.index('product_type_identifier')
+UNITS_COLUMN = SALES_REPORT_COLUMNS.index('units')
+COUNTRY_COLUMN = SALES_REPORT_COLUMNS.index('country_code')
+PROCEEDS_COLUMN = SALES_REPORT_COLUMNS.index('developer_proceeds')
+PROCEEDS_CURRENCY_COLUMN = SALES_REPORT_COLUMNS.index('proceeds_currency')
+
+SALES_REPORT_CHUNK_ROWS = 5000
+SALES_REPORT_STREAM_CHUNK_BYTES = 64 * 1024
+
+SALES_REPORT_LOADING_KEY_FMT = 'sales-reports;loading;vendor=%s;date=%s'
+SALES_REPORT_LOADING_SECONDS = 60 * 30
+UNKNOWN_APP_ROWS_KEY_FMT = 'sales-reports;unknown-app-rows;vendor=%s;date=%s'
+UNKNOWN_APP_COUNTRIES_KEY_FMT = 'sales-reports;unknown-app-countries;vendor=%s;date=%s'
+UNKNOWN_APP_ROWS_SECONDS = 60 * 60 * 24
+
+
+def _iter_decompressed_lines(chunks):
+  decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  remainder = ''
+  for chunk in chunks:
+    lines = (remainder + decompressor.decompress(chunk)).split('\n')
+    remainder = lines.pop()
+    for line in lines:
+      yield line + '\n'
+
+  remainder += decompressor.flush()
+  for line in remainder.split('\n'):
+    if line:
+      yield line + '\n'
+
+
+def _sales_report_row(l, vendor_id, now):
+  """Returns the iTunes id and COPY values (minus app id) for a report TSV row."""
+  try:
+    begin_date = datetime.strptime(l[9], '%m/%d/%Y').date()
+    end_date = datetime.strptime(l[10], '%m/%d/%Y').date()
+  except ValueError:
+    logging.info('Skipping invalid date from tsv row: %r', l)
+    return None, None
+
+  values = [
+    None, vendor_id, now,
+    begin_date, end_date,
+    l[6], l[7],
+    l[11].lower(), l[12].lower(),
+    l[8], l[13].lower(),
+    l[0], l[1].lower(),
+    l[2], l[4], l[5],
+    l[15], l[16],
+    l[18], l[19],
+    l[17], l[20], l[21],
+  ]
+  return l[14], values
+
+
+class _DailyRollups(object):
+  def __init__(self):
+    self.units = collections.defaultdict(Decimal)
+    self.download_units = collections.defaultdict(Decimal)
+    self.proceeds = collections.defaultdict(lambda: collections.defaultdict(Decimal))
+
+  def add(self, app_id, values):
+    app_date = (app_id, str(values[END_DATE_COLUMN]))
+    units = Decimal(values[UNITS_COLUMN])
+    self.units[app_date] += units
+    if values[PRODUCT_TYPE_COLUMN] in AppStoreSalesReport.DOWNLOAD_PRODUCT_TYPE_IDENTIFIERS:
+      self.download_units[app_date] += units
+
+    # developer_proceeds is the unit price. Refunds etc. don't count against revenue.
+    proceeds = Decimal(values[PROCEEDS_COLUMN] or 0) * units
+    self.proceeds[app_date][values[PROCEEDS_CURRENCY_COLUMN]] += max(proceeds, 0)
+
+  def models(self, vendor_id):
+    return [AppStoreSalesReportDailyRollup(
+                vendor_id=vendor_id,
+                app_id=app_id,
+                report_date=report_date,
+                units=units,
+                download_units=self.download_units[(app_id, report_date)],
+                proceeds=dict((currency, str(amount))
+                              for currency, amount in self.proceeds[(app_id, report_date)].items()))
+            for (app_id, report_date), units in self.units.items()]
+
+
+def _clear_sales_report(vendor_id, fetch_date, app_ids=None):
+  """Deletes rows left by an earlier, unfinished attempt at loading a report."""
+  reports = AppStoreSalesReport.objects.filter(vendor_id=vendor_id, end_date=fetch_date)
+  rollups = AppStoreSalesReportDailyRollup.objects.filter(vendor_id=vendor_id, report_date=fetch_date)
+  if app_ids is not None:
+    reports = reports.filter(app_id__in=app_ids)
+    rollups = rollups.filter(app_id__in=app_ids)
+  reports.delete()
+  rollups.delete()
+
+
+def _load_sales_report(vendor_id, fetch_date, lines):
+  """COPYs report rows for known apps, and sets aside the rest. Returns how
+  many rows were loaded, their rollups and whether any were set aside.
+  """
+  now = datetime.now()
+  rows_key = UNKNOWN_APP_ROWS_KEY_FMT % (vendor_id, fetch_date)
+  countries_key = UNKNOWN_APP_COUNTRIES_KEY_FMT % (vendor_id, fetch_date)
+  redis = redis_wrap.client()
+  redis.delete(rows_key, countries_key)
+
+  app_ids_by_itunes_id = {}
+  # iTunes id => (units, country) for the country with the most units
+  unknown_units_countries = {}
+  rollups = _DailyRollups()
+  loaded = 0
+
+  reader = csv.reader(lines, delimiter='\t')
   # drop column titles in first line of tsv
-  lines = list(csv.reader(tsv_file, delimiter='\t'))[1:]
+  next(reader, None)
+
+  while True:
+    rows = [_sales_report_row(l, vendor_id, now) for l in itertools.islice(reader, SALES_REPORT_CHUNK_ROWS)]
+    if not rows:
+      break
+
+    new_itunes_ids = set(itunes_id for itunes_id, _ in rows
+                         if itunes_id and itunes_id not in app_ids_by_itunes_id
+                         and itunes_id not in unknown_units_countries)
+    if new_itunes_ids:
+      app_ids_by_itunes_id.update(
+          AppStoreApp.objects.filter(itunes_id__in=list(new_itunes_ids)).values_list('itunes_id', 'id'))
+
+    copy_lines = []
+    unknown_lines = []
+    for itunes_id, values in rows:
+      if not values:
+        continue
+
+      app_id = app_ids_by_itunes_id.get(itunes_id)
+      if app_id:
+        values[APP_ID_COLUMN] = app_id
+        copy_lines.append(bulksql.copy_line(values))
+        rollups.add(app_id, values)
 
-  countries_units_by_itunes_id = collections.defaultdict(lambda: [])
+      else:
+        values[APP_ID_COLUMN] = itunes_id
+        unknown_lines.append(bulksql.copy_line(values))
+        units_country = (Decimal(values[UNITS_COLUMN]), values[COUNTRY_COLUMN])
+        unknown_units_countries[itunes_id] = max(unknown_units_countries.get(itunes_id, units_country), units_country)
 
-  report_dicts = []
-  for l in lines:
-    d = {}
-    itunes_id = l[14]
-    country = l[12].lower()
-    d['country_code'] = country
-    d['itunes_id'] = itunes_id
+    if copy_lines:
+      bulksql.copy_lines(connection.cursor(), 'lk_appstoresalesreport', SALES_REPORT_COLUMNS, copy_lines)
+      loaded += len(copy_lines)
+    if unknown_lines:
+      redis.rpush(rows_key, *unknown_lines)
 
-    d['vendor_id'] = vendor_id
+  if unknown_units_countries:
+    with redis.pipeline() as pipe:
+      pipe.hmset(countries_key, dict((itunes_id, country)
+                                     for itunes_id, (_, country) in unknown_units_countries.items()))
+      pipe.expire(countries_key, UNKNOWN_APP_ROWS_SECONDS)
+      pipe.expire(rows_key, UNKNOWN_APP_ROWS_SECONDS)
+      pipe.execute()
 
-    try:
-      d['begin_date'] = datetime.strptime(l[9], '%m/%d/%Y').date()
-      d['end_date'] = datetime.strptime(l[10], '%m/%d/%Y').date()
-    except ValueError:
-      logging.info('Skipping invalid date from tsv row: %r', l)
-      continue
-
-    d['product_type_identifier'] = l[6]
-    units = l[7]
-    d['units'] = units
-
-    d['customer_currency'] = l[11].lower()
-    d['proceeds_currency'] = l[13].lower()
-    d['developer_proceeds'] = l[8]
-
-    d['provider'] = l[0]
-    d['provider_country'] = l[1].lower()
-    d['sku'] = l[2]
-    d['title'] = l[4]
-    d['version'] = l[5]
-    d['customer_price'] = l[15]
-    d['promo_code'] = l[16]
-    d['parent_identifier'] = l[17]
-    d['subscription'] = l[18]
-    d['period'] = l[19]
-    d['category'] = l[20]
-    d['cmb'] = l[21]
-
-    countries_units_by_itunes_id[itunes_id].append((units, country))
-    report_dicts.append(d)
-
-  decorated_apps_by_itunes_id = {}
-  for itunes_id, units_countries in countries_units_by_itunes_id.items():
-    # this will sort by the first item in each tuple, being units, so will return the country with the highest sales
-    biggest_unit_country = sorted(countries_units_by_itunes_id[itunes_id], reverse=True)[0]
-    _, country = biggest_unit_country
-    try:
-      decorated_apps_by_itunes_id[itunes_id] = appstore.get_app_by_itunes_id(itunes_id, country)
-    except:
-      logging.exception('Could not find app with id: %s country: %s in sales report for vendor %s',
-          itunes_id, country, vendor_id)
+  return loaded, rollups, bool(unknown_units_countries)
 
-  reports = []
-  missing_apps = set()
-  for report in report_dicts:
-    app = decorated_apps_by_itunes_id.get(report['itunes_id'])
-    if not app:
-      # This might not be an app, eg. an app bundle
-      missing_apps.add(report['itunes_id'])
-      continue
 
-    report['app'] = app
-    del report['itunes_id']
-    reports.append(AppStoreSalesReport(**report))
+def _finish_sales_report(vendor, fetch_date, rollups, notify):
+  with transaction.atomic():
+    AppStoreSalesReportDailyRollup.objects.bulk_create(rollups.models(vendor.id))
+    s = AppStoreSalesReportFetchedStatus(vendor=vendor, report_date=fetch_date)
+    s.save()
+
+  redis = redis_wrap.client()
+  redis.delete(SALES_REPORT_LOADING_KEY_FMT % (vendor.id, fetch_date),
+               UNKNOWN_APP_ROWS_KEY_FMT % (vendor.id, fetch_date),
+               UNKNOWN_APP_COUNTRIES_KEY_FMT % (vendor.id, fetch_date))
+
+  _record_fetch_outcome(vendor.id, fetch_date)
 
-  if missing_apps:
-    logging.info('App(s) missing for report. itunes_ids: %s vendor: %s', list(missing_apps), vendor_id)
+  if notify:
+    send_latest_report_for_user_subs.delay(vendor.user_id, fetch_date)
 
-  return reports
 
+@celery_app.task(queue='itunesfetch', max_retries=5)
+def _load_unknown_app_sales_reports(vendor_id, fetch_date, notify=False):
+  vendor = ItunesConnectVendor.objects.get(pk=vendor_id)
+  rows_key = UNKNOWN_APP_ROWS_KEY_FMT % (vendor_id, fetch_date)
+  redis = redis_wrap.client()
+
+  app_ids_by_itunes_id = {}
+  for itunes_id, country in redis.hgetall(UNKNOWN_APP_COUNTRIES_KEY_FMT % (vendor_id, fetch_date)).items():
+    try:
+      app = appstore.get_app_by_itunes_id(itunes_id, country)
+    except:
+      logging.exception('Could not find app with id: %s country: %s in sales report for vendor %s',
+          itunes_id, country, vendor_id)
+      app = None
+    if app:
+      app_ids_by_itunes_id[itunes_id] = app.id
+    else:
+      # This might not be an app, eg. an app bundle
+      logging.info('App missing for report. itunes_id: %s vendor: %s', itunes_id, vendor_id)
 
-@celery_app.task(queue='itunesfetch', max_retries=10)
+  try:
+    # In case an earlier attempt got partway through.
+    _clear_sales_report(vendor_id, fetch_date, app_ids=app_ids_by_itunes_id.values())
+
+    rollups = _DailyRollups()
+    start = 0
+    while True:
+      lines = redis.lrange(rows_key, start, start + SALES_REPORT_CHUNK_ROWS - 1)
+      if not lines:
+        break
+      start += len(lines)
+
+      copy_lines = []
+      for line in lines:
+        values = line.split('\t')
+        app_id = app_ids_by_itunes_id.get(values[APP_ID_COLUMN])
+        if app_id:
+          values[APP_ID_COLUMN] = str(app_id)
+          copy_lines.append('\t'.join(values))
+          rollups.add(app_id, values)
+
+      if copy_lines:
+        bulksql.copy_lines(connection.cursor(), 'lk_appstoresalesreport', SALES_REPORT_COLUMNS, copy_lines)
+
+  except Exception as e:
+    logging.exception('Itunes Connect Error - Could not load rows for new apps (vendor: %s - date: %s)',
+        vendor_id, fetch_date)
+    if _load_unknown_app_sales_reports.request.retries >= _load_unknown_app_sales_reports.max_retries:
+      # The dispatcher let go of this fetch already, so nobody else will.
+      _record_fetch_outcome(vendor_id, fetch_date, failed=True, gave_up=True)
+    raise _load_unknown_app_sales_reports.retry(exc=e, countdown=60.0)
+
+  _finish_sales_report(vendor, fetch_date, rollups, notify)
+
+
+@celery_app.task(queue='itunesfetch')
 def _fetch_from_itunes(vendor_id, fetch_date, notify=False):
-  def retry(base_wait=1.0):
-    retries = _fetch_from_itunes.request.retries
-    countdown_secs = base_wait * math.pow(2, retries)
-    raise _fetch_from_itunes.retry(countdown=countdown_secs)
+  """Fetches and loads one day's report for the sales report dispatcher,
+  which retries it, and which it reports back to when it's done.
+  """
+  member = _fetch_member(vendor_id, fetch_date, notify)
+  if not SALES_FETCH_QUEUE.renew([member], lease_seconds=SALES_FETCH_LEASE_SECONDS):
+    # Either this sat in the celery queue so long that the dispatcher took
+    # it back, or it was queued before there was a dispatcher.
+    logging.info('Itunes Connect - Handing fetch to dispatcher for vendor: %s date: %s', vendor_id, fetch_date)
+    SALES_FETCH_QUEUE.schedule({member: time.time()})
+    return
+
+  def retry(base_wait=1.0, shared=True):
+    _retry_dispatched_fetch(member, base_wait, shared=shared)
+    raise Ignore()
 
   vendor = ItunesConnectVendor.objects.get(pk=vendor_id)
 
-  def maybe_notify():
-    if notify:
-      send_latest_report_for_user_subs.delay(vendor.user_id, fetch_date)
+  def finished(failed=False):
+    _record_fetch_outcome(vendor_id, fetch_date, failed=failed)
+    _release_dispatched_fetch(member)
 
   fetched = AppStoreSalesReportFetchedStatus.objects.filter(vendor=vendor, report_date=fetch_date)[:1]
   if fetched:
     logging.info('Itunes Connect - aborting attempt to load report that was already fetched')
-    maybe_notify()
+    if notify:
+      send_latest_report_for_user_subs.delay(vendor.user_id, fetch_date)
+    finished(failed=fetched[0].failed)
     return
 
   apple_id, password = _itunes_creds_for_user_id(vendor.user_id)
   if not (apple_id and password):
     logging.error('Itunes Connect Error - Problem fetching user credentials for autoingestion')
+    finished(failed=True)
     return
 
   data = {
@@ -628,7 +841,7 @@ def _fetch_from_itunes(vendor_id, fetch_date, notify=False):
   }
 
   try:
-    r = requests.post('https://reportingitc.apple.com/autoingestion.tft', data=data)
+    r = requests.post('https://reportingitc.apple.com/autoingestion.tft', data=data, stream=True)
   except requests.exceptions.RequestException:
     logging.exception('Itunes Connect Error - Apple may have changed the autoingestion endpoint')
     # Presumably a temporary outage.
@@ -644,8 +857,16 @@ def _fetch_from_itunes(vendor_id, fetch_date, notify=False):
     except UnicodeDecodeError:
       error_message = '(unknown unicode error)'
 
-    if 'past 365 days' in error_message:
+    if 'past 365 days' in error_message and fetch_date < get_freshest_sales_report_date():
       # "Daily reports are only available for past 365 days. Please enter a new date."
+      # This one has aged out, and isn't coming back.
+      logging.info('Itunes Connect - Report too old for vendor: %s date: %s', vendor.itc_id, fetch_date)
+      s = AppStoreSalesReportFetchedStatus(vendor=vendor, report_date=fetch_date, failed=True)
+      s.save()
+      finished(failed=True)
+      return
+
+    if 'past 365 days' in error_message:
       # This means the report is probably not ready yet. Retry in awhile.
       logging.info('Itunes Connect - No report yet for vendor: %s date: %s! Retrying in awhile', vendor.itc_id, fetch_date)
       retry(base_wait=(60.0 * 10))
@@ -656,6 +877,7 @@ def _fetch_from_itunes(vendor_id, fetch_date, notify=False):
       logging.info('Itunes Connect - No report for vendor: %s date: %s', vendor.itc_id, fetch_date)
       s = AppStoreSalesReportFetchedStatus(vendor=vendor, report_date=fetch_date, empty=True)
       s.save()
+      finished()
       return
 
     if (('password was entered incorrectly' in error_message) or
@@ -678,6 +900,7 @@ def _fetch_from_itunes(vendor_id, fetch_date, notify=False):
       logging.info('Itunes Connect - %s: %s', permanent_failure_reason, vendor.itc_id)
       s = AppStoreSalesReportFetchedStatus(vendor=vendor, report_date=fetch_date, failed=True)
       s.save()
+      finished(failed=True)
       return
 
     else:
@@ -686,25 +909,41 @@ def _fetch_from_itunes(vendor_id, fetch_date, notify=False):
       retry()
       return # for clarity
 
+  redis = redis_wrap.client()
+  loading_key = SALES_REPORT_LOADING_KEY_FMT % (vendor.id, fetch_date)
+  if not redis.set(loading_key, 1, nx=True, ex=SALES_REPORT_LOADING_SECONDS):
+    logging.info('Itunes Connect - Report already loading for vendor: %s date: %s', vendor.id, fetch_date)
+    # Check back once it's done, in case we need to notify.
+    retry(base_wait=60.0, shared=False)
+
   try:
-    decompressed = zlib.decompress(r.content, 16 + zlib.MAX_WBITS)
-  except zlib.error as e:
-    logging.error('Itunes Connect Error - Decompressing failed (vendor: %s - exception: %s)', vendor_id, e)
+    _clear_sales_report(vendor.id, fetch_date)
+    lines = _iter_decompressed_lines(r.iter_content(SALES_REPORT_STREAM_CHUNK_BYTES))
+    loaded, rollups, has_unknown_apps = _load_sales_report(vendor.id, fetch_date, lines)
+
+  except (zlib.error, requests.exceptions.RequestException) as e:
+    logging.error('Itunes Connect Error - Reading report failed (vendor: %s - exception: %s)', vendor_id, e)
+    redis.delete(loading_key)
     # TODO(Taylor, Keith): If this error ever occurs, determine if it is recoverable.
     retry()
 
-  tsv = StringIO.StringIO(decompressed)
+  except Exception:
+    redis.delete(loading_key)
+    raise
 
-  with transaction.atomic():
-    reports = _create_reports_from_tsv(tsv, vendor.id)
-    if reports:
-      AppStoreSalesReport.objects.bulk_create(reports)
-    else:
-      logging.info('Itunes Connect - No usable report rows for vendor: %s date: %s', vendor.id, fetch_date)
-    s = AppStoreSalesReportFetchedStatus(vendor=vendor, report_date=fetch_date)
-    s.save()
+  if has_unknown_apps:
+    # Save what we have so far; these finish the report off.
+    AppStoreSalesReportDailyRollup.objects.bulk_create(rollups.models(vendor.id))
+    _load_unknown_app_sales_reports.delay(vendor.id, fetch_date, notify=notify)
+    # We're done with Apple; the rest is counted when it lands.
+    _release_dispatched_fetch(member)
+    return
+
+  if not loaded:
+    logging.info('Itunes Connect - No usable report rows for vendor: %s date: %s', vendor.id, fetch_date)
 
-  maybe_notify()
+  _finish_sales_report(vendor, fetch_date, rollups, notify)
+  _release_dispatched_fetch(member)
 
 
 def report_status_for_vendor_date(vendor, requested_date):
@@ -734,36 +973,327 @@ def choose_vendor(user, vendor):
   import_initial_sales_reports_for_user_vendor(user, vendor)
 
 
-def import_initial_sales_reports_for_user_vendor(user, vendor, delay=True):
-  start_date = get_freshest_sales_report_date()
+def import_initial_sales_reports_for_user_vendor(user, vendor, days=None):
+  backfill_sales_reports(vendor, days or INITIAL_BACKFILL_DAYS, notify_when_ready=True)
 
-  for x in range(14):
-    _fetch_from_itunes.delay(vendor.id, start_date - timedelta(x))
 
-  if delay:
-    # these are in the same queue, so this should happen after these ^
-    finish_initial_ingestion.delay(user.id, start_date)
-  else:
-    really_finish_initial_ingestion.delay(user.id, start_date)
+#
+# SALES REPORT DISPATCH
+#
+# ingest_new_sales_reports schedules a fetch for every chosen vendor in a
+# work queue, and dispatch_sales_report_fetches starts them at a steady
+# rate from a token bucket, with a cap on how many run at once. Only the
+# fetches that are running have celery tasks, so we never flood redis with
+# tens of thousands of them (see celery#1954).
+#
+# When a fetch fails for a reason that likely affects everyone -- Apple
+# being down, or reports not being ready yet -- it pushes back one shared
+# backoff time. Nothing new starts until then, and everything that failed
+# in the meantime is retried then, instead of each fetch backing off on
+# its own countdown.
+#
+
+
+# Claimed fetches can wait a while in the celery queue, so they get a long
+# lease, and then SALES_FETCH_LEASE_SECONDS from when they actually start.
+SALES_FETCH_QUEUE = work_queues.WorkQueue('sales-report-fetch',
+    lease_seconds=60 * 60 * 2, max_attempts=10)
+SALES_FETCH_LEASE_SECONDS = 60 * 15
+
+VENDOR_PAGE_SIZE = 1000
+DISPATCH_RUN_SECONDS = 9
+# How many seconds' worth of fetches may start at once after a lull.
+DISPATCH_BURST_SECONDS = 2
+
+SALES_FETCH_TOKENS_KEY = 'sales-reports;fetch-tokens'
+SALES_FETCH_BACKOFF_KEY = 'sales-reports;fetch-backoff'
+MAX_SALES_FETCH_BACKOFF_SECONDS = 60 * 60
+
+DISPATCH_PROGRESS_KEY_FMT = 'sales-reports;dispatch;date=%s;%s'
+DISPATCH_PROGRESS_SECONDS = 60 * 60 * 24 * 7
+
+
+# KEYS: bucket hash
+# ARGV: now, tokens per second, bucket size, tokens wanted
+TAKE_TOKENS_SCRIPT = """
+local now = tonumber(ARGV[1])
+local size = tonumber(ARGV[3])
+local tokens = tonumber(redis.call('hget', KEYS[1], 'tokens') or size)
+local updated = tonumber(redis.call('hget', KEYS[1], 'updated') or now)
+tokens = math.min(size, tokens + math.max(0, now - updated) * tonumber(ARGV[2]))
+
+local taken = math.max(0, math.min(math.floor(tokens), tonumber(ARGV[4])))
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens - taken), 'updated', tostring(now))
+return taken
+"""
+
+
+# KEYS: backoff hash
+# ARGV: now, base wait, max wait
+BACKOFF_SCRIPT = """
+local now = tonumber(ARGV[1])
+local until_time = tonumber(redis.call('hget', KEYS[1], 'until') or 0)
+-- Everything that fails before the current backoff runs out shares it.
+if now >= until_time then
+  local failures = redis.call('hincrby', KEYS[1], 'failures', 1)
+  local wait = math.min(tonumber(ARGV[2]) * math.pow(2, failures - 1), tonumber(ARGV[3]))
+  until_time = now + wait
+  redis.call('hset', KEYS[1], 'until', tostring(until_time))
+end
+return tostring(until_time)
+"""
+
+
+def _fetch_member(vendor_id, fetch_date, notify):
+  return '%s;%s;%d' % (vendor_id, fetch_date.isoformat(), notify and 1 or 0)
+
+
+def _parse_fetch_member(member):
+  vendor_id, fetch_date, notify = member.split(';')
+  return long(vendor_id), datetime.strptime(fetch_date, '%Y-%m-%d').date(), notify == '1'
+
+
+def _record_fetch_outcome(vendor_id, fetch_date, failed=False, gave_up=False):
+  outcome, other = failed and ('failed', 'done') or ('done', 'failed')
+  redis = redis_wrap.client()
+  with redis.pipeline() as pipe:
+    pipe.srem(DISPATCH_PROGRESS_KEY_FMT % (fetch_date, other), vendor_id)
+    pipe.sadd(DISPATCH_PROGRESS_KEY_FMT % (fetch_date, outcome), vendor_id)
+    pipe.expire(DISPATCH_PROGRESS_KEY_FMT % (fetch_date, outcome), DISPATCH_PROGRESS_SECONDS)
+    pipe.execute()
+
+  _advance_backfill(vendor_id, fetch_date, gave_up=gave_up)
+
+
+def _release_dispatched_fetch(member):
+  SALES_FETCH_QUEUE.ack([member])
+  # Apple answered, so whatever we were backing off from is over.
+  redis = redis_wrap.client()
+  redis.hdel(SALES_FETCH_BACKOFF_KEY, 'failures')
+
+
+def _retry_dispatched_fetch(member, base_wait, shared=True):
+  now = time.time()
+  if not shared:
+    SALES_FETCH_QUEUE.ack([member], reschedule_times=[now + base_wait])
+    return
+
+  redis = redis_wrap.client()
+  backoff = redis.register_script(BACKOFF_SCRIPT)
+  retry_time = float(backoff(keys=[SALES_FETCH_BACKOFF_KEY], args=[now, base_wait, MAX_SALES_FETCH_BACKOFF_SECONDS]))
+  for dead_member in SALES_FETCH_QUEUE.fail([member], retry_time - now):
+    _give_up_dispatched_fetch(dead_member)
+
+
+def _give_up_dispatched_fetch(member):
+  vendor_id, fetch_date, _ = _parse_fetch_member(member)
+  logging.error('Itunes Connect Error - Giving up on report for vendor: %s date: %s', vendor_id, fetch_date)
+  _record_fetch_outcome(vendor_id, fetch_date, failed=True, gave_up=True)
+
+
+def sales_report_dispatch_progress(fetch_date):
+  redis = redis_wrap.client()
+  with redis.pipeline() as pipe:
+    pipe.get(DISPATCH_PROGRESS_KEY_FMT % (fetch_date, 'total'))
+    pipe.scard(DISPATCH_PROGRESS_KEY_FMT % (fetch_date, 'done'))
+    pipe.scard(DISPATCH_PROGRESS_KEY_FMT % (fetch_date, 'failed'))
+    pipe.hget(SALES_FETCH_BACKOFF_KEY, 'until')
+    total, done, failed, backoff_until = pipe.execute()
+
+  total = int(total or 0)
+  return {
+    'total': total,
+    'done': done,
+    'failed': failed,
+    'pending': max(0, total - done - failed),
+    'in_flight': SALES_FETCH_QUEUE.leased_count(),
+    'backoff_until': max(0.0, float(backoff_until or 0)),
+  }
 
 
 @celery_app.task(ignore_result=True, queue='itunes')
 def ingest_new_sales_reports():
-  # TODO(Anyone): Paging so we don't load all the vendors into memory all at once
-  vendor_id_user_ids = ItunesConnectVendor.objects.filter(is_chosen=True).values_list('id', 'user_id')
-
   freshest_date = get_freshest_sales_report_date()
-  for vendor_id, user_id in vendor_id_user_ids:
-    _fetch_from_itunes.delay(vendor_id, freshest_date, notify=True)
-    # This is to prevent hammering redis as we create thousands of new tasks
-    # and chords there. In theory it will prevent this from happening:
-    #   https://github.com/celery/celery/issues/1954
-    time.sleep(0.1)
+  now = time.time()
+
+  scheduled = 0
+  after_id = 0
+  while True:
+    vendor_ids = list(ItunesConnectVendor.objects
+        .filter(is_chosen=True, id__gt=after_id)
+        .order_by('id')
+        .values_list('id', flat=True)[:VENDOR_PAGE_SIZE])
+    if not vendor_ids:
+      break
+
+    SALES_FETCH_QUEUE.schedule(dict((_fetch_member(vendor_id, freshest_date, True), now)
+                                    for vendor_id in vendor_ids))
+    scheduled += len(vendor_ids)
+    after_id = vendor_ids[-1]
+
+  redis = redis_wrap.client()
+  redis.setex(DISPATCH_PROGRESS_KEY_FMT % (freshest_date, 'total'), DISPATCH_PROGRESS_SECONDS, scheduled)
+  logging.info('Itunes Connect - Scheduled %s sales report fetches for %s', scheduled, freshest_date)
+
+
+@celery_app.task(ignore_result=True, queue='itunes')
+def dispatch_sales_report_fetches():
+  rate = settings.ITUNES_CONNECT_FETCHES_PER_SECOND
+  bucket_size = max(1, rate * DISPATCH_BURST_SECONDS)
+
+  redis = redis_wrap.client()
+  take_tokens = redis.register_script(TAKE_TOKENS_SCRIPT)
+
+  start = time.time()
+  dispatched = 0
+  while True:
+    now = time.time()
+    backoff_until = float(redis.hget(SALES_FETCH_BACKOFF_KEY, 'until') or 0)
+    if backoff_until > now:
+      break
+
+    # The fetches we'd be waiting on run on the same workers as this, so
+    # leave it to the next beat instead of waiting around for room.
+    room = settings.ITUNES_CONNECT_MAX_CONCURRENT_FETCHES - SALES_FETCH_QUEUE.leased_count(now)
+    if room <= 0:
+      break
+    tokens = take_tokens(keys=[SALES_FETCH_TOKENS_KEY], args=[now, rate, bucket_size, room])
+    if not tokens:
+      break
+
+    members, dead_members = SALES_FETCH_QUEUE.claim(tokens, now=now, with_dead_letters=True)
+    # Fetches whose workers died too many times.
+    for dead_member in dead_members:
+      _give_up_dispatched_fetch(dead_member)
+
+    for member in members:
+      vendor_id, fetch_date, notify = _parse_fetch_member(member)
+      _fetch_from_itunes.delay(vendor_id, fetch_date, notify=notify)
+    dispatched += len(members)
+
+    if len(members) < tokens:
+      # Nothing else is due; put back what we didn't use.
+      redis.hincrbyfloat(SALES_FETCH_TOKENS_KEY, 'tokens', tokens - len(members))
+      break
+
+    if time.time() - start >= DISPATCH_RUN_SECONDS:
+      break
+
+  if dispatched:
+    logging.info('Itunes Connect - Dispatched %s sales report fetches', dispatched)
+
+
+#
+# SALES REPORT BACKFILL
+#
+# Backfills fetch a range of days for one vendor, newest first, through the
+# dispatcher. Only a few of a vendor's days are scheduled at a time; each
+# one that lands schedules the next, so a year of history doesn't crowd out
+# everyone else's daily reports.
+#
+# A day has landed once it has an AppStoreSalesReportFetchedStatus, or once
+# the dispatcher has given up on it. When the most recent REPORT_READY_DAYS
+# have landed, the user's first report is ready to send.
+#
+
+
+INITIAL_BACKFILL_DAYS = 365
+# Apple only keeps daily reports for the past 365 days, counting today in
+# US/Pacific; see get_oldest_sales_report_date().
+MAX_BACKFILL_DAYS = 365
+BACKFILL_PARALLELISM = 3
+# The first report compares the last week to the one before it.
+REPORT_READY_DAYS = 14
+
+BACKFILL_KEY_FMT = 'sales-reports;backfill;vendor=%s'
+BACKFILL_GAVE_UP_KEY_FMT = 'sales-reports;backfill-gave-up;vendor=%s'
+BACKFILL_SECONDS = 60 * 60 * 24 * 7
+
+
+# KEYS: backfill hash
+ADVANCE_BACKFILL_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+  return nil
+end
+local offset = redis.call('hincrby', KEYS[1], 'scheduled', 1) - 1
+if offset >= tonumber(redis.call('hget', KEYS[1], 'days')) then
+  return nil
+end
+return offset
+"""
+
+
+def backfill_sales_reports(vendor, days, notify_when_ready=False):
+  end_date = get_freshest_sales_report_date()
+  # Don't ask for anything Apple has already dropped.
+  days = max(1, min(days, (end_date - get_oldest_sales_report_date()).days + 1))
+  first_days = min(days, BACKFILL_PARALLELISM)
+
+  redis = redis_wrap.client()
+  key = BACKFILL_KEY_FMT % vendor.id
+  with redis.pipeline() as pipe:
+    pipe.delete(key, BACKFILL_GAVE_UP_KEY_FMT % vendor.id)
+    pipe.hmset(key, {
+      'user_id': vendor.user_id,
+      'end_date': end_date.isoformat(),
+      'days': days,
+      'scheduled': first_days,
+      'notify': notify_when_ready and 1 or 0,
+    })
+    pipe.expire(key, BACKFILL_SECONDS)
+    pipe.execute()
+
+  now = time.time()
+  SALES_FETCH_QUEUE.schedule(dict((_fetch_member(vendor.id, end_date - timedelta(x), False), now)
+                                  for x in range(first_days)))
 
 
-@celery_app.task(ignore_result=True, queue='itunesfetch')
-def finish_initial_ingestion(user_id, requested_date):
-  really_finish_initial_ingestion.apply_async(args=[user_id, requested_date], countdown=(60.0 * 4))
+def _landed_backfill_days(vendor_id, gave_up_dates, start_date, end_date):
+  landed = AppStoreSalesReportFetchedStatus.objects.filter(vendor_id=vendor_id,
+      report_date__gte=start_date, report_date__lte=end_date).count()
+  return landed + len([d for d in gave_up_dates if start_date <= d <= end_date])
+
+
+def _advance_backfill(vendor_id, fetch_date, gave_up=False):
+  key = BACKFILL_KEY_FMT % vendor_id
+  gave_up_key = BACKFILL_GAVE_UP_KEY_FMT % vendor_id
+  redis = redis_wrap.client()
+  state = redis.hgetall(key)
+  if not state:
+    return
+
+  end_date = datetime.strptime(state['end_date'], '%Y-%m-%d').date()
+  days = int(state['days'])
+  start_date = end_date - timedelta(days - 1)
+  if not start_date <= fetch_date <= end_date:
+    return
+
+  if gave_up:
+    with redis.pipeline() as pipe:
+      pipe.sadd(gave_up_key, fetch_date.isoformat())
+      pipe.expire(gave_up_key, BACKFILL_SECONDS)
+      pipe.execute()
+
+  advance = redis.register_script(ADVANCE_BACKFILL_SCRIPT)
+  offset = advance(keys=[key])
+  if offset is not None:
+    SALES_FETCH_QUEUE.schedule({_fetch_member(vendor_id, end_date - timedelta(offset), False): time.time()})
+
+  gave_up_dates = [datetime.strptime(d, '%Y-%m-%d').date() for d in redis.smembers(gave_up_key)]
+
+  if 'ready' not in state:
+    ready_start_date = end_date - timedelta(min(days, REPORT_READY_DAYS) - 1)
+    ready_days = (end_date - ready_start_date).days + 1
+    if _landed_backfill_days(vendor_id, gave_up_dates, ready_start_date, end_date) < ready_days:
+      return
+
+    # Only the first fetch to get here sends it.
+    if redis.hsetnx(key, 'ready', 1) and state['notify'] == '1':
+      really_finish_initial_ingestion.delay(long(state['user_id']), end_date)
+
+  if _landed_backfill_days(vendor_id, gave_up_dates, start_date, end_date) >= days:
+    logging.info('Itunes Connect - Finished backfilling %s days for vendor: %s', days, vendor_id)
+    redis.delete(key, gave_up_key)
 
 
 @celery_app.task(ignore_result=True, queue='itunes')
@@ -972,30 +1502,6 @@ def slack_field_value(n, delta_day, delta_week, day_nonneg, week_nonneg, data_ty
     return u'%i downloads\n_%s / %s_' % (n, day_part, week_part)
 
 
-METRICS_DICT = {
-  'downloads': {
-    'week': {
-      'requested': 0,
-      'previous': 0,
-    },
-    'day': {
-      'requested': 0,
-      'previous': 0,
-    },
-  },
-  'revenue': {
-    'week': {
-      'requested': 0,
-      'previous': 0,
-    },
-    'day': {
-      'requested': 0,
-      'previous': 0,
-    },
-  },
-}
-
-
 def get_sales_metrics(vendor, requested_date, base_currency='usd'):
   if report_status_for_vendor_date(vendor, requested_date) != REPORT_STATUS_AVAILABLE:
     return None, None
@@ -1018,62 +1524,14 @@ def get_sales_metrics(vendor, requested_date, base_currency='usd'):
       .distinct()
   )
 
-  reports = list(
-    AppStoreSalesReport.objects
-      .filter(vendor=vendor, end_date__in=load_dates)
-      # Don't load the app name / promo code / category / version / etc. here
-      .only('app_id', 'developer_proceeds', 'proceeds_currency', 'units', 'end_date', 'product_type_identifier')
-  )
-
-  total_sales_metrics = copy.deepcopy(METRICS_DICT)
-  app_sales_metrics = {}
-
   currency_conversions = conversion_dict_for_currency(base_currency) or {}
+  app_ids, download_sums, revenue_sums = sales_metrics.app_period_sums(vendor.id, requested_date,
+      currency_conversions, base_currency)
 
-  for report in reports:
-    app_id = report.app_id
-    if app_id not in app_sales_metrics:
-      app_sales_metrics[app_id] = copy.deepcopy(METRICS_DICT)
-
-    revenue = float(report.developer_proceeds or 0)
-    if report.proceeds_currency != base_currency:
-      if report.proceeds_currency in currency_conversions:
-        revenue = revenue / currency_conversions[report.proceeds_currency]
-      else:
-        logging.error('Itunes Connect Error - currency conversion not found: %s -> %s', report.proceeds_currency, base_currency)
-        revenue = 0
-
-    # developer_proceeds is the unit price. units is a decimal.
-    revenue *= float(report.units)
-
-    if revenue > 0:
-      if report.end_date in requested_week_dates:
-        app_sales_metrics[app_id]['revenue']['week']['requested'] += revenue
-        total_sales_metrics['revenue']['week']['requested'] += revenue
-        if report.end_date == requested_date:
-          app_sales_metrics[app_id]['revenue']['day']['requested'] += revenue
-          total_sales_metrics['revenue']['day']['requested'] += revenue
-        if report.end_date == previous_date:
-          app_sales_metrics[app_id]['revenue']['day']['previous'] += revenue
-          total_sales_metrics['revenue']['day']['previous'] += revenue
-      else:
-        app_sales_metrics[app_id]['revenue']['week']['previous'] += revenue
-        total_sales_metrics['revenue']['week']['previous'] += revenue
-
-    if report.is_download:
-      downloads = int(report.units)
-      if report.end_date in requested_week_dates:
-        app_sales_metrics[app_id]['downloads']['week']['requested'] += downloads
-        total_sales_metrics['downloads']['week']['requested'] += downloads
-        if report.end_date == requested_date:
-          app_sales_metrics[app_id]['downloads']['day']['requested'] += downloads
-          total_sales_metrics['downloads']['day']['requested'] += downloads
-        if report.end_date == previous_date:
-          app_sales_metrics[app_id]['downloads']['day']['previous'] += downloads
-          total_sales_metrics['downloads']['day']['previous'] += downloads
-      else:
-        app_sales_metrics[app_id]['downloads']['week']['previous'] += downloads
-        total_sales_metrics['downloads']['week']['previous'] += downloads
+  total_sales_metrics = sales_metrics.metrics_dict(download_sums.sum(axis=0), revenue_sums.sum(axis=0))
+  app_sales_metrics = {}
+  for i, app_id in enumerate(app_ids):
+    app_sales_metrics[long(app_id)] = sales_metrics.metrics_dict(download_sums[i], revenue_sums[i])
 
   if requested_date not in dates_accounted_for:
     logging.warn('Requested date not in dates accounted for, yet status was available')
@@ -1122,12 +1580,11 @@ def get_sales_metrics(vendor, requested_date, base_currency='usd'):
       weekly_rev['delta'] = formatted_delta(weekly_rev['requested'], weekly_rev['previous'])
 
   apps_by_id = {a.id: a for a in AppStoreApp.objects.filter(id__in=app_sales_metrics.keys())}
+  appstore_app_info.decorate_apps([(app, app.app_info_countries[0]) for app in apps_by_id.values()])
   app_sales_metrics_list = []
   for app_id in app_sales_metrics:
     metrics = app_sales_metrics[app_id]
-    app = apps_by_id[app_id]
-    appstore_app_info.decorate_app(app, app.app_info_countries[0])
-    app_sales_metrics_list.append({'app': app, 'metrics': metrics})
+    app_sales_metrics_list.append({'app': apps_by_id[app_id], 'metrics': metrics})
   app_sales_metrics_list.sort(key=lambda a: a['metrics']['downloads']['day']['requested'], reverse=True)
 
   if len(app_sales_metrics_list) == 1:
@@ -14,10 +14,16 @@
 # limitations under the License.
 #
 
+import collections
+import cPickle as pickle
+import hashlib
+import json
+
 from django.db import connection
 from django.db import transaction
 from django.db.models import Q
 
+from backend.lk.logic import redis_wrap
 from backend.lk.models import MatchOperator
 from backend.lk.models import RuntimeConfigRule
 from backend.lk.models import RuntimeConfigRuleNamespace
@@ -168,23 +174,177 @@ class ConfigInterpreter(object):
     return interpret_rules(self.rules, **kwargs)
 
 
-def interpolated_config_for_user(user, namespace, bundle_id, **kwargs):
-  all_rules = rules_for_user(user, bundle_id, namespace=namespace)
+#
+# COMPILED RULES
+#
+# interpret_rules() re-sorts rules and re-parses versions on every call.
+# For config delivery, each (user, bundle_id, namespaces) ruleset is instead
+# compiled once into per-key lists of pre-parsed match tuples, and cached
+# in process and in redis keyed by the namespaces' update times.
+#
+
+
+# Whether a rule matches, given cmp(rule value, client value).
+MATCH_OPERATOR_TESTS = {
+  MatchOperator.GREATER_OR_EQUAL: lambda c: c <= 0,
+  MatchOperator.GREATER: lambda c: c < 0,
+  MatchOperator.EQUAL: lambda c: c == 0,
+  MatchOperator.LESS_OR_EQUAL: lambda c: c >= 0,
+  MatchOperator.LESS: lambda c: c > 0,
+}
+
+
+def _compile_match(rule_version, match_operator):
+  if not rule_version:
+    return None
+  return text.version_parts(rule_version), match_operator
+
+
+def compile_rules(rules):
+  compiled = collections.defaultdict(list)
+  for rule in sorted(rules, key=lambda r: (r.specificity, r.sort_time), reverse=True):
+    labels = rule.sdk_user_labels
+    compiled[rule.key].append((
+      _compile_match(rule.version, rule.version_match),
+      _compile_match(rule.build, rule.build_match),
+      _compile_match(rule.ios_version, rule.ios_version_match),
+      rule.debug,
+      labels and tuple(labels.split(',')),
+      rule.typed_value,
+    ))
+  return dict(compiled)
+
+
+def _version_matches(compiled_match, client_parts):
+  if compiled_match is None:
+    return True
+  if client_parts is None:
+    return False
 
-  interpreters = {}
-  for rule in all_rules:
-    if rule.key not in interpreters:
-      interpreters[rule.key] = ConfigInterpreter(rule.key)
-    interpreters[rule.key].add_rule(rule)
+  rule_parts, match_operator = compiled_match
+  test = MATCH_OPERATOR_TESTS.get(match_operator)
+  return not test or test(text.cmp_version_parts(rule_parts, client_parts))
+
+
+def evaluate_compiled_rules(compiled, version=None, build=None, ios_version=None,
+                            sdk_user_labels=None, debug=False):
+  version_parts = text.version_parts(version) if version else None
+  build_parts = text.version_parts(build) if build else None
+  ios_version_parts = text.version_parts(ios_version) if ios_version else None
 
   values = {}
-  for interpreter in interpreters.values():
-    value = interpreter.value(**kwargs)
-    if value is not None:
-      values[interpreter.key] = value
+  for key, compiled_rules in compiled.items():
+    for version_match, build_match, ios_version_match, rule_debug, labels, value in compiled_rules:
+      if not _version_matches(version_match, version_parts):
+        continue
+      if not _version_matches(build_match, build_parts):
+        continue
+      if not _version_matches(ios_version_match, ios_version_parts):
+        continue
+
+      # None here means not set at all -- important since this one is a boolean.
+      if rule_debug is not None and rule_debug != debug:
+        continue
+
+      if labels:
+        if not sdk_user_labels:
+          continue
+        if not all(label in sdk_user_labels for label in labels):
+          continue
+
+      if value is not None:
+        values[key] = value
+      break
+
   return values
 
 
+NAMESPACE_VERSIONS_REDIS_KEY_FORMAT = 'runtime-config;namespace-versions;user-id=%s;bundle-id=%s'
+# This bounds how long a reader racing an uncommitted rules change can keep
+# serving rules compiled from before the change.
+NAMESPACE_VERSIONS_TIMEOUT = 15
+COMPILED_RULES_REDIS_KEY_FORMAT = 'runtime-config;compiled;user-id=%s;bundle-id=%s;versions=%s'
+COMPILED_RULES_TIMEOUT = 60 * 60 * 24
+COMPILED_RULES_PROCESS_CACHE_LIMIT = 1000
+
+_compiled_rules_by_key = {}
+
+
+def _namespaces_tuple(namespace):
+  if isinstance(namespace, (tuple, list)):
+    return tuple(namespace)
+  return (namespace,)
+
+
+def _namespace_versions(redis, user, bundle_id, namespaces):
+  versions_key = NAMESPACE_VERSIONS_REDIS_KEY_FORMAT % (user.id, bundle_id)
+  fields = [ns or '' for ns in namespaces]
+  versions = redis.hmget(versions_key, fields)
+  if all(v is not None for v in versions):
+    return versions
+
+  update_times = dict(
+      RuntimeConfigRuleNamespace.objects
+        .filter(user=user, bundle_id=bundle_id)
+        .values_list('namespace', 'update_time'))
+  versions = []
+  for ns in namespaces:
+    update_time = update_times.get(ns)
+    versions.append(update_time and '%f' % RuntimeConfigRule.date_to_api_date(update_time) or '0')
+
+  with redis.pipeline() as pipe:
+    pipe.hmset(versions_key, dict(zip(fields, versions)))
+    pipe.expire(versions_key, NAMESPACE_VERSIONS_TIMEOUT)
+    pipe.execute()
+
+  return versions
+
+
+def compiled_rules_for_user(user, bundle_id, namespace):
+  namespaces = _namespaces_tuple(namespace)
+  redis = redis_wrap.client()
+  versions = _namespace_versions(redis, user, bundle_id, namespaces)
+
+  versions_string = ','.join('%s:%s' % (ns or '', v) for ns, v in zip(namespaces, versions))
+  cache_key = COMPILED_RULES_REDIS_KEY_FORMAT % (user.id, bundle_id, versions_string)
+
+  compiled = _compiled_rules_by_key.get(cache_key)
+  if compiled is not None:
+    return compiled
+
+  pickled = redis.get(cache_key)
+  if pickled:
+    compiled = pickle.loads(pickled)
+  else:
+    compiled = compile_rules(rules_for_user(user, bundle_id, namespace=list(namespaces)))
+    redis.setex(cache_key, COMPILED_RULES_TIMEOUT, pickle.dumps(compiled, pickle.HIGHEST_PROTOCOL))
+
+  if len(_compiled_rules_by_key) >= COMPILED_RULES_PROCESS_CACHE_LIMIT:
+    _compiled_rules_by_key.clear()
+  _compiled_rules_by_key[cache_key] = compiled
+
+  return compiled
+
+
+def invalidate_compiled_rules(user, bundle_id):
+  # Compiled rules are keyed by namespace versions, so dropping the versions
+  # makes the next reader pick up new update times and recompile.
+  redis = redis_wrap.client()
+  redis.delete(NAMESPACE_VERSIONS_REDIS_KEY_FORMAT % (user.id, bundle_id))
+
+
+def interpolated_config_for_user(user, namespace, bundle_id, **kwargs):
+  compiled = compiled_rules_for_user(user, bundle_id, namespace)
+  return evaluate_compiled_rules(compiled, **kwargs)
+
+
+def config_hash(config):
+  """A short content hash of an evaluated config, so clients can tell us which
+  config they already have.
+  """
+  return hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()[:16]
+
+
 def interpolated_config_for_session(session):
   return interpolated_config_for_user(
       session.user,
@@ -311,6 +471,8 @@ def update_namespace_status(user, bundle_id, namespace):
       user=user, bundle_id=bundle_id, namespace=namespace)
   published.save()
 
+  invalidate_compiled_rules(user, bundle_id)
+
 
 def namespace_update_time(user, bundle_id, namespace):
   status = RuntimeConfigRuleNamespace.objects.filter(
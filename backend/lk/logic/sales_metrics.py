@@ -0,0 +1,133 @@
+#
+# Copyright 2016 Cluster Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import logging
+
+import numpy as np
+from django.db import connection
+
+
+#
+# SALES METRICS
+#
+# Sums downloads and revenue for all of a vendor's apps at once. The daily
+# rollups are loaded as numpy columns, proceeds are converted with one rate
+# lookup per distinct currency, and each period's sums are a bincount over
+# app indexes rather than a pass over rows per app.
+#
+
+
+# name, comparison, first & last day included (in days before the requested date)
+PERIODS = (
+  ('day', 'requested', 0, 0),
+  ('day', 'previous', 1, 1),
+  ('week', 'requested', 0, 6),
+  ('week', 'previous', 7, 13),
+)
+DAYS_LOADED = max(last for _, _, _, last in PERIODS) + 1
+
+
+def _columns(rows, num_columns):
+  if not rows:
+    return [()] * num_columns
+  return zip(*rows)
+
+
+def load_rollup_columns(vendor_id, requested_date):
+  """Loads the rollups for the days ending on requested_date as columns:
+  (app_ids, days_ago, downloads) and (app_ids, days_ago, currencies, proceeds).
+  """
+  cursor = connection.cursor()
+  cursor.execute("""
+    SELECT app_id, %s::date - report_date, download_units::float8
+    FROM lk_appstoresalesreportdailyrollup
+    WHERE vendor_id = %s AND report_date > %s::date - %s AND report_date <= %s
+  """, [requested_date, vendor_id, requested_date, DAYS_LOADED, requested_date])
+  app_ids, days_ago, downloads = _columns(cursor.fetchall(), 3)
+  download_columns = (
+    np.array(app_ids, dtype=np.int64),
+    np.array(days_ago, dtype=np.int64),
+    np.array(downloads, dtype=np.float64),
+  )
+
+  cursor.execute("""
+    SELECT r.app_id, %s::date - r.report_date, p.key, p.value::float8
+    FROM lk_appstoresalesreportdailyrollup r, each(r.proceeds) p
+    WHERE r.vendor_id = %s AND r.report_date > %s::date - %s AND r.report_date <= %s
+  """, [requested_date, vendor_id, requested_date, DAYS_LOADED, requested_date])
+  app_ids, days_ago, currencies, proceeds = _columns(cursor.fetchall(), 4)
+  proceeds_columns = (
+    np.array(app_ids, dtype=np.int64),
+    np.array(days_ago, dtype=np.int64),
+    np.array(currencies, dtype=object),
+    np.array(proceeds, dtype=np.float64),
+  )
+
+  return download_columns, proceeds_columns
+
+
+def convert_currency(currencies, amounts, conversions, base_currency):
+  """Converts amounts into base_currency; conversions maps each currency to
+  its units per base_currency unit. Amounts in unknown currencies become 0.
+  """
+  unique_currencies, currency_index = np.unique(currencies, return_inverse=True)
+  rates = np.array([c == base_currency and 1.0 or conversions.get(c, np.nan) for c in unique_currencies],
+                   dtype=np.float64)
+
+  missing = np.isnan(rates)
+  for currency in unique_currencies[missing]:
+    logging.error('Itunes Connect Error - currency conversion not found: %s -> %s', currency, base_currency)
+  rates[missing] = np.inf
+
+  return amounts / rates[currency_index]
+
+
+def sum_periods(app_index, days_ago, values, num_apps):
+  """Returns a (num_apps, len(PERIODS)) array of values summed by app and period."""
+  sums = np.zeros((num_apps, len(PERIODS)), dtype=np.float64)
+  for i, (_, _, first, last) in enumerate(PERIODS):
+    in_period = (days_ago >= first) & (days_ago <= last)
+    # Older numpy won't take minlength=0.
+    sums[:, i] = np.bincount(app_index[in_period], weights=values[in_period],
+                             minlength=max(num_apps, 1))[:num_apps]
+  return sums
+
+
+def app_period_sums(vendor_id, requested_date, conversions, base_currency):
+  """Returns app ids, with download and revenue sums by PERIODS for each."""
+  (download_app_ids, download_days_ago, downloads), (proceeds_app_ids, proceeds_days_ago, currencies, proceeds) = \
+      load_rollup_columns(vendor_id, requested_date)
+
+  app_ids, app_index = np.unique(np.concatenate([download_app_ids, proceeds_app_ids]), return_inverse=True)
+  download_app_index = app_index[:len(download_app_ids)]
+  proceeds_app_index = app_index[len(download_app_ids):]
+
+  revenue = convert_currency(currencies, proceeds, conversions, base_currency)
+  return (
+    app_ids,
+    sum_periods(download_app_index, download_days_ago, downloads, len(app_ids)),
+    sum_periods(proceeds_app_index, proceeds_days_ago, revenue, len(app_ids)),
+  )
+
+
+def metrics_dict(download_sums, revenue_sums):
+  """Arranges one row of app_period_sums() for the report renderers."""
+  metrics = {'downloads': {}, 'revenue': {}}
+  for i, (period, comparison, _, _) in enumerate(PERIODS):
+    metrics['downloads'].setdefault(period, {})[comparison] = int(round(download_sums[i]))
+    metrics['revenue'].setdefault(period, {})[comparison] = float(revenue_sums[i])
+  return metrics
@@ -31,14 +31,14 @@ def decorated_apps_by_id(app_ids, load_config_children=False):
   filters = Q(id__in=app_ids)
   if load_config_children:
     filters |= Q(config_parent_id__in=app_ids)
-  apps = list(SDKApp.objects.filter(filters))
+  apps = list(SDKApp.objects.filter(filters).select_related('appstore_app'))
 
   counts_by_app = session_user_labels.label_counts_by_app_ids([a.id for a in apps])
   for app in apps:
     app.decorated_label_counts = counts_by_app[app.id]
 
-    if app.appstore_app_id:
-      appstore_app_info.decorate_app(app.appstore_app, app.appstore_app_country)
+  appstore_app_info.decorate_apps([(app.appstore_app, app.appstore_app_country)
+                                   for app in apps if app.appstore_app_id])
 
   if load_config_children:
     parent_apps = []
@@ -0,0 +1,246 @@
+#
+# Copyright 2016 Cluster Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+
+from backend.lk.logic import redis_wrap
+from backend.util import bitwise
+from backend.util import bulksql
+from backend import celery_app
+
+
+#
+# COALESCED SDKSESSION / SDKUSER COUNTERS
+#
+# Instead of one UPDATE per /track request against hot rows, deltas are
+# accumulated in a redis hash per row and flushed as a single multi-row
+# UPDATE ... FROM (VALUES ...) per table.
+#
+
+
+SESSION_COUNTERS_KEY_PREFIX = 'sessions;counters;sdksession='
+SDKUSER_COUNTERS_KEY_PREFIX = 'sessions;counters;sdkuser='
+DIRTY_SESSIONS_ZSET_KEY = 'sessions;counters;dirty-sdksessions'
+DIRTY_SDKUSERS_ZSET_KEY = 'sessions;counters;dirty-sdkusers'
+
+COUNTER_FIELDS = ('taps', 'screens', 'visits', 'seconds')
+MONTHLY_COUNTER_FIELDS = tuple('monthly_%s' % f for f in COUNTER_FIELDS)
+SECONDS_FIELDS = ('seconds', 'monthly_seconds')
+
+DAY_BIT_FIELD_PREFIX = 'day:'
+
+FLUSH_BATCH_SIZE = 500
+# Beat starts a flush every second; while counters keep coming in, keep
+# flushing in this interval until then.
+FLUSH_INTERVAL_SECONDS = 0.25
+FLUSH_RUN_SECONDS = 1.0
+
+
+TAKE_DIRTY_SCRIPT = """
+local ids = redis.call('zrange', KEYS[1], 0, ARGV[1] - 1)
+local result = {}
+for _, id in ipairs(ids) do
+  local key = ARGV[2] .. id
+  table.insert(result, id)
+  table.insert(result, redis.call('hgetall', key))
+  redis.call('del', key)
+  redis.call('zrem', KEYS[1], id)
+end
+return result
+"""
+
+
+def _increment(pipe, key_prefix, dirty_key, row_id, deltas):
+  key = '%s%s' % (key_prefix, row_id)
+  for field, delta in deltas.items():
+    if not delta:
+      continue
+    if field in SECONDS_FIELDS:
+      pipe.hincrbyfloat(key, field, delta)
+    else:
+      pipe.hincrby(key, field, delta)
+  pipe.hset(key, 'last_accessed_time', time.time())
+  pipe.zadd(dirty_key, time.time(), row_id)
+
+
+def increment_session(session_id, taps=0, screens=0, visits=0, seconds=0):
+  redis = redis_wrap.client()
+  with redis.pipeline() as pipe:
+    _increment(pipe, SESSION_COUNTERS_KEY_PREFIX, DIRTY_SESSIONS_ZSET_KEY, session_id,
+        dict(taps=taps, screens=screens, visits=visits, seconds=seconds))
+    pipe.execute()
+
+
+def increment_sdk_user(sdk_user_id, day_offsets, valid_days_bitmask,
+                       taps=0, screens=0, visits=0, seconds=0):
+  deltas = dict(taps=taps, screens=screens, visits=visits, seconds=seconds)
+  for field in COUNTER_FIELDS:
+    deltas['monthly_%s' % field] = deltas[field]
+
+  key = '%s%s' % (SDKUSER_COUNTERS_KEY_PREFIX, sdk_user_id)
+  redis = redis_wrap.client()
+  with redis.pipeline() as pipe:
+    _increment(pipe, SDKUSER_COUNTERS_KEY_PREFIX, DIRTY_SDKUSERS_ZSET_KEY, sdk_user_id, deltas)
+    # Bits can't be OR'ed into a hash field, so record each active day
+    # offset separately; the mask is as of the latest request. The day
+    # count is worked out from the merged bits when flushing.
+    for offset in day_offsets:
+      pipe.hset(key, '%s%d' % (DAY_BIT_FIELD_PREFIX, offset), 1)
+    pipe.hset(key, 'valid_days_bitmask', valid_days_bitmask)
+    pipe.execute()
+
+
+def _take_dirty(redis, dirty_key, key_prefix):
+  take = redis.register_script(TAKE_DIRTY_SCRIPT)
+  result = take(keys=[dirty_key], args=[FLUSH_BATCH_SIZE, key_prefix])
+
+  pending = {}
+  for raw_id, flat_hash in zip(result[::2], result[1::2]):
+    pending[long(raw_id)] = dict(zip(flat_hash[::2], flat_hash[1::2]))
+  return pending
+
+
+def _restore(redis, dirty_key, key_prefix, pending):
+  # Put deltas back so the next flush picks them up.
+  with redis.pipeline() as pipe:
+    for row_id, fields in pending.items():
+      key = '%s%s' % (key_prefix, row_id)
+      for field, value in fields.items():
+        if field in SECONDS_FIELDS:
+          pipe.hincrbyfloat(key, field, float(value))
+        elif field in COUNTER_FIELDS or field in MONTHLY_COUNTER_FIELDS:
+          pipe.hincrby(key, field, int(value))
+        else:
+          pipe.hsetnx(key, field, value)
+      pipe.zadd(dirty_key, time.time(), row_id)
+    pipe.execute()
+
+
+def _update_from_values(cursor, table, columns, assignments, rows):
+  # IMPORTANT: Lock rows in id order before updating, same as the increment
+  # log processing, so concurrent transactions can't deadlock on these rows.
+  rows = sorted(rows, key=lambda r: r[0])
+  cursor.execute("""
+    SELECT id FROM %s WHERE id IN %%s ORDER BY id FOR UPDATE
+  """ % table, [tuple(r[0] for r in rows)])
+
+  bulksql.update_from_values(cursor, table, columns, assignments, rows)
+
+
+def _session_row(session_id, fields):
+  return (
+    session_id,
+    int(fields.get('taps', 0)),
+    int(fields.get('screens', 0)),
+    int(fields.get('visits', 0)),
+    int(float(fields.get('seconds', 0))),
+    datetime.fromtimestamp(float(fields['last_accessed_time'])),
+  )
+
+
+def _sdk_user_row(sdk_user_id, fields):
+  days_active_bits = 0
+  for field in fields:
+    if field.startswith(DAY_BIT_FIELD_PREFIX):
+      days_active_bits |= 1 << int(field[len(DAY_BIT_FIELD_PREFIX):])
+
+  counters = [int(fields.get(f, 0)) for f in ('taps', 'screens', 'visits')]
+  counters.append(int(float(fields.get('seconds', 0))))
+  counters += [int(fields.get(f, 0)) for f in ('monthly_taps', 'monthly_screens', 'monthly_visits')]
+  counters.append(int(float(fields.get('monthly_seconds', 0))))
+
+  return tuple([sdk_user_id] + counters + [
+    bitwise.to_psql_int64(days_active_bits),
+    bitwise.to_psql_int64(long(fields['valid_days_bitmask'])),
+    datetime.fromtimestamp(float(fields['last_accessed_time'])),
+  ])
+
+
+SESSION_COLUMNS = ('id', 'taps', 'screens', 'visits', 'seconds', 'last_accessed_time')
+SESSION_ASSIGNMENTS = [
+  'taps = lk_sdksession.taps + v.taps',
+  'screens = lk_sdksession.screens + v.screens',
+  'visits = lk_sdksession.visits + v.visits',
+  'seconds = lk_sdksession.seconds + v.seconds',
+  'last_accessed_time = GREATEST(lk_sdksession.last_accessed_time, v.last_accessed_time)',
+]
+
+SDKUSER_COLUMNS = ('id',) + COUNTER_FIELDS + MONTHLY_COUNTER_FIELDS + (
+    'days_active_bits', 'valid_days_bitmask', 'last_accessed_time')
+# Every SET expression sees the row as it was, so the day count is taken
+# from the same merged bits that are stored, rather than from the caller.
+MERGED_DAYS_ACTIVE_MAP = '((lk_sdkuser.days_active_map | v.days_active_bits) & v.valid_days_bitmask)'
+SDKUSER_ASSIGNMENTS = ['%s = lk_sdkuser.%s + v.%s' % (f, f, f) for f in COUNTER_FIELDS + MONTHLY_COUNTER_FIELDS] + [
+  'days_active_map = %s' % MERGED_DAYS_ACTIVE_MAP,
+  # Counts the set bits.
+  "monthly_days_active = length(replace(%s::bit(64)::text, '0', ''))" % MERGED_DAYS_ACTIVE_MAP,
+  'last_accessed_time = GREATEST(lk_sdkuser.last_accessed_time, v.last_accessed_time)',
+]
+
+
+def _flush(redis, table, dirty_key, key_prefix, columns, assignments, row_fn):
+  pending = _take_dirty(redis, dirty_key, key_prefix)
+  if not pending:
+    return 0
+
+  try:
+    rows = [row_fn(row_id, fields) for row_id, fields in pending.items()]
+    with transaction.atomic():
+      _update_from_values(connection.cursor(), table, columns, assignments, rows)
+  except Exception:
+    logging.exception('Problem flushing %s counters, restoring...', table)
+    _restore(redis, dirty_key, key_prefix, pending)
+    return 0
+
+  return len(pending)
+
+
+def flush_counters():
+  redis = redis_wrap.client()
+  flushed_sessions = _flush(redis, 'lk_sdksession', DIRTY_SESSIONS_ZSET_KEY, SESSION_COUNTERS_KEY_PREFIX,
+      SESSION_COLUMNS, SESSION_ASSIGNMENTS, _session_row)
+  flushed_users = _flush(redis, 'lk_sdkuser', DIRTY_SDKUSERS_ZSET_KEY, SDKUSER_COUNTERS_KEY_PREFIX,
+      SDKUSER_COLUMNS, SDKUSER_ASSIGNMENTS, _sdk_user_row)
+  return flushed_sessions, flushed_users
+
+
+@celery_app.task(ignore_result=True, queue='sessions')
+def process_coalesced_counters():
+  if not settings.TRACK_COALESCE_COUNTERS:
+    return
+
+  start = time.time()
+  total_sessions = 0
+  total_users = 0
+  while time.time() - start < FLUSH_RUN_SECONDS:
+    flushed_sessions, flushed_users = flush_counters()
+    total_sessions += flushed_sessions
+    total_users += flushed_users
+
+    if not (flushed_sessions or flushed_users):
+      # Nothing is coming in; the next beat will check again.
+      break
+    if flushed_sessions < FLUSH_BATCH_SIZE and flushed_users < FLUSH_BATCH_SIZE:
+      time.sleep(FLUSH_INTERVAL_SECONDS)
+
+  if total_sessions or total_users:
+    logging.info('Flushed counters for %s sessions, %s sdk users...', total_sessions, total_users)
@@ -0,0 +1,156 @@
+#
+# Copyright 2016 Cluster Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+from datetime import datetime
+
+from django.db import DataError
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+
+from backend.lk.logic import redis_wrap
+from backend.util import bulksql
+from backend import celery_app
+
+
+#
+# RAW TAP & SCREEN STORAGE
+#
+# The tracking path appends rows in COPY text format to a redis list per
+# table, and process_buffered_events loads them in micro-batches with
+# COPY FROM STDIN, which is much cheaper than INSERTing row at a time.
+#
+# A batch is only trimmed off the buffer once its COPY has committed, so a
+# worker dying partway through loses nothing (but might load a batch
+# twice). One worker copies each table at a time. A batch that fails is
+# retried on later runs, unless its rows are bad or it has failed
+# MAX_COPY_ATTEMPTS times; then it is set aside in a capped failed list.
+#
+
+
+TAP_COLUMNS = ('visit_id', 'create_time', 'time', 'x', 'y', 'orient')
+SCREEN_COLUMNS = ('visit_id', 'create_time', 'start_time', 'end_time', 'name')
+
+BUFFER_KEY_FORMAT = 'sessions;event-buffer;table=%s'
+FAILED_BUFFER_KEY_FORMAT = 'sessions;event-buffer-failed;table=%s'
+COPYING_KEY_FORMAT = 'sessions;event-buffer-copying;table=%s'
+COPY_ATTEMPTS_KEY_FORMAT = 'sessions;event-buffer-attempts;table=%s'
+
+COPY_BATCH_SIZE = 5000
+PROCESS_RUN_SECONDS = 5
+COPYING_SECONDS = 60
+
+# Runs start every 5 seconds, so this is about 5 minutes of trying.
+MAX_COPY_ATTEMPTS = 60
+MAX_FAILED_LINES = 100000
+FAILED_LINES_SECONDS = 60 * 60 * 24 * 7
+
+
+def buffer_events(taps, screens):
+  """Queues SDKTap and SDKScreen objects for storage; their visits must
+  already have been saved.
+  """
+  now = datetime.now()
+  tap_lines = [bulksql.copy_line((t.visit.id, now, t.time, float(t.x), float(t.y), (t.orient or '?')[:1]))
+               for t in taps]
+  screen_lines = [bulksql.copy_line((s.visit.id, now, s.start_time, s.end_time, (s.name or '?')[:128]))
+                  for s in screens]
+  if not (tap_lines or screen_lines):
+    return
+
+  redis = redis_wrap.client()
+  with redis.pipeline() as pipe:
+    if tap_lines:
+      pipe.rpush(BUFFER_KEY_FORMAT % 'lk_sdktap', *tap_lines)
+    if screen_lines:
+      pipe.rpush(BUFFER_KEY_FORMAT % 'lk_sdkscreen', *screen_lines)
+    pipe.execute()
+
+
+def _set_aside_lines(redis, table, lines):
+  failed_key = FAILED_BUFFER_KEY_FORMAT % table
+  with redis.pipeline() as pipe:
+    pipe.rpush(failed_key, *lines)
+    pipe.ltrim(failed_key, -MAX_FAILED_LINES, -1)
+    pipe.expire(failed_key, FAILED_LINES_SECONDS)
+    pipe.ltrim(BUFFER_KEY_FORMAT % table, len(lines), -1)
+    pipe.delete(COPY_ATTEMPTS_KEY_FORMAT % table)
+    pipe.execute()
+
+
+def _copy_buffered_lines(redis, table, columns):
+  key = BUFFER_KEY_FORMAT % table
+  lines = redis.lrange(key, 0, COPY_BATCH_SIZE - 1)
+  if not lines:
+    return 0
+
+  try:
+    with transaction.atomic():
+      cursor = connection.cursor()
+      bulksql.copy_lines(cursor, table, columns, lines)
+
+  except (DataError, IntegrityError):
+    # Retrying won't fix these.
+    logging.exception('Bad rows in %s buffered rows for %s, setting them aside', len(lines), table)
+    _set_aside_lines(redis, table, lines)
+    return 0
+
+  except Exception:
+    attempts = redis.incr(COPY_ATTEMPTS_KEY_FORMAT % table)
+    if attempts >= MAX_COPY_ATTEMPTS:
+      logging.exception('Could not COPY %s buffered rows into %s, setting them aside', len(lines), table)
+      _set_aside_lines(redis, table, lines)
+    else:
+      logging.exception('Could not COPY %s buffered rows into %s, will retry', len(lines), table)
+    return 0
+
+  with redis.pipeline() as pipe:
+    pipe.ltrim(key, len(lines), -1)
+    pipe.delete(COPY_ATTEMPTS_KEY_FORMAT % table)
+    pipe.execute()
+  return len(lines)
+
+
+def copy_buffered_events(table, columns):
+  redis = redis_wrap.client()
+  copying_key = COPYING_KEY_FORMAT % table
+  if not redis.set(copying_key, 1, nx=True, ex=COPYING_SECONDS):
+    # Someone else is copying this table right now.
+    return 0
+
+  try:
+    return _copy_buffered_lines(redis, table, columns)
+  finally:
+    redis.delete(copying_key)
+
+
+@celery_app.task(ignore_result=True, queue='sessions')
+def process_buffered_events():
+  start = time.time()
+  taps = 0
+  screens = 0
+  while time.time() - start < PROCESS_RUN_SECONDS:
+    copied_taps = copy_buffered_events('lk_sdktap', TAP_COLUMNS)
+    copied_screens = copy_buffered_events('lk_sdkscreen', SCREEN_COLUMNS)
+    taps += copied_taps
+    screens += copied_screens
+    if copied_taps < COPY_BATCH_SIZE and copied_screens < COPY_BATCH_SIZE:
+      break
+
+  if taps or screens:
+    logging.info('Copied %s taps and %s screens...', taps, screens)
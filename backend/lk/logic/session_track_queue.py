@@ -0,0 +1,205 @@
+#
+# Copyright 2016 Cluster Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from django.db import transaction
+
+from backend.lk.logic import redis_wrap
+from backend.lk.logic import sessions
+from backend import celery_app
+
+
+#
+# WRITE-BEHIND TRACKING QUEUE
+#
+# Each session gets its own redis list of pending /track payloads, and
+# a zset holds the ids of sessions with anything pending. Consumers
+# lease a session by pushing its score into the future, so only one
+# consumer drains a given session at a time and payloads are applied in
+# the order they were received.
+#
+# Claims are counted per session until its payloads apply. After a failed
+# attempt, the session's payloads are applied one at a time, so a payload
+# that can never be applied ends up first in line by itself; once it has
+# failed MAX_ATTEMPTS times it is moved to a dead letter list.
+#
+
+
+QueuedTap = namedtuple('QueuedTap', ['time', 'x', 'y', 'orient'])
+QueuedScreen = namedtuple('QueuedScreen', ['start', 'end', 'name'])
+
+SESSION_QUEUE_KEY_FORMAT = 'sessions;track-queue;session-id=%s'
+PENDING_SESSIONS_ZSET_KEY = 'sessions;track-queue;pending'
+SESSION_ATTEMPTS_KEY = 'sessions;track-queue;attempts'
+DEAD_PAYLOADS_KEY = 'sessions;track-queue;dead'
+
+# If a consumer dies holding a session, another one picks it up after this.
+SESSION_LEASE_SECONDS = 60
+SESSIONS_PER_CLAIM = 25
+PAYLOADS_PER_SESSION = 100
+# Beat starts a consumer every second; each one drains for up to this long,
+# so this is roughly how many consumers are running at once.
+CONSUMER_RUN_SECONDS = 5
+# Failed attempts wait out the lease, so this is about ten minutes.
+MAX_ATTEMPTS = 10
+MAX_DEAD_PAYLOADS = 10000
+
+
+# Only mark the session pending if we just created its list; otherwise
+# it is either already pending or leased by a consumer.
+ENQUEUE_SCRIPT = """
+local length = redis.call('rpush', KEYS[1], ARGV[1])
+if length == 1 then
+  redis.call('zadd', KEYS[2], ARGV[2], ARGV[3])
+end
+return length
+"""
+
+# Returns session id, attempts pairs.
+CLAIM_SCRIPT = """
+local session_ids = redis.call('zrangebyscore', KEYS[1], 0, ARGV[1], 'LIMIT', 0, ARGV[2])
+local result = {}
+for _, session_id in ipairs(session_ids) do
+  redis.call('zadd', KEYS[1], ARGV[3], session_id)
+  table.insert(result, session_id)
+  table.insert(result, redis.call('hincrby', KEYS[2], session_id, 1))
+end
+return result
+"""
+
+# ARGV: payloads done, session id, now, attempts to keep counting from (0 to reset)
+ACK_SCRIPT = """
+redis.call('ltrim', KEYS[1], ARGV[1], -1)
+if redis.call('llen', KEYS[1]) == 0 then
+  redis.call('zrem', KEYS[2], ARGV[2])
+  redis.call('hdel', KEYS[3], ARGV[2])
+else
+  redis.call('zadd', KEYS[2], ARGV[3], ARGV[2])
+  if ARGV[4] == '0' then
+    redis.call('hdel', KEYS[3], ARGV[2])
+  else
+    redis.call('hset', KEYS[3], ARGV[2], ARGV[4])
+  end
+end
+"""
+
+# Moves the first payload in a session's list to the dead letter list.
+DEAD_LETTER_SCRIPT = """
+local payload = redis.call('lpop', KEYS[1])
+if payload then
+  redis.call('rpush', KEYS[2], cjson.encode({session_id = ARGV[1], payload = payload}))
+  redis.call('ltrim', KEYS[2], -tonumber(ARGV[2]), -1)
+end
+return payload
+"""
+
+
+def _timestamp(dt):
+  return time.mktime(dt.timetuple()) + (dt.microsecond / 1000000.0)
+
+
+def enqueue_track(session, remote_addr, attributes, raw_taps, raw_screens):
+  # Reflect the new attributes on this instance so the caller can compute
+  # config as if they had been written already.
+  for k, v in sessions.session_attributes(**attributes):
+    setattr(session, k, v)
+
+  payload = json.dumps({
+    'remote_addr': remote_addr,
+    'attributes': attributes,
+    'taps': [(_timestamp(t.time), t.x, t.y, t.orient) for t in raw_taps],
+    'screens': [(_timestamp(s.start), _timestamp(s.end), s.name) for s in raw_screens],
+  })
+
+  redis = redis_wrap.client()
+  enqueue = redis.register_script(ENQUEUE_SCRIPT)
+  enqueue(keys=[SESSION_QUEUE_KEY_FORMAT % session.id, PENDING_SESSIONS_ZSET_KEY],
+      args=[payload, time.time(), session.id])
+
+
+def _apply_payloads(session, payloads):
+  taps = []
+  screens = []
+  for payload in payloads:
+    sessions.update_attributes(session, payload['remote_addr'], **payload['attributes'])
+
+    taps += [QueuedTap(datetime.fromtimestamp(t), x, y, orient)
+             for t, x, y, orient in payload['taps']]
+    screens += [QueuedScreen(datetime.fromtimestamp(start), datetime.fromtimestamp(end), name)
+                for start, end, name in payload['screens']]
+
+  # One track() per batch, so counters and visits get written once no matter
+  # how many requests this session made while it was waiting.
+  sessions.track(session, 'track', raw_taps=taps, raw_screens=screens)
+
+
+def _process_session_queue(redis, session_id, attempts):
+  queue_key = SESSION_QUEUE_KEY_FORMAT % session_id
+  # Something in here failed before; find out which payload it was.
+  one_at_a_time = attempts > 1
+
+  if attempts > MAX_ATTEMPTS:
+    dead_letter = redis.register_script(DEAD_LETTER_SCRIPT)
+    dead_letter(keys=[queue_key, DEAD_PAYLOADS_KEY], args=[session_id, MAX_DEAD_PAYLOADS])
+    logging.error('Giving up on a queued track payload for session: %s', session_id)
+
+  raw_payloads = redis.lrange(queue_key, 0, (one_at_a_time and 1 or PAYLOADS_PER_SESSION) - 1)
+
+  if raw_payloads:
+    payloads = [json.loads(p) for p in raw_payloads]
+    with transaction.atomic():
+      session = sessions.get_session_for_update(session_id)
+      if session:
+        _apply_payloads(session, payloads)
+      else:
+        logging.warn('Dropping %s queued payloads for missing session: %s', len(payloads), session_id)
+
+  # After a failure, the session stays one at a time until its list is empty.
+  ack = redis.register_script(ACK_SCRIPT)
+  ack(keys=[queue_key, PENDING_SESSIONS_ZSET_KEY, SESSION_ATTEMPTS_KEY],
+      args=[len(raw_payloads), session_id, time.time(), one_at_a_time and 1 or 0])
+
+  return len(raw_payloads)
+
+
+@celery_app.task(ignore_result=True, queue='sessions')
+def process_queued_tracking():
+  redis = redis_wrap.client()
+  claim = redis.register_script(CLAIM_SCRIPT)
+
+  start = time.time()
+  processed = 0
+  while time.time() - start < CONSUMER_RUN_SECONDS:
+    now = time.time()
+    claimed = claim(keys=[PENDING_SESSIONS_ZSET_KEY, SESSION_ATTEMPTS_KEY],
+        args=[now, SESSIONS_PER_CLAIM, now + SESSION_LEASE_SECONDS])
+    if not claimed:
+      break
+
+    for session_id, attempts in zip(claimed[::2], claimed[1::2]):
+      try:
+        processed += _process_session_queue(redis, long(session_id), attempts)
+      except Exception:
+        # The lease expires and another consumer retries this session later.
+        logging.exception('Problem applying queued tracking for session: %s', session_id)
+
+  if processed:
+    logging.info('Applied %s queued track payloads...', processed)
@@ -20,11 +20,15 @@ import time
 from datetime import datetime
 from datetime import timedelta
 
+import numpy as np
+from django.db import connection
 from django.db import transaction
-from redis import WatchError
 
 from backend.lk.logic import redis_wrap
+from backend.lk.logic import sharded_sweeps
+from backend.lk.logic import work_queues
 from backend.lk.models import ActiveStatus
+from backend.lk.models import ALL_USER_LABELS
 from backend.lk.models import CumulativeTimeUsed
 from backend.lk.models import SessionFrequency
 from backend.lk.models import DEFAULT_SUPER_CONFIG_FREQ
@@ -37,6 +41,7 @@ from backend.lk.models import SDKApp
 from backend.lk.models import SDKAppStat
 from backend.lk.models import SDKUser
 from backend.lk.models import SDKUserLabelChangeEvent
+from backend.util import bulksql
 from backend import celery_app
 
 
@@ -152,6 +157,26 @@ def labels_for_user(user, future_days_offset=0):
 CURRENT_COUNT_REDIS_KEY_FORMAT = 'sessions;label-counts;app-id=%s'
 
 
+def _combined_label_increments(old_labels, new_labels):
+  increment_label_by = {}
+  for l1, l2 in TRACK_LABEL_COMBINATIONS:
+    had_label = l1 in old_labels and l2 in old_labels
+    has_label = l1 in new_labels and l2 in new_labels
+
+    if had_label != has_label:
+      if had_label:
+        # removed label
+        increment = -1
+      else:
+        # added label
+        increment = 1
+
+      combined_label = '%s-%s' % (l1, l2)
+      increment_label_by[combined_label] = increment
+
+  return increment_label_by
+
+
 @transaction.atomic
 def update_labels_for_user(sdk_user, future_days_offset=0):
   old_labels = set(sdk_user.labels or [])
@@ -187,20 +212,7 @@ def update_labels_for_user(sdk_user, future_days_offset=0):
 
   # Now track the changes we've made in our counts.
 
-  for l1, l2 in TRACK_LABEL_COMBINATIONS:
-    had_label = l1 in old_labels and l2 in old_labels
-    has_label = l1 in new_labels and l2 in new_labels
-
-    if had_label != has_label:
-      if had_label:
-        # removed label
-        increment = -1
-      else:
-        # added label
-        increment = 1
-
-      combined_label = '%s-%s' % (l1, l2)
-      increment_label_by[combined_label] = increment
+  increment_label_by.update(_combined_label_increments(old_labels, new_labels))
 
   redis = redis_wrap.client()
   redis_key = CURRENT_COUNT_REDIS_KEY_FORMAT % sdk_user.app_id
@@ -237,47 +249,25 @@ def label_counts_for_app_id(app_id):
 
 
 DIRTY_SDK_USER_LABELS_REDIS_KEY = 'sessions;dirty-sdk-users'
+DIRTY_SDK_USER_LABELS_BATCH_SIZE = 50
+
+DIRTY_SDK_USER_LABELS_QUEUE = work_queues.WorkQueue('dirty-sdk-user-labels',
+    pending_key=DIRTY_SDK_USER_LABELS_REDIS_KEY,
+    lease_seconds=60 * 5)
 
 def mark_sdk_user_labels_dirty(sdk_user_ids):
   if not sdk_user_ids:
     return
 
   t = time.time()
-  rescored_user_ids = []
-
-  user_ids_uniq = set(sdk_user_ids)
-  for user_id in user_ids_uniq:
-    rescored_user_ids.append(t)
-    rescored_user_ids.append(user_id)
-
-  redis = redis_wrap.client()
-  redis.zadd(DIRTY_SDK_USER_LABELS_REDIS_KEY, *rescored_user_ids)
+  DIRTY_SDK_USER_LABELS_QUEUE.schedule(dict((user_id, t) for user_id in set(sdk_user_ids)))
 
 
 @celery_app.task(ignore_result=True, queue='sessions')
 def process_dirty_sdk_user_labels():
-  now_timestamp = time.time()
-
-  sdk_user_ids_needing_attention = []
-
-  # Atomically find next app ids to check.
-  redis = redis_wrap.client()
-  while True:
-    with redis.pipeline() as pipe:
-      try:
-        pipe.watch(DIRTY_SDK_USER_LABELS_REDIS_KEY)
-        sdk_user_ids_needing_attention = pipe.zrangebyscore(DIRTY_SDK_USER_LABELS_REDIS_KEY,
-            0, now_timestamp,
-            start=0, num=50)
-
-        if sdk_user_ids_needing_attention:
-          pipe.multi()
-          pipe.zrem(DIRTY_SDK_USER_LABELS_REDIS_KEY, *sdk_user_ids_needing_attention)
-          pipe.execute()
-
-        break
-      except WatchError:
-        logging.info('Interrupted while fetching app ids to ingest...')
+  sdk_user_ids_needing_attention = DIRTY_SDK_USER_LABELS_QUEUE.claim(DIRTY_SDK_USER_LABELS_BATCH_SIZE)
+  if not sdk_user_ids_needing_attention:
+    return
 
   updates = 0
   with transaction.atomic():
@@ -292,65 +282,323 @@ def process_dirty_sdk_user_labels():
       if update_labels_for_user(sdk_user):
         updates += 1
 
+  # If this failed, the leases run out and these are retried.
+  DIRTY_SDK_USER_LABELS_QUEUE.ack(sdk_user_ids_needing_attention)
+
   if updates:
     logging.info('Updated %s sdk user rows labels...', updates)
 
 
-@celery_app.task(ignore_result=True, queue='sessions')
-def process_weekly_inactive_sessions(future_days_offset=0):
-  updates = 0
-
-  with transaction.atomic():
-    week_ago_days = 7 - future_days_offset
-    one_week_ago = datetime.now() - timedelta(days=week_ago_days, hours=1)
-    old_users = list(
-      SDKUser.objects
-        .select_for_update()
-        .filter(last_accessed_time__lt=one_week_ago)
-        .extra(where=['labels @> ARRAY[%s]'], params=[ActiveStatus.WeeklyActive])
-        .order_by('id')[:250]
-    )
+def update_weekly_inactive_labels(after_id, last_id, future_days_offset=0):
+  week_ago_days = 7 - future_days_offset
+  one_week_ago = datetime.now() - timedelta(days=week_ago_days, hours=1)
+  old_users = list(
+    SDKUser.objects
+      .select_for_update()
+      .filter(id__gt=after_id, id__lte=last_id, last_accessed_time__lt=one_week_ago)
+      .extra(where=['labels @> ARRAY[%s]'], params=[ActiveStatus.WeeklyActive])
+      .order_by('id')
+  )
 
-    for user in old_users:
-      if update_labels_for_user(user, future_days_offset=future_days_offset):
-        updates += 1
+  updates = 0
+  for user in old_users:
+    if update_labels_for_user(user, future_days_offset=future_days_offset):
+      updates += 1
 
   if updates:
     logging.info('Updated %s weekly inactive sdk user rows labels...', updates)
 
+  return updates
+
+
+WEEKLY_INACTIVE_SWEEP = sharded_sweeps.Sweep('sdkuser-weekly-inactive', 'lk_sdkuser',
+    update_weekly_inactive_labels, initial_batch_size=250)
 
 
-PROCESS_SDKUSERS_LABELS_LIMIT = 250
-LAST_SDKUSER_LABELS_PROCESSED_KEY = 'sessions:labels:max-sdkuser-id'
+#
+# BATCH LABELS
+#
+# Same rules as labels_for_user(), computed for thousands of users at once:
+# each user's labels are a bitmask, and the thresholds are evaluated over
+# whole columns with numpy.
+#
+
+
+BATCH_LABELS = tuple(ALL_USER_LABELS) + ('almost',)
+LABEL_BITS = dict((label, 1 << i) for i, label in enumerate(BATCH_LABELS))
+# Never set on any user; stands in for labels we don't compute here.
+UNKNOWN_LABEL_BIT = 1 << 62
+
+
+def _labels_bitmask(labels):
+  bits = 0
+  for label in labels:
+    bits |= LABEL_BITS.get(label, UNKNOWN_LABEL_BIT)
+  return bits
+
+
+def _bitmask_labels(bits):
+  return set(label for label in BATCH_LABELS if bits & LABEL_BITS[label])
+
+
+def _weekly_days_active(days_active_maps, today_offsets):
+  # Counts the bits for today and the 6 days before it, like
+  # SDKUser.weekly_days_active() does for a single user.
+  maps = days_active_maps.view(np.uint64)
+  weekly = np.zeros(len(maps), dtype=np.int64)
+  for days_ago in range(7):
+    shifts = ((today_offsets - days_ago) % 64).astype(np.uint64)
+    weekly += ((maps >> shifts) & np.uint64(1)).astype(np.int64)
+  return weekly
+
+
+def labels_bitmasks_for_users(today_offsets, days_active_maps, monthly_days_active, monthly_visits,
+                              monthly_seconds, was_super_or_fringe, super_required, almost_required):
+  weekly = _weekly_days_active(days_active_maps, today_offsets)
+  monthly = monthly_days_active
+  bits = np.zeros(len(monthly), dtype=np.int64)
+
+  def add(label, condition):
+    bits[condition] |= LABEL_BITS[label]
+
+  add(ActiveStatus.MonthlyActive, monthly > 0)
+  add(ActiveStatus.MonthlyInactive, monthly <= 0)
+  add(ActiveStatus.WeeklyActive, weekly >= 1)
+  add(ActiveStatus.WeeklyInactive, weekly < 1)
+
+  once_a_day = (weekly == 7) | (monthly >= 28)
+  add(SessionFrequency.MoreThanOnceADay, once_a_day & (monthly_visits > (29 * 3)))
+  add(SessionFrequency.OnceADay, once_a_day)
+  add(SessionFrequency.FiveDaysAWeek, (weekly >= 5) | (monthly >= 20))
+  add(SessionFrequency.ThreeDaysAWeek, (weekly >= 3) | (monthly >= 12))
+  add(SessionFrequency.OnceAWeek, (weekly >= 1) | (monthly >= 4))
+  add(SessionFrequency.TwiceAMonth, monthly >= 2)
+
+  seconds_per_day = monthly_seconds.astype(np.float64) / np.maximum(monthly, 1)
+  add(CumulativeTimeUsed.HourPerDay, seconds_per_day > (60 * 60))
+  add(CumulativeTimeUsed.FifteenMinutesPerDay, seconds_per_day > (60 * 15))
+  add(CumulativeTimeUsed.FiveMinutesPerDay, seconds_per_day > (60 * 5))
+  add(CumulativeTimeUsed.OneMinutePerDay, seconds_per_day > 60)
+  add(CumulativeTimeUsed.ThirtySecondsPerDay, seconds_per_day > 30)
+
+  is_super = (bits & super_required) == super_required
+  is_almost = ~is_super & ((bits & almost_required) == almost_required)
+  add('super', is_super)
+  add('almost', is_almost)
+  add('fringe', is_almost & was_super_or_fringe)
+
+  return bits
+
+
+def update_labels_for_users(after_id, last_id, future_days_offset=0):
+  """Relabels sdk users with after_id < id <= last_id, and returns the number
+  of users whose labels changed.
+  """
+  today = datetime.now().date() + timedelta(days=future_days_offset)
+
+  cursor = connection.cursor()
+  cursor.execute("""
+    SELECT id, app_id, user_id, labels,
+        days_active_map, monthly_days_active, monthly_visits, monthly_seconds,
+        ((%s::date - create_time::date) %% 64 + 64) %% 64
+    FROM lk_sdkuser
+    WHERE id > %s AND id <= %s
+    ORDER BY id
+    FOR UPDATE
+  """, [today, after_id, last_id])
+  rows = cursor.fetchall()
+  if not rows:
+    return 0
+
+  ids, app_ids, user_ids, old_labels = zip(*[row[:4] for row in rows])
+  columns = np.array([row[4:] for row in rows], dtype=np.int64)
+
+  apps_by_id = SDKApp.objects.in_bulk(list(set(app_ids)))
+  super_bits_by_app_id = dict((app_id, _labels_bitmask(super_labels_for_app(app)))
+                              for app_id, app in apps_by_id.items())
+  almost_bits_by_app_id = dict((app_id, _labels_bitmask(almost_labels_for_app(app)))
+                               for app_id, app in apps_by_id.items())
+
+  old_labels = [set(labels or []) for labels in old_labels]
+  new_bits = labels_bitmasks_for_users(
+      columns[:, 4],
+      columns[:, 0],
+      columns[:, 1],
+      columns[:, 2],
+      columns[:, 3],
+      np.array([bool(labels & set(['super', 'fringe'])) for labels in old_labels]),
+      np.array([super_bits_by_app_id[app_id] for app_id in app_ids], dtype=np.int64),
+      np.array([almost_bits_by_app_id[app_id] for app_id in app_ids], dtype=np.int64))
+  old_bits = np.array([_labels_bitmask(labels) for labels in old_labels], dtype=np.int64)
+
+  changed_indexes = np.nonzero(new_bits != old_bits)[0]
+  if not len(changed_indexes):
+    return 0
+
+  change_events = []
+  updated_labels = []
+  increments_by_app_id = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
+  for i in changed_indexes:
+    sdk_user_id, app_id, user_id = ids[i], app_ids[i], user_ids[i]
+    old_user_labels = old_labels[i]
+    new_user_labels = _bitmask_labels(new_bits[i])
+    increments = increments_by_app_id[app_id]
+
+    for label in old_user_labels - new_user_labels:
+      change_events.append(SDKUserLabelChangeEvent(app_id=app_id, sdk_user_id=sdk_user_id, user_id=user_id,
+                                                   label=label, kind='removed'))
+      increments[label] -= 1
+    for label in new_user_labels - old_user_labels:
+      change_events.append(SDKUserLabelChangeEvent(app_id=app_id, sdk_user_id=sdk_user_id, user_id=user_id,
+                                                   label=label, kind='added'))
+      increments[label] += 1
+    for label, increment in _combined_label_increments(old_user_labels, new_user_labels).items():
+      increments[label] += increment
+
+    updated_labels.append((sdk_user_id, list(sorted(new_user_labels))))
+
+  SDKUserLabelChangeEvent.objects.bulk_create(change_events)
+  bulksql.update_from_values(cursor, 'lk_sdkuser', ('id', 'labels'),
+      ['labels = v.labels::text[]'], updated_labels)
+
+  redis = redis_wrap.client()
+  with redis.pipeline() as pipe:
+    for app_id, increments in increments_by_app_id.items():
+      redis_key = CURRENT_COUNT_REDIS_KEY_FORMAT % app_id
+      for label, increment in increments.items():
+        if increment:
+          pipe.hincrby(redis_key, label, increment)
+    pipe.execute()
+
+  return len(updated_labels)
+
+
+LABELS_SWEEP = sharded_sweeps.Sweep('sdkuser-labels', 'lk_sdkuser', update_labels_for_users,
+    initial_batch_size=5000)
+
+
+#
+# LABEL COUNT RECONCILIATION
+#
+# The counts in CURRENT_COUNT_REDIS_KEY_FORMAT are only ever incremented, so
+# any missed or failed increment sticks around. Periodically recount them
+# from lk_sdkuser and correct the drift in place.
+#
+# Label updates increment redis before their transaction commits, so a
+# recount can disagree with redis just because of updates in flight. Those
+# differences go away on their own; real drift doesn't. So a difference is
+# only corrected once the same one has been seen on two runs in a row.
+#
+
+
+RECONCILE_APPS_SHARD_SIZE = 50
+
+COUNT_DIFFERENCES_REDIS_KEY_FORMAT = 'sessions;label-count-differences;app-id=%s'
+# A bit more than a day, so differences are only compared with the last run.
+COUNT_DIFFERENCES_EXPIRE_SECONDS = 60 * 60 * 36
+
+APPLY_COUNT_CORRECTIONS_SCRIPT = """
+for i = 1, #ARGV, 2 do
+  local count = redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+  if count == 0 then
+    redis.call('hdel', KEYS[1], ARGV[i])
+  end
+end
+"""
+
+
+def _label_counts_for_label_sets(counts_by_label_set):
+  counts = collections.defaultdict(lambda: 0)
+  for labels, count in counts_by_label_set:
+    labels = set(labels or [])
+    for label in labels:
+      counts[label] += count
+    for combined_label in _combined_label_increments(set(), labels):
+      counts[combined_label] += count
+  return counts
+
 
 @celery_app.task(ignore_result=True, queue='sessions')
-def process_sdkuser_labels_periodically():
+def reconcile_label_counts_for_app_ids(app_ids):
+  """Recounts labels for app_ids with one grouped scan and corrects the
+  redis counts that were off by the same amount on the last run too.
+  Returns the number of label counts that were corrected.
+  """
   redis = redis_wrap.client()
-  max_id = redis.get(LAST_SDKUSER_LABELS_PROCESSED_KEY) or 0
+  # Labels are stored sorted, so this groups each distinct label set.
+  cursor = connection.cursor()
+  cursor.execute("""
+    SELECT app_id, labels, COUNT(*)
+    FROM lk_sdkuser
+    WHERE app_id IN %s
+    GROUP BY app_id, labels
+  """, [tuple(app_ids)])
+  label_sets_by_app_id = collections.defaultdict(list)
+  for app_id, labels, count in cursor.fetchall():
+    label_sets_by_app_id[app_id].append((labels, count))
+
+  # Corrections are applied as increments rather than by replacing the
+  # hash, so updates that land in redis after this read are kept.
+  current_counts_by_app_id = label_counts_by_app_ids(app_ids)
 
-  with transaction.atomic():
-    sdk_users = list(
-      SDKUser.objects
-        .select_for_update()
-        .filter(id__gt=max_id)
-        .order_by('id')[:PROCESS_SDKUSERS_LABELS_LIMIT]
-    )
+  with redis.pipeline() as pipe:
+    for app_id in app_ids:
+      pipe.hgetall(COUNT_DIFFERENCES_REDIS_KEY_FORMAT % app_id)
+    last_differences_by_app_id = dict(zip(app_ids, pipe.execute()))
+
+  apply_corrections = redis.register_script(APPLY_COUNT_CORRECTIONS_SCRIPT)
+  corrected = 0
+  for app_id in app_ids:
+    counts = _label_counts_for_label_sets(label_sets_by_app_id[app_id])
+    current_counts = current_counts_by_app_id[app_id]
+    last_differences = last_differences_by_app_id[app_id]
+
+    corrections = []
+    differences = {}
+    for label in set(counts) | set(current_counts):
+      difference = counts.get(label, 0) - current_counts.get(label, 0)
+      if not difference:
+        continue
+      if int(last_differences.get(label, 0)) == difference:
+        corrections += [label, difference]
+      else:
+        differences[label] = difference
+
+    differences_key = COUNT_DIFFERENCES_REDIS_KEY_FORMAT % app_id
+    with redis.pipeline() as pipe:
+      pipe.delete(differences_key)
+      if differences:
+        pipe.hmset(differences_key, differences)
+        pipe.expire(differences_key, COUNT_DIFFERENCES_EXPIRE_SECONDS)
+      pipe.execute()
+
+    if not corrections:
+      continue
+
+    logging.info('Correcting %s label counts for app id: %s', len(corrections) / 2, app_id)
+    apply_corrections(keys=[CURRENT_COUNT_REDIS_KEY_FORMAT % app_id], args=corrections)
+    corrected += len(corrections) / 2
 
-    if sdk_users:
-      new_max_id = sdk_users[-1].id
-      updates = 0
-      for sdk_user in sdk_users:
-        if update_labels_for_user(sdk_user):
-          updates += 1
+  return corrected
 
-      if updates:
-        logging.info('Updated %s sdk user labels periodically', updates)
 
-    else:
-      logging.info('No more users to update labels, starting over')
-      new_max_id = 0
+@celery_app.task(ignore_result=True, queue='sessions')
+def reconcile_label_counts():
+  # One task per shard, so a big lk_sdkuser can't run this past the task
+  # time limit and leave the rest of the apps unreconciled.
+  last_id = 0
+  shards = 0
+  while True:
+    app_ids = list(SDKApp.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)
+                   [:RECONCILE_APPS_SHARD_SIZE])
+    if not app_ids:
+      break
+
+    last_id = app_ids[-1]
+    reconcile_label_counts_for_app_ids.delay(app_ids)
+    shards += 1
 
-  redis.set(LAST_SDKUSER_LABELS_PROCESSED_KEY, new_max_id)
+  logging.info('Queued label count reconciliation for %s shard(s) of apps', shards)
 
 
 #
@@ -14,6 +14,7 @@
 # limitations under the License.
 #
 
+import bisect
 import collections
 import logging
 import time
@@ -34,21 +35,31 @@ from backend.lk.models import SDKTap
 from backend.lk.models import SDKUser
 from backend.lk.models import SDKUserIncrementLog
 from backend.lk.models import SDKVisit
-from backend.lk.logic import redis_wrap
 from backend.lk.logic import sdk_apps
+from backend.lk.logic import session_counters
+from backend.lk.logic import session_events
 from backend.lk.logic import session_user_labels
+from backend.lk.logic import sharded_sweeps
 from backend.util import bitwise
+from backend.util import bulksql
 from backend.util import text
 from backend import celery_app
 
 
 
-def get_session_by_encrypted_id(user, encrypted_id):
+def get_session_by_encrypted_id(user, encrypted_id, for_update=True):
   decrypted_id = SDKSession.decrypt_id(encrypted_id)
   if not decrypted_id:
     return None
 
-  session = SDKSession.objects.select_for_update().filter(id=decrypted_id).first()
+  if not for_update:
+    return SDKSession.objects.filter(id=decrypted_id).first()
+
+  return get_session_for_update(decrypted_id)
+
+
+def get_session_for_update(session_id):
+  session = SDKSession.objects.select_for_update().filter(id=session_id).first()
   if session and session.sdk_user_id:
     # Make sure this is fetched for update, since we will almost definitely modify it.
     session.sdk_user = SDKUser.objects.select_for_update().get(pk=session.sdk_user_id)
@@ -68,13 +79,11 @@ def create_session(user, bundle_id):
   return session
 
 
-def update_attributes(session, remote_addr,
-    version=None, build=None, debug=False,
+def session_attributes(version=None, build=None, debug=False,
     screen_width=None, screen_height=None, screen_scale=None,
     os=None, os_version=None, hardware=None,
     sdk_platform=None, sdk_version=None):
-
-  attrs = (
+  return (
     ('app_version', version),
     ('app_build', build),
     ('app_build_debug', debug),
@@ -88,6 +97,10 @@ def update_attributes(session, remote_addr,
     ('sdk_version', sdk_version),
   )
 
+
+def update_attributes(session, remote_addr, **kwargs):
+  attrs = session_attributes(**kwargs)
+
   modified = {}
   for k, v in attrs:
     existing_v = getattr(session, k, None)
@@ -240,6 +253,25 @@ COPY_SESSION_ATTRS_TO_VISIT = (
     'screen_width', 'screen_scale',
 )
 
+def _visit_near_range(visit, start, end):
+  return visit.start_time <= end + VISIT_BOUNDARY and visit.end_time >= start - VISIT_BOUNDARY
+
+
+def _visit_containing(visits, visit_starts, start, end):
+  # visits are sorted by start time and visit_starts are their start times.
+  i = bisect.bisect_right(visit_starts, start)
+  while i > 0:
+    i -= 1
+    visit = visits[i]
+    if visit.end_time >= end:
+      return visit
+  return None
+
+
+def _latest_visit_cache_key(session):
+  return 'sdkvisit-by-session:%d' % session.id
+
+
 def _visits_for_ranges(session, raw_ranges):
   if not raw_ranges:
     return (), ()
@@ -257,33 +289,41 @@ def _visits_for_ranges(session, raw_ranges):
       # end time
       current_range[1] = max(end, current_range[1])
 
-  latest_visit_by_session_key = 'sdkvisit-by-session:%d' % session.id
-  latest_visit_cached = cache.get(latest_visit_by_session_key)
-  new_latest_visit = None
+  latest_visit_cached = cache.get(_latest_visit_cache_key(session))
 
-  new_visits = []
-  existing_visits = []
-  for i, (start, end) in enumerate(reduced_ranges):
-    end_boundary = end + VISIT_BOUNDARY
-    start_boundary = start - VISIT_BOUNDARY
+  if latest_visit_cached and all(_visit_near_range(latest_visit_cached, start, end)
+                                 for start, end in reduced_ranges):
+    candidate_visits = [latest_visit_cached]
+  else:
+    # Fetch every visit that could match any of these ranges at once,
+    # rather than querying for each range.
+    window_start = reduced_ranges[0][0] - VISIT_BOUNDARY
+    window_end = max(end for _, end in reduced_ranges) + VISIT_BOUNDARY
+    # http://stackoverflow.com/questions/325933 -- excellent.
+    candidate_visits = list(
+        SDKVisit.objects
+          .filter(session_id=session.id, start_time__lte=window_end, end_time__gte=window_start)
+          .order_by('start_time', 'id'))
 
-    if (latest_visit_cached and
-        latest_visit_cached.start_time <= end_boundary and
-        latest_visit_cached.end_time >= start_boundary):
-      visit = latest_visit_cached
-      latest_visit_cached = None
+  candidate_starts = [v.start_time for v in candidate_visits]
 
-    else:
-      # http://stackoverflow.com/questions/325933 -- excellent.
-      visit = SDKVisit.objects.filter(session_id=session.id,
-          start_time__lte=end_boundary,
-          end_time__gte=start_boundary).first()
+  new_visits = []
+  existing_visits_by_id = collections.OrderedDict()
+  for start, end in reduced_ranges:
+    visit = None
+    # Candidates are sorted by start time, so only the ones that start before
+    # this range's end boundary can match; check from the latest backwards.
+    i = bisect.bisect_right(candidate_starts, end + VISIT_BOUNDARY)
+    while i > 0:
+      i -= 1
+      if _visit_near_range(candidate_visits[i], start, end):
+        visit = candidate_visits[i]
+        break
 
     if visit:
       visit.start_time = min(start, visit.start_time)
       visit.end_time = max(end, visit.end_time)
-      visit.save(update_fields=['start_time', 'end_time'])
-      existing_visits.append(visit)
+      existing_visits_by_id[visit.id] = visit
 
     else:
       visit = SDKVisit(user_id=session.user_id, session=session,
@@ -293,15 +333,41 @@ def _visits_for_ranges(session, raw_ranges):
         setattr(visit, k, getattr(session, k))
       new_visits.append(visit)
 
-    new_latest_visit = visit
+  return new_visits, existing_visits_by_id.values()
+
 
-  for v in new_visits:
-    v.save()
+VISIT_INSERT_FIELDS = [f for f in SDKVisit._meta.concrete_fields if not f.primary_key]
+VISIT_UPDATE_COLUMNS = ('id', 'start_time', 'end_time', 'screens', 'taps')
+VISIT_UPDATE_ASSIGNMENTS = [
+  'start_time = LEAST(lk_sdkvisit.start_time, v.start_time)',
+  'end_time = GREATEST(lk_sdkvisit.end_time, v.end_time)',
+  'screens = lk_sdkvisit.screens + v.screens',
+  'taps = lk_sdkvisit.taps + v.taps',
+]
 
-  if new_latest_visit:
-    cache.set(latest_visit_by_session_key, new_latest_visit, 60 * 30)
+def _save_visits(new_visits, existing_visits, existing_counts):
+  cursor = connection.cursor()
 
-  return new_visits, existing_visits
+  if new_visits:
+    # Not bulk_create() because it doesn't give us back ids in this version
+    # of Django, and taps/screens need them.
+    rows = [[f.get_db_prep_save(getattr(v, f.attname), connection) for f in VISIT_INSERT_FIELDS]
+            for v in new_visits]
+    new_ids = bulksql.insert_returning_ids(cursor, SDKVisit._meta.db_table,
+        [f.column for f in VISIT_INSERT_FIELDS], rows)
+    for visit, visit_id in zip(new_visits, new_ids):
+      visit.id = visit_id
+
+  if existing_visits:
+    # Increment rather than overwrite counts, since existing visits might
+    # have come from the cache with stale counts.
+    rows = []
+    for visit in sorted(existing_visits, key=lambda v: v.id):
+      screens_before, taps_before = existing_counts[visit.id]
+      rows.append((visit.id, visit.start_time, visit.end_time,
+                   visit.screens - screens_before, visit.taps - taps_before))
+    bulksql.update_from_values(cursor, SDKVisit._meta.db_table,
+        VISIT_UPDATE_COLUMNS, VISIT_UPDATE_ASSIGNMENTS, rows)
 
 
 def track_event(session, event_name, remote_addr, **track_data):
@@ -322,29 +388,27 @@ def track(session, event_name, raw_taps=None, raw_screens=None):
   new_visits, existing_visits = _visits_for_ranges(session,
       [(s.start_time, s.end_time) for s in screens] + [(t.time, t.time) for t in taps])
   session_visits = sorted(new_visits + existing_visits, key=lambda v: v.start_time)
+  existing_counts = dict((v.id, (v.screens, v.taps)) for v in existing_visits)
 
-  for screen in screens:
-    matching_visit = None
-    for visit in session_visits:
-      if visit.start_time <= screen.start_time and visit.end_time >= screen.end_time:
-        matching_visit = visit
-        break
+  session_visit_starts = [v.start_time for v in session_visits]
 
+  for screen in screens:
+    matching_visit = _visit_containing(session_visits, session_visit_starts,
+        screen.start_time, screen.end_time)
     screen.visit = matching_visit
     matching_visit.screens += 1
 
   for tap in taps:
-    matching_visit = None
-    for visit in session_visits:
-      if visit.start_time <= tap.time and visit.end_time >= tap.time:
-        matching_visit = visit
-        break
-
+    matching_visit = _visit_containing(session_visits, session_visit_starts, tap.time, tap.time)
     tap.visit = matching_visit
     matching_visit.taps += 1
 
-  for visit in session_visits:
-    visit.save(update_fields=['screens', 'taps'])
+  _save_visits(new_visits, existing_visits, existing_counts)
+  if session_visits:
+    cache.set(_latest_visit_cache_key(session), session_visits[-1], 60 * 30)
+
+  if settings.TRACK_STORE_EVENTS:
+    session_events.buffer_events(taps, screens)
 
   updates_by_date = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
 
@@ -365,13 +429,17 @@ def track(session, event_name, raw_taps=None, raw_screens=None):
   for visit in new_visits:
     updates_by_date[visit.start_time.date()]['monthly_visits'] += 1
 
-  SDKSession.objects.filter(id=session.id).update(
-    last_accessed_time=datetime.now(),
-    taps=F('taps') + tap_count,
-    screens=F('screens') + screens_count,
-    visits=F('visits') + new_visits_count,
-    seconds=F('seconds') + seconds_count,
-  )
+  if settings.TRACK_COALESCE_COUNTERS:
+    session_counters.increment_session(session.id,
+        taps=tap_count, screens=screens_count, visits=new_visits_count, seconds=seconds_count)
+  else:
+    SDKSession.objects.filter(id=session.id).update(
+      last_accessed_time=datetime.now(),
+      taps=F('taps') + tap_count,
+      screens=F('screens') + screens_count,
+      visits=F('visits') + new_visits_count,
+      seconds=F('seconds') + seconds_count,
+    )
 
   if not session.sdk_user_id:
     return
@@ -386,8 +454,10 @@ def track(session, event_name, raw_taps=None, raw_screens=None):
   dates_visited.update(t.time.date() for t in taps)
 
   relative_active_bitmask = 0
+  days_offsets = set()
   for d in dates_visited:
     days_offset = sdk_user.days_active_bitmap_offset_for_date(now_date=d)
+    days_offsets.add(days_offset)
     day_bit = 1 << days_offset
     relative_active_bitmask |= day_bit
 
@@ -403,25 +473,29 @@ def track(session, event_name, raw_taps=None, raw_screens=None):
     sdk_user.monthly_visits += new_visits_count
     sdk_user.monthly_seconds += seconds_count
 
-  SDKUser.objects.filter(id=sdk_user.id).update(
-    last_accessed_time=datetime.now(),
-    taps=F('taps') + tap_count,
-    screens=F('screens') + screens_count,
-    visits=F('visits') + new_visits_count,
-    seconds=F('seconds') + seconds_count,
-
-    monthly_taps=F('monthly_taps') + tap_count,
-    monthly_screens=F('monthly_screens') + screens_count,
-    monthly_visits=F('monthly_visits') + new_visits_count,
-    monthly_seconds=F('monthly_seconds') + seconds_count,
-
-    days_active_map=(
-        F('days_active_map')
-          .bitor(bitwise.to_psql_int64(relative_active_bitmask))
-          .bitand(bitwise.to_psql_int64(valid_days_bitmask))
-    ),
-    monthly_days_active=days_active,
-  )
+  if settings.TRACK_COALESCE_COUNTERS:
+    session_counters.increment_sdk_user(sdk_user.id, days_offsets, valid_days_bitmask,
+        taps=tap_count, screens=screens_count, visits=new_visits_count, seconds=seconds_count)
+  else:
+    SDKUser.objects.filter(id=sdk_user.id).update(
+      last_accessed_time=datetime.now(),
+      taps=F('taps') + tap_count,
+      screens=F('screens') + screens_count,
+      visits=F('visits') + new_visits_count,
+      seconds=F('seconds') + seconds_count,
+
+      monthly_taps=F('monthly_taps') + tap_count,
+      monthly_screens=F('monthly_screens') + screens_count,
+      monthly_visits=F('monthly_visits') + new_visits_count,
+      monthly_seconds=F('monthly_seconds') + seconds_count,
+
+      days_active_map=(
+          F('days_active_map')
+            .bitor(bitwise.to_psql_int64(relative_active_bitmask))
+            .bitand(bitwise.to_psql_int64(valid_days_bitmask))
+      ),
+      monthly_days_active=days_active,
+    )
 
   logs_by_day = []
   for date, updates in updates_by_date.items():
@@ -509,7 +583,6 @@ def days_active_for_user(sdk_user, days=180):
 
 @celery_app.task(ignore_result=True, queue='sessions')
 def process_session_data():
-  process_sdkuser_days_active()
   process_sdkuser_increment_log()
 
 
@@ -518,18 +591,15 @@ def process_session_data():
 #
 
 
-PROCESS_SDKUSERS_LIMIT = 100
-
-@transaction.atomic
-def process_sdkuser_days_active_from_id(max_id, future_days_offset=0):
+def update_sdkuser_days_active(after_id, last_id, future_days_offset=0):
   if settings.IS_PRODUCTION and future_days_offset:
     raise RuntimeError('Not to be used in production')
 
   users = list(
       SDKUser.objects
         .select_for_update()
-        .filter(id__gt=max_id)
-        .order_by('id')[:PROCESS_SDKUSERS_LIMIT])
+        .filter(id__gt=after_id, id__lte=last_id)
+        .order_by('id'))
 
   update_infos = []
   updated_user_ids = []
@@ -551,24 +621,11 @@ def process_sdkuser_days_active_from_id(max_id, future_days_offset=0):
         len(updated_user_ids), ' '.join(['%d->%d' % (b, a) for b, a in update_infos[:5]]))
     session_user_labels.mark_sdk_user_labels_dirty(updated_user_ids)
 
-  if len(users) < PROCESS_SDKUSERS_LIMIT:
-    logging.info('Starting over at the beginning of SDK users table...')
-    return -1
-
-  return users[-1].id
-
-
-LAST_SDKUSER_PROCESSED_KEY = 'sessions:max-sdkuser-id'
-
-def process_sdkuser_days_active():
-  redis = redis_wrap.client()
-  max_id = redis.get(LAST_SDKUSER_PROCESSED_KEY) or 0
+  return len(updated_user_ids)
 
-  new_max_id = process_sdkuser_days_active_from_id(max_id)
 
-  if new_max_id:
-    logging.info('New max id: %s', new_max_id)
-    redis.set(LAST_SDKUSER_PROCESSED_KEY, new_max_id)
+DAYS_ACTIVE_SWEEP = sharded_sweeps.Sweep('sdkuser-days-active', 'lk_sdkuser', update_sdkuser_days_active,
+    initial_batch_size=100)
 
 
 #
@@ -0,0 +1,307 @@
+#
+# Copyright 2016 Cluster Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+
+from backend.lk.logic import redis_wrap
+from backend import celery_app
+
+
+#
+# SHARDED TABLE SWEEPS
+#
+# A sweep walks a whole table in id order, calling a function for each
+# batch of rows. The table is split into fixed id ranges ("shards") which
+# workers lease from redis, so any number of workers can sweep at once and
+# a full pass takes time proportional to table size / worker count.
+#
+# Progress within a shard is saved after every batch, so a worker that dies
+# or runs out of time leaves the rest of its shard for whoever leases it
+# next.
+#
+# start_sweeps only queues settings.SWEEP_WORKERS_PER_SWEEP new workers for
+# a sweep once the ones it queued before are done, and a finished pass waits
+# MIN_CYCLE_SECONDS before the next one starts, so sweeps don't pile up
+# behind each other in the celery queue.
+#
+
+
+SHARD_ID_RANGE = 10000
+
+WORKER_RUN_SECONDS = 20
+LEASE_SECONDS = WORKER_RUN_SECONDS * 2
+# Queued workers that haven't started after this long are assumed lost.
+QUEUED_WORKER_SECONDS = 60 * 10
+MIN_CYCLE_SECONDS = 60 * 60
+
+MIN_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 5000
+# Shrink batches when locking them takes longer than this, and grow them
+# when it takes much less.
+TARGET_LOCK_WAIT_SECONDS = 0.5
+
+
+SWEEPS = {}
+
+
+class Sweep(object):
+  def __init__(self, name, table, process_range, initial_batch_size=250):
+    """process_range(after_id, last_id) should process the rows with ids
+    after_id < id <= last_id, which are already locked in the current
+    transaction, and return how many rows it changed.
+    """
+    self.name = name
+    self.table = table
+    self.process_range = process_range
+    self.initial_batch_size = initial_batch_size
+
+    SWEEPS[name] = self
+
+  def _key(self, kind):
+    return 'sweeps;%s;%s' % (self.name, kind)
+
+
+# KEYS: leases zset, next shard, progress hash, cycle hash
+# ARGV: now, lease expiration, shard id range, max id, min cycle seconds
+LEASE_SHARD_SCRIPT = """
+local now = tonumber(ARGV[1])
+local shard = redis.call('zrangebyscore', KEYS[1], '-inf', now, 'LIMIT', 0, 1)[1]
+if not shard then
+  shard = tonumber(redis.call('get', KEYS[2]) or 0)
+  if shard > tonumber(ARGV[4]) then
+    if redis.call('zcard', KEYS[1]) > 0 then
+      return nil
+    end
+
+    local finished = redis.call('hget', KEYS[4], 'finished')
+    if not finished then
+      local started = redis.call('hget', KEYS[4], 'started')
+      if started then
+        redis.call('hset', KEYS[4], 'last_cycle_seconds', now - tonumber(started))
+      end
+      redis.call('hincrby', KEYS[4], 'cycles', 1)
+      redis.call('hset', KEYS[4], 'finished', ARGV[1])
+      finished = ARGV[1]
+    end
+    if now < tonumber(finished) + tonumber(ARGV[5]) then
+      return nil
+    end
+
+    redis.call('hdel', KEYS[4], 'finished')
+    shard = 0
+  end
+
+  if shard == 0 then
+    redis.call('hset', KEYS[4], 'started', ARGV[1])
+  end
+  redis.call('set', KEYS[2], shard + ARGV[3])
+end
+
+redis.call('zadd', KEYS[1], ARGV[2], shard)
+return {tostring(shard), redis.call('hget', KEYS[3], shard) or tostring(shard - 1)}
+"""
+
+
+def _lease_shard(redis, sweep, max_id):
+  lease = redis.register_script(LEASE_SHARD_SCRIPT)
+  now = time.time()
+  result = lease(
+      keys=[sweep._key('leases'), sweep._key('next-shard'), sweep._key('progress'), sweep._key('cycle')],
+      args=[now, now + LEASE_SECONDS, SHARD_ID_RANGE, max_id, MIN_CYCLE_SECONDS])
+  if not result:
+    return None, None
+
+  shard, after_id = result
+  return long(shard), long(after_id)
+
+
+def _max_id(table):
+  cursor = connection.cursor()
+  cursor.execute('SELECT MAX(id) FROM %s' % table)
+  max_id, = cursor.fetchone()
+  return max_id or 0
+
+
+def _next_batch_size(batch_size, lock_wait):
+  if lock_wait > TARGET_LOCK_WAIT_SECONDS:
+    return max(MIN_BATCH_SIZE, batch_size / 2)
+  if lock_wait < TARGET_LOCK_WAIT_SECONDS / 4:
+    return min(MAX_BATCH_SIZE, int(batch_size * 1.25))
+  return batch_size
+
+
+@transaction.atomic
+def _process_batch(sweep, after_id, shard_end, batch_size):
+  cursor = connection.cursor()
+
+  lock_start = time.time()
+  # Lock rows in id order upfront; process_range will find them already locked.
+  cursor.execute("""
+    SELECT id FROM %s
+    WHERE id > %%s AND id < %%s
+    ORDER BY id
+    LIMIT %%s
+    FOR UPDATE
+  """ % sweep.table, [after_id, shard_end, batch_size])
+  ids = [row_id for row_id, in cursor.fetchall()]
+  lock_wait = time.time() - lock_start
+
+  if not ids:
+    return None, 0, 0, lock_wait
+
+  updates = sweep.process_range(after_id, ids[-1])
+  return ids[-1], len(ids), updates, lock_wait
+
+
+def _record_batch(redis, sweep, shard, last_id, rows, updates, seconds, lock_wait):
+  stats_key = sweep._key('shard-stats')
+  with redis.pipeline() as pipe:
+    pipe.hset(sweep._key('progress'), shard, last_id)
+    pipe.zadd(sweep._key('leases'), time.time() + LEASE_SECONDS, shard)
+
+    pipe.hincrby(sweep._key('stats'), 'rows', rows)
+    pipe.hincrby(sweep._key('stats'), 'updates', updates)
+    pipe.hincrbyfloat(sweep._key('stats'), 'seconds', seconds)
+    pipe.hincrbyfloat(sweep._key('stats'), 'lock_wait_seconds', lock_wait)
+
+    pipe.hset(stats_key, '%s:last_id' % shard, last_id)
+    pipe.hincrby(stats_key, '%s:rows' % shard, rows)
+    pipe.hincrby(stats_key, '%s:updates' % shard, updates)
+    pipe.hincrbyfloat(stats_key, '%s:seconds' % shard, seconds)
+    pipe.hset(stats_key, '%s:update_time' % shard, time.time())
+    pipe.execute()
+
+
+def _finish_shard(redis, sweep, shard):
+  with redis.pipeline() as pipe:
+    pipe.zrem(sweep._key('leases'), shard)
+    pipe.hdel(sweep._key('progress'), shard)
+    pipe.execute()
+
+
+def _release_shard(redis, sweep, shard):
+  # Leave progress in place and let the next worker pick this up right away.
+  redis.zadd(sweep._key('leases'), 0, shard)
+
+
+def run_sweep_worker(sweep):
+  redis = redis_wrap.client()
+  batch_size = int(redis.get(sweep._key('batch-size')) or sweep.initial_batch_size)
+  max_id = _max_id(sweep.table)
+
+  start = time.time()
+  rows = 0
+  updates = 0
+  while time.time() - start < WORKER_RUN_SECONDS:
+    shard, after_id = _lease_shard(redis, sweep, max_id)
+    if shard is None:
+      break
+
+    shard_end = shard + SHARD_ID_RANGE
+    while True:
+      if time.time() - start >= WORKER_RUN_SECONDS:
+        _release_shard(redis, sweep, shard)
+        break
+
+      batch_start = time.time()
+      last_id, batch_rows, batch_updates, lock_wait = _process_batch(sweep, after_id, shard_end, batch_size)
+      if last_id is not None:
+        _record_batch(redis, sweep, shard, last_id, batch_rows, batch_updates,
+            time.time() - batch_start, lock_wait)
+        after_id = last_id
+        rows += batch_rows
+        updates += batch_updates
+
+      shard_done = batch_rows < batch_size
+      batch_size = _next_batch_size(batch_size, lock_wait)
+      if shard_done:
+        _finish_shard(redis, sweep, shard)
+        break
+
+  redis.set(sweep._key('batch-size'), batch_size)
+
+  if rows:
+    elapsed = time.time() - start
+    logging.info('Sweep %s processed %s rows (%s updated) in %.1fs (%.0f rows/s, batch size %s)',
+        sweep.name, rows, updates, elapsed, rows / elapsed, batch_size)
+
+
+def sweep_stats(sweep_name):
+  sweep = SWEEPS[sweep_name]
+  redis = redis_wrap.client()
+  with redis.pipeline() as pipe:
+    pipe.hgetall(sweep._key('cycle'))
+    pipe.hgetall(sweep._key('stats'))
+    pipe.hgetall(sweep._key('shard-stats'))
+    pipe.zrange(sweep._key('leases'), 0, -1, withscores=True)
+    pipe.get(sweep._key('next-shard'))
+    pipe.get(sweep._key('batch-size'))
+    cycle, stats, raw_shard_stats, leases, next_shard, batch_size = pipe.execute()
+
+  shards = {}
+  for field, value in raw_shard_stats.items():
+    shard, metric = field.split(':', 1)
+    shards.setdefault(long(shard), {})[metric] = float(value)
+
+  seconds = float(stats.get('seconds') or 0)
+  return {
+    'cycle': cycle,
+    'rows': int(stats.get('rows') or 0),
+    'updates': int(stats.get('updates') or 0),
+    'rows_per_second': seconds and int(stats.get('rows') or 0) / seconds,
+    'lock_wait_seconds': float(stats.get('lock_wait_seconds') or 0),
+    'leased_shards': [long(leased_shard) for leased_shard, expiration in leases if expiration > time.time()],
+    'next_shard': long(next_shard or 0),
+    'batch_size': int(batch_size or 0),
+    'shards': shards,
+  }
+
+
+@celery_app.task(ignore_result=True, queue='sessions')
+def sweep_worker(sweep_name, worker_id=None):
+  sweep = SWEEPS[sweep_name]
+  redis = redis_wrap.client()
+  if worker_id:
+    redis.zadd(sweep._key('workers'), time.time() + WORKER_RUN_SECONDS + LEASE_SECONDS, worker_id)
+
+  try:
+    run_sweep_worker(sweep)
+  finally:
+    if worker_id:
+      redis.zrem(sweep._key('workers'), worker_id)
+
+
+@celery_app.task(ignore_result=True, queue='sessions')
+def start_sweeps():
+  redis = redis_wrap.client()
+  for sweep_name, sweep in SWEEPS.items():
+    now = time.time()
+    workers_key = sweep._key('workers')
+    redis.zremrangebyscore(workers_key, '-inf', now)
+    if redis.zcard(workers_key) or redis.zcount(sweep._key('leases'), now, '+inf'):
+      # Earlier workers are still queued or running.
+      continue
+
+    worker_ids = [uuid.uuid4().hex for _ in range(settings.SWEEP_WORKERS_PER_SWEEP)]
+    redis.zadd(workers_key, *[v for worker_id in worker_ids for v in (now + QUEUED_WORKER_SECONDS, worker_id)])
+    for worker_id in worker_ids:
+      sweep_worker.delay(sweep_name, worker_id=worker_id)
@@ -16,65 +16,167 @@
 #
 
 import collections
+import cookielib
+import cPickle as pickle
+import hashlib
 import json
 import logging
-import ssl
+import threading
 import time
-import urllib2
-from httplib import HTTPException
-from socket import error as SocketError
+import urlparse
+import zlib
 
+import requests
+from requests.adapters import HTTPAdapter
 from django.conf import settings
 from django.core.cache import cache
+from redis import RedisError
+
+from backend.lk.logic import redis_wrap
 
 
 CACHED_FETCH_KEY_FORMAT = 'cached-fetch:%s'
+REVALIDATE_KEY_FORMAT = 'urlfetch;revalidate;url=%s'
+HOST_STATS_KEY_FORMAT = 'urlfetch;stats;host=%s'
 
+# Keep-alive connections are pooled per host and shared by every thread.
+POOLED_HOSTS = 100
+CONNECTIONS_PER_HOST = 100
 
-def send_request(url, method='GET', body=None, headers=None, json_response=True, timeout=8.0):
+
+def _create_session():
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=POOLED_HOSTS, pool_maxsize=CONNECTIONS_PER_HOST)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  # The session is shared by unrelated callers, so don't carry cookies over.
+  session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+  return session
+
+_session = _create_session()
+
+
+def _record_host_stats(url, code, seconds, content_bytes):
+  try:
+    redis = redis_wrap.client()
+    if not redis:
+      return
+
+    key = HOST_STATS_KEY_FORMAT % urlparse.urlparse(url).netloc
+    with redis.pipeline(transaction=False) as pipe:
+      pipe.hincrby(key, 'requests', 1)
+      pipe.hincrby(key, 'status:%s' % code, 1)
+      pipe.hincrby(key, 'bytes', content_bytes)
+      pipe.hincrbyfloat(key, 'seconds', seconds)
+      pipe.execute()
+  except RedisError:
+    logging.warn('Could not record urlfetch stats for: %s', url)
+
+
+def host_stats(host):
+  redis = redis_wrap.client()
+  stats = redis.hgetall(HOST_STATS_KEY_FORMAT % host)
+  result = dict((k, int(v)) for k, v in stats.items() if k != 'seconds')
+  result['seconds'] = float(stats.get('seconds') or 0)
+  if result.get('requests'):
+    result['average_seconds'] = result['seconds'] / result['requests']
+    result['average_bytes'] = result.get('bytes', 0) / result['requests']
+  return result
+
+
+def _send_raw_request(url, method='GET', body=None, headers=None, timeout=8.0):
   headers = headers or {}
   headers.update({
     'User-Agent': 'Mozilla/5.0 (compatible; LK robot; +%s)' % settings.SITE_URL
   })
-  req = urllib2.Request(url, body, headers)
-  req.get_method = lambda: method
 
+  start = time.time()
   try:
-    result = urllib2.urlopen(req, None, timeout)
-    code = 200
-  except urllib2.HTTPError as e:
-    if e.code >= 500:
-      logging.warn('urlfetch response: %s', e.code)
-    result = e
-    code = e.code
-  except SocketError as e:
+    # NOTE: requests asks for gzip and decodes it transparently.
+    response = _session.request(method, url, data=body, headers=headers, timeout=timeout)
+    content = response.content
+  except requests.exceptions.Timeout:
     logging.info('urlfetch socket timeout or reset')
+    _record_host_stats(url, -1, time.time() - start, 0)
     return -1, {}, None
-  except (urllib2.URLError, ssl.SSLError, HTTPException) as e:
-    # HTTPException example: BadStatusLine ''
+  except requests.exceptions.RequestException as e:
+    # Connection problems, bad status lines, SSL errors and the like.
     logging.warn('urlfetch connection problem: %s', e)
+    _record_host_stats(url, -1, time.time() - start, 0)
     return -1, {}, None
 
+  code = response.status_code
+  if code >= 500:
+    logging.warn('urlfetch response: %s', code)
+  _record_host_stats(url, code, time.time() - start, len(content))
+
+  response_headers = dict((k.lower(), v) for k, v in response.headers.items())
+  return code, response_headers, content
+
+
+def _decode_json(url, code, content):
   try:
-    result_content = result.read()
-  except SocketError as e:
-    logging.warn('urlfetch socket error: %s', e)
-    return -1, {}, None
+    return json.loads(content)
+  except ValueError as e:
+    if code == 200:
+      logging.warn('Invalid JSON response from URL: %s %r', url, content)
+    return None
 
-  if json_response:
-    try:
-      result_content = json.loads(result_content)
-    except ValueError as e:
-      if code == 200:
-        logging.warn('Invalid JSON response from URL: %s %r', url, result_content)
-      result_content = None
 
-  return code, result.info().dict, result_content
+def send_request(url, method='GET', body=None, headers=None, json_response=True, timeout=8.0):
+  code, response_headers, content = _send_raw_request(url, method=method, body=body, headers=headers,
+      timeout=timeout)
+  if json_response and code != -1:
+    content = _decode_json(url, code, content)
+  return code, response_headers, content
+
+
+def _revalidate_key(url):
+  return REVALIDATE_KEY_FORMAT % hashlib.sha1(url).hexdigest()
+
+
+def _send_revalidating_request(url, revalidate_seconds):
+  # Remember the validators and body of the last 200 response, and let the
+  # server tell us with a 304 when it hasn't changed since.
+  redis = redis_wrap.client()
+  if not redis:
+    return _send_raw_request(url)
+
+  key = _revalidate_key(url)
+  cached = redis.get(key)
+  if cached:
+    etag, last_modified, cached_headers, compressed_content = pickle.loads(cached)
+  else:
+    etag, last_modified, cached_headers, compressed_content = None, None, None, None
+
+  request_headers = {}
+  if etag:
+    request_headers['If-None-Match'] = etag
+  if last_modified:
+    request_headers['If-Modified-Since'] = last_modified
+
+  code, headers, content = _send_raw_request(url, headers=request_headers)
+  if code == 304 and cached:
+    redis.expire(key, revalidate_seconds)
+    return 200, cached_headers, zlib.decompress(compressed_content)
+
+  if code == 200 and (headers.get('etag') or headers.get('last-modified')):
+    redis.setex(key, revalidate_seconds, pickle.dumps(
+        (headers.get('etag'), headers.get('last-modified'), headers, zlib.compress(content)),
+        pickle.HIGHEST_PROTOCOL))
+
+  return code, headers, content
 
 
 FetchResponse = collections.namedtuple('FetchResponse', ['code', 'headers', 'data'])
 
-def fetch(url, cache_seconds=None, should_cache_fn=None, json_response=True, retries=0):
+def fetch(url, cache_seconds=None, should_cache_fn=None, json_response=True, retries=0, revalidate_seconds=None):
+  """Fetches url with a GET request.
+
+  If revalidate_seconds is given, the last good response is kept around for
+  that long and the request is made conditional on it, so an unchanged
+  resource costs a 304 instead of the whole response.
+  """
   if cache_seconds:
     cache_key = CACHED_FETCH_KEY_FORMAT % url
     cached = cache.get(cache_key)
@@ -85,13 +187,49 @@ def fetch(url, cache_seconds=None, should_cache_fn=None, json_response=True, ret
   for i in range(retries + 1):
     if i > 0:
       time.sleep(0.333 * i)
-    code, headers, data = send_request(url, json_response=json_response)
+    if revalidate_seconds:
+      code, headers, data = _send_revalidating_request(url, revalidate_seconds)
+    else:
+      code, headers, data = _send_raw_request(url)
     if code >= 200 and code < 500:
       break
 
+  if json_response and code != -1:
+    data = _decode_json(url, code, data)
+
   result = FetchResponse(code, headers, data)
   if cache_seconds and code >= 200 and code < 500:
     if (not should_cache_fn) or should_cache_fn(code, data):
       cache.set(cache_key, result, cache_seconds)
 
-  return result
\ No newline at end of file
+  return result
+
+
+class HostRateLimiter(object):
+  """Spaces out requests to each host across every thread in this process.
+
+  wait() reserves the next slot for the url's host and sleeps until it comes
+  up; up to burst requests can go out back to back after the host has been
+  idle. pause() holds off all requests to a host, eg. after a 403.
+  """
+
+  def __init__(self, requests_per_second, burst=1):
+    self.interval = 1.0 / requests_per_second
+    self.burst = burst
+    self._lock = threading.Lock()
+    self._next_times = {}
+
+  def wait(self, url):
+    host = urlparse.urlparse(url).netloc
+    with self._lock:
+      now = time.time()
+      next_time = max(self._next_times.get(host, 0), now - self.interval * (self.burst - 1))
+      self._next_times[host] = next_time + self.interval
+    delay = next_time - now
+    if delay > 0:
+      time.sleep(delay)
+
+  def pause(self, url, seconds):
+    host = urlparse.urlparse(url).netloc
+    with self._lock:
+      self._next_times[host] = max(self._next_times.get(host, 0), time.time() + seconds)
@@ -0,0 +1,329 @@
+#
+# Copyright 2016 Cluster Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+
+from backend.lk.logic import redis_wrap
+
+
+#
+# SCHEDULED WORK QUEUES
+#
+# Members wait in a "pending" zset scored by when they are due. claim()
+# atomically moves due members into a "leased" zset scored by when their
+# lease runs out; workers ack() what they finish, optionally scheduling it
+# again, or fail() it to retry later. Leases that run out count as a failed
+# attempt, and members that fail too many times in a row are moved to a
+# dead letter zset instead of being retried forever.
+#
+# NOTE: A member scheduled again while it is leased is not claimed again
+# until the lease is acked, failed or expires, so one member is never
+# worked on twice at once (unless a worker outlives its lease). When claim()
+# comes across one that is due, it moves it out of pending into a
+# "deferred" hash, so it can't crowd out other due members; it goes back
+# into pending, due by the earlier of the two times, when the lease ends.
+#
+
+
+DEFAULT_LEASE_SECONDS = 60 * 10
+DEFAULT_MAX_ATTEMPTS = 5
+
+THROUGHPUT_MINUTES = 10
+
+
+QUEUES = {}
+
+
+class WorkQueue(object):
+  def __init__(self, name, pending_key=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+      max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """pending_key lets a queue take over an existing zset of member => due time."""
+    self.name = name
+    self.pending_key = pending_key or self._key('pending')
+    self.lease_seconds = lease_seconds
+    self.max_attempts = max_attempts
+
+    QUEUES[name] = self
+
+  def _key(self, kind):
+    return 'work-queues;%s;%s' % (self.name, kind)
+
+  def _throughput_key(self, minute):
+    return self._key('acked;minute=%d' % minute)
+
+  def schedule(self, member_times):
+    """Schedules each member at the given time, replacing any earlier
+    schedule. Takes a dict of member => timestamp.
+    """
+    if not member_times:
+      return
+    scored = []
+    for member, target_time in member_times.items():
+      scored.append(target_time)
+      scored.append(member)
+    redis = redis_wrap.client()
+    redis.zadd(self.pending_key, *scored)
+
+  def claim(self, limit, now=None, with_dead_letters=False):
+    """Leases up to limit due members and returns them. With
+    with_dead_letters, returns (claimed, dead) where dead are members whose
+    expired leases used up their last attempt.
+    """
+    now = now or time.time()
+    redis = redis_wrap.client()
+    claim = redis.register_script(CLAIM_SCRIPT)
+    claimed, dead = claim(
+        keys=[self.pending_key, self._key('leased'), self._key('attempts'), self._key('dead'), self._key('stats'),
+              self._key('deferred')],
+        args=[now, limit, now + self.lease_seconds, self.max_attempts])
+    if with_dead_letters:
+      return claimed, dead
+    return claimed
+
+  def renew(self, members, lease_seconds=None):
+    """Extends the leases on members that are still leased, eg. when work
+    claimed a while ago actually starts. Returns the members renewed.
+    """
+    if not members:
+      return []
+    lease_seconds = lease_seconds or self.lease_seconds
+    redis = redis_wrap.client()
+    renew = redis.register_script(RENEW_SCRIPT)
+    return renew(keys=[self._key('leased')], args=[time.time() + lease_seconds] + list(members))
+
+  def ack(self, members, reschedule_times=None):
+    """Finishes leases on members, scheduling each one again at the matching
+    time in reschedule_times, if any, unless it is already due sooner.
+    """
+    if not members:
+      return 0
+    reschedule_times = reschedule_times or [None] * len(members)
+
+    args = [THROUGHPUT_MINUTES * 60 * 2]
+    for member, target_time in zip(members, reschedule_times):
+      args.append(member)
+      args.append('' if target_time is None else target_time)
+
+    redis = redis_wrap.client()
+    ack = redis.register_script(ACK_SCRIPT)
+    return ack(
+        keys=[self.pending_key, self._key('leased'), self._key('attempts'), self._key('stats'),
+              self._throughput_key(int(time.time() / 60)), self._key('deferred')],
+        args=args)
+
+  def fail(self, members, retry_seconds):
+    """Finishes leases on members, retrying them after retry_seconds unless
+    they have failed too many times. Returns the members given up on.
+    """
+    if not members:
+      return []
+    now = time.time()
+    redis = redis_wrap.client()
+    fail = redis.register_script(FAIL_SCRIPT)
+    return fail(
+        keys=[self.pending_key, self._key('leased'), self._key('attempts'), self._key('dead'), self._key('stats'),
+              self._key('deferred')],
+        args=[now, now + retry_seconds, self.max_attempts] + list(members))
+
+  def leased_count(self, now=None):
+    """Counts members currently being worked on."""
+    now = now or time.time()
+    redis = redis_wrap.client()
+    return redis.zcount(self._key('leased'), now, '+inf')
+
+  def dead_letters(self, limit=100):
+    redis = redis_wrap.client()
+    return redis.zrange(self._key('dead'), 0, limit - 1, withscores=True)
+
+  def requeue_dead_letters(self, members, target_time=None):
+    if not members:
+      return
+    target_time = target_time or time.time()
+    redis = redis_wrap.client()
+    with redis.pipeline() as pipe:
+      pipe.zrem(self._key('dead'), *members)
+      pipe.zadd(self.pending_key, *[v for member in members for v in (target_time, member)])
+      pipe.execute()
+
+  def stats(self, now=None):
+    now = now or time.time()
+    current_minute = int(now / 60)
+    # Only count whole minutes.
+    throughput_keys = [self._throughput_key(m) for m in range(current_minute - THROUGHPUT_MINUTES, current_minute)]
+
+    redis = redis_wrap.client()
+    with redis.pipeline() as pipe:
+      pipe.zcard(self.pending_key)
+      pipe.zcount(self.pending_key, '-inf', now)
+      pipe.zrangebyscore(self.pending_key, '-inf', now, start=0, num=1, withscores=True)
+      pipe.zcard(self._key('leased'))
+      pipe.hlen(self._key('deferred'))
+      pipe.zcard(self._key('dead'))
+      pipe.hgetall(self._key('stats'))
+      pipe.mget(throughput_keys)
+      pending, due, oldest_due, leased, deferred, dead, counters, acked_by_minute = pipe.execute()
+
+    return {
+      'pending': pending,
+      'due': due,
+      'lag_seconds': oldest_due and (now - oldest_due[0][1]) or 0.0,
+      'leased': leased,
+      'deferred': deferred,
+      'dead': dead,
+      'acked_per_minute': sum(int(a or 0) for a in acked_by_minute) / float(THROUGHPUT_MINUTES),
+      'counts': dict((k, int(v)) for k, v in counters.items()),
+    }
+
+
+def queue_stats(queue_name):
+  return QUEUES[queue_name].stats()
+
+
+# Schedules member in pending (KEYS[1]) at target_time, unless it is
+# already due sooner there or in deferred (deferred_key).
+SCHEDULE_MEMBER_LUA = """
+local function schedule_member(member, target_time, deferred_key)
+  local deferred = redis.call('hget', deferred_key, member)
+  if deferred then
+    redis.call('hdel', deferred_key, member)
+    if not target_time or tonumber(deferred) < target_time then
+      target_time = tonumber(deferred)
+    end
+  end
+  if not target_time then
+    return
+  end
+
+  local due = redis.call('zscore', KEYS[1], member)
+  if not due or tonumber(due) > target_time then
+    redis.call('zadd', KEYS[1], target_time, member)
+  end
+end
+"""
+
+
+# KEYS: pending, leased, attempts, dead, stats, deferred
+FAIL_MEMBER_LUA = SCHEDULE_MEMBER_LUA + """
+local function fail_member(member, now, retry_time, max_attempts)
+  redis.call('zrem', KEYS[2], member)
+  local attempts = redis.call('hincrby', KEYS[3], member, 1)
+  if attempts >= max_attempts then
+    redis.call('hdel', KEYS[3], member)
+    redis.call('hdel', KEYS[6], member)
+    redis.call('zrem', KEYS[1], member)
+    redis.call('zadd', KEYS[4], now, member)
+    redis.call('hincrby', KEYS[5], 'dead_lettered', 1)
+    return true
+  end
+
+  schedule_member(member, retry_time, KEYS[6])
+  return false
+end
+"""
+
+
+# KEYS: pending, leased, attempts, dead, stats, deferred
+# ARGV: now, limit, lease expiration, max attempts
+CLAIM_SCRIPT = FAIL_MEMBER_LUA + """
+local now = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+
+local dead = {}
+local expired = redis.call('zrangebyscore', KEYS[2], '-inf', now, 'LIMIT', 0, limit)
+for _, member in ipairs(expired) do
+  if fail_member(member, now, now, tonumber(ARGV[4])) then
+    dead[#dead + 1] = member
+  end
+end
+if #expired > 0 then
+  redis.call('hincrby', KEYS[5], 'expired', #expired)
+end
+
+-- Every due member looked at leaves pending, claimed or deferred, so this
+-- always gets further down the due members.
+local claimed = {}
+while #claimed < limit do
+  local due = redis.call('zrangebyscore', KEYS[1], '-inf', now, 'WITHSCORES', 'LIMIT', 0, limit - #claimed)
+  if #due == 0 then
+    break
+  end
+  for i = 1, #due, 2 do
+    local member = due[i]
+    redis.call('zrem', KEYS[1], member)
+    if redis.call('zscore', KEYS[2], member) then
+      local deferred = redis.call('hget', KEYS[6], member)
+      if not deferred or tonumber(deferred) > tonumber(due[i + 1]) then
+        redis.call('hset', KEYS[6], member, due[i + 1])
+      end
+    else
+      redis.call('zadd', KEYS[2], ARGV[3], member)
+      claimed[#claimed + 1] = member
+    end
+  end
+end
+if #claimed > 0 then
+  redis.call('hincrby', KEYS[5], 'claimed', #claimed)
+end
+return {claimed, dead}
+"""
+
+
+# KEYS: leased
+# ARGV: lease expiration, members...
+RENEW_SCRIPT = """
+local renewed = {}
+for i = 2, #ARGV do
+  if redis.call('zscore', KEYS[1], ARGV[i]) then
+    redis.call('zadd', KEYS[1], ARGV[1], ARGV[i])
+    renewed[#renewed + 1] = ARGV[i]
+  end
+end
+return renewed
+"""
+
+
+# KEYS: pending, leased, attempts, stats, throughput, deferred
+# ARGV: throughput expiration seconds, then member, reschedule time ('' for none) pairs
+ACK_SCRIPT = SCHEDULE_MEMBER_LUA + """
+local acked = 0
+for i = 2, #ARGV, 2 do
+  local member = ARGV[i]
+  acked = acked + redis.call('zrem', KEYS[2], member)
+  redis.call('hdel', KEYS[3], member)
+  schedule_member(member, tonumber(ARGV[i + 1]), KEYS[6])
+end
+
+if acked > 0 then
+  redis.call('hincrby', KEYS[4], 'acked', acked)
+  redis.call('incrby', KEYS[5], acked)
+  redis.call('expire', KEYS[5], ARGV[1])
+end
+return acked
+"""
+
+
+# KEYS: pending, leased, attempts, dead, stats, deferred
+# ARGV: now, retry time, max attempts, members...
+FAIL_SCRIPT = FAIL_MEMBER_LUA + """
+local dead = {}
+for i = 4, #ARGV do
+  if fail_member(ARGV[i], tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])) then
+    dead[#dead + 1] = ARGV[i]
+  end
+end
+redis.call('hincrby', KEYS[5], 'failed', #ARGV - 3)
+return dead
+"""
@@ -0,0 +1,26 @@
+#
+# Copyright 2016 Cluster Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from django.core.management.base import BaseCommand
+
+from backend.lk.logic import appstore_review_search
+
+
+class Command(BaseCommand):
+  help = 'Builds the review search indexes CONCURRENTLY, if they are missing.'
+
+  def handle(self, *args, **options):
+    appstore_review_search.create_search_indexes()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import backend.util.hstore_field
+import djorm_pgarray.fields
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lk', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppStoreAppCurrentInfo',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+                ('data', backend.util.hstore_field.HStoreField()),
+                ('categories', djorm_pgarray.fields.IntegerArrayField()),
+                ('screenshots', djorm_pgarray.fields.TextArrayField(dbtype='text')),
+                ('ipad_screenshots', djorm_pgarray.fields.TextArrayField(dbtype='text')),
+                ('release_date', models.DateTimeField()),
+                ('country', models.CharField(max_length=2, null=True)),
+                ('update_time', models.DateTimeField(auto_now=True)),
+                ('app', models.ForeignKey(related_name='+', to='lk.AppStoreApp', on_delete=django.db.models.deletion.DO_NOTHING, db_index=False)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='appstoreappcurrentinfo',
+            unique_together=set([('app', 'country')]),
+        ),
+        migrations.CreateModel(
+            name='AppStoreAppInfoChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+                ('country', models.CharField(max_length=2, null=True)),
+                ('changes', backend.util.hstore_field.HStoreField()),
+                ('app', models.ForeignKey(related_name='+', to='lk.AppStoreApp', on_delete=django.db.models.deletion.DO_NOTHING, db_index=False)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='appstoreappinfochange',
+            index_together=set([('app', 'country', 'create_time')]),
+        ),
+        # Seed current info from the latest legacy snapshot for each app+country.
+        migrations.RunSQL("""
+            INSERT INTO lk_appstoreappcurrentinfo
+                (create_time, update_time, app_id, country, data, categories, screenshots, ipad_screenshots, release_date)
+            SELECT DISTINCT ON (app_id, country)
+                create_time, create_time, app_id, country, data, categories, screenshots, ipad_screenshots, release_date
+            FROM lk_appstoreappinfo
+            ORDER BY app_id, country, create_time DESC
+        """),
+    ]
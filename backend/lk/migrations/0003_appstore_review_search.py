@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lk', '0002_appstore_app_current_info'),
+    ]
+
+    # search_vector is maintained by a trigger and only read in raw SQL, so
+    # it is not a model field. Existing rows are filled in afterwards by
+    # appstore_review_search.backfill_search_vectors, from beat.
+    #
+    # The search indexes are not built here: a plain CREATE INDEX would
+    # block review inserts for the whole build. Run
+    # "manage.py create_review_search_indexes" afterwards, which builds them
+    # CONCURRENTLY.
+    operations = [
+        migrations.RunSQL("""
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+            ALTER TABLE lk_appstorereview ADD COLUMN search_vector tsvector;
+
+            CREATE FUNCTION lk_appstorereview_search_vector_update() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector :=
+                    setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+                    setweight(to_tsvector('english', coalesce(NEW.body, '')), 'B');
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER lk_appstorereview_search_vector_trigger
+                BEFORE INSERT OR UPDATE OF title, body ON lk_appstorereview
+                FOR EACH ROW EXECUTE PROCEDURE lk_appstorereview_search_vector_update();
+        """, reverse_sql="""
+            DROP INDEX IF EXISTS lk_appstorereview_title_trgm;
+            DROP INDEX IF EXISTS lk_appstorereview_search_vector_gin;
+            DROP TRIGGER lk_appstorereview_search_vector_trigger ON lk_appstorereview;
+            DROP FUNCTION lk_appstorereview_search_vector_update();
+            ALTER TABLE lk_appstorereview DROP COLUMN search_vector;
+        """),
+    ]
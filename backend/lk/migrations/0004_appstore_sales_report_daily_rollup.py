@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import backend.util.hstore_field
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lk', '0003_appstore_review_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppStoreSalesReportDailyRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('report_date', models.DateField()),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+                ('units', models.DecimalField(max_digits=18, decimal_places=2)),
+                ('download_units', models.DecimalField(max_digits=18, decimal_places=2)),
+                ('proceeds', backend.util.hstore_field.HStoreField()),
+                ('app', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.DO_NOTHING, to='lk.AppStoreApp', db_index=False)),
+                ('vendor', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.DO_NOTHING, to='lk.ItunesConnectVendor', db_index=False)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='appstoresalesreportdailyrollup',
+            unique_together=set([('vendor', 'report_date', 'app')]),
+        ),
+        # Roll up the reports fetched so far.
+        migrations.RunSQL("""
+            INSERT INTO lk_appstoresalesreportdailyrollup
+                (create_time, vendor_id, report_date, app_id, units, download_units, proceeds)
+            SELECT NOW(), vendor_id, end_date, app_id, SUM(units), SUM(download_units),
+                hstore(array_agg(proceeds_currency::text), array_agg(proceeds::text))
+            FROM (
+                SELECT vendor_id, end_date, app_id, proceeds_currency,
+                    SUM(units) AS units,
+                    SUM(CASE WHEN product_type_identifier IN ('1', '1-B', '1E', '1EP', '1EU', '1F', '1T', 'F1')
+                        THEN units ELSE 0 END) AS download_units,
+                    SUM(GREATEST(developer_proceeds * units, 0)) AS proceeds
+                FROM lk_appstoresalesreport
+                GROUP BY vendor_id, end_date, app_id, proceeds_currency
+            ) by_currency
+            GROUP BY vendor_id, end_date, app_id
+        """),
+    ]
@@ -15,6 +15,9 @@
 # limitations under the License.
 #
 
+import json
+from datetime import datetime
+
 from django.db import models
 from djorm_pgarray.fields import IntegerArrayField
 from djorm_pgarray.fields import TextArrayField
@@ -25,7 +28,11 @@ from backend.util import hstore_field
 from backend.util import text
 
 
-class AppStoreAppInfo(APIModel):
+class BaseAppStoreAppInfo(APIModel):
+  class Meta:
+    app_label = 'lk'
+    abstract = True
+
   create_time = models.DateTimeField(auto_now_add=True)
 
   app = models.ForeignKey(AppStoreApp, related_name='+', db_index=False, on_delete=models.DO_NOTHING)
@@ -113,3 +120,45 @@ class AppStoreAppInfo(APIModel):
     full_dict['screenshots'] = self.screenshots
 
     return full_dict
+
+
+class AppStoreAppInfo(BaseAppStoreAppInfo):
+  # Full snapshots of app info, one per change. No longer written; see
+  # AppStoreAppCurrentInfo and AppStoreAppInfoChange.
+  pass
+
+
+class AppStoreAppCurrentInfo(BaseAppStoreAppInfo):
+  class Meta:
+    app_label = 'lk'
+    unique_together = ('app', 'country')
+
+  update_time = models.DateTimeField(auto_now=True)
+
+
+class AppStoreAppInfoChange(APIModel):
+  class Meta:
+    app_label = 'lk'
+    index_together = ('app', 'country', 'create_time')
+
+  create_time = models.DateTimeField(auto_now_add=True)
+
+  app = models.ForeignKey(AppStoreApp, related_name='+', db_index=False, on_delete=models.DO_NOTHING)
+  country = models.CharField(null=True, max_length=2)
+
+  # Property name => JSON-encoded new value, for changed properties only.
+  changes = hstore_field.HStoreField()
+
+  @property
+  def changed_values(self):
+    return dict((k, json.loads(v)) for k, v in self.changes.items())
+
+  @changed_values.setter
+  def changed_values(self, values):
+    self.changes = dict((k, json.dumps(v, default=_json_default)) for k, v in values.items())
+
+
+def _json_default(value):
+  if isinstance(value, datetime):
+    return value.isoformat()
+  raise TypeError('Cannot encode %r' % value)
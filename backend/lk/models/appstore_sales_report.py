@@ -20,6 +20,7 @@ from django.db import models
 from backend.lk.models.apimodel import APIModel
 from backend.lk.models.appstore_app import AppStoreApp
 from backend.lk.models.itunes_connect_vendor import ItunesConnectVendor
+from backend.util import hstore_field
 
 
 class AppStoreSalesReport(APIModel):
@@ -61,9 +62,11 @@ class AppStoreSalesReport(APIModel):
   category = models.CharField(max_length=50)
   cmb = models.CharField(max_length=5)
 
+  DOWNLOAD_PRODUCT_TYPE_IDENTIFIERS = ('1', '1-B', '1E', '1EP', '1EU', '1F', '1T', 'F1')
+
   @property
   def is_download(self):
-    return self.product_type_identifier in ['1', '1-B', '1E', '1EP', '1EU', '1F', '1T', 'F1']
+    return self.product_type_identifier in self.DOWNLOAD_PRODUCT_TYPE_IDENTIFIERS
 
 
 class AppStoreSalesReportFetchedStatus(APIModel):
@@ -76,3 +79,22 @@ class AppStoreSalesReportFetchedStatus(APIModel):
   create_time = models.DateTimeField(auto_now_add=True)
   empty = models.BooleanField(default=False)
   failed = models.BooleanField(default=False)
+
+
+class AppStoreSalesReportDailyRollup(APIModel):
+  class Meta:
+    app_label = 'lk'
+    unique_together = ('vendor', 'report_date', 'app')
+
+  vendor = models.ForeignKey(ItunesConnectVendor, related_name='+', db_index=False, on_delete=models.DO_NOTHING)
+  report_date = models.DateField()
+  app = models.ForeignKey(AppStoreApp, related_name='+', db_index=False, on_delete=models.DO_NOTHING)
+
+  create_time = models.DateTimeField(auto_now_add=True)
+
+  units = models.DecimalField(max_digits=18, decimal_places=2)
+  download_units = models.DecimalField(max_digits=18, decimal_places=2)
+
+  # Currency => total positive proceeds (unit proceeds * units) in that
+  # currency, as a decimal string.
+  proceeds = hstore_field.HStoreField()
@@ -16,11 +16,16 @@
 
 # Load modules that contain @celery.task's so we properly register them with the worker.
 from backend.lk.logic import appstore_review_ingestion
+from backend.lk.logic import appstore_review_search
 from backend.lk.logic import appstore_review_subscriptions
 from backend.lk.logic import debug
 from backend.lk.logic import gae_photos
 from backend.lk.logic import itunes_connect
 from backend.lk.logic import screenshot_bundler
+from backend.lk.logic import session_counters
+from backend.lk.logic import session_events
+from backend.lk.logic import session_track_queue
 from backend.lk.logic import sessions
 from backend.lk.logic import session_user_labels
+from backend.lk.logic import sharded_sweeps
 from backend.lk.logic import users
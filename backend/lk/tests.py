@@ -0,0 +1,64 @@
+from django.test import TestCase
+
+from backend.lk.logic import appstore_app_info
+from backend.lk.logic import appstore_fetch
+from backend.lk.models import AppStoreApp
+
+
+class FakeWorkQueue(object):
+  def __init__(self, members):
+    self.members = members
+    self.acked = []
+
+  def claim(self, limit, now=None):
+    claimed, self.members = self.members[:limit], self.members[limit:]
+    return claimed
+
+  def ack(self, members, reschedule_times=None):
+    self.acked.extend(members)
+
+
+class AppInfoIngestionTest(TestCase):
+  def setUp(self):
+    self.app = AppStoreApp.objects.create(itunes_id='284882215', bundle_id='com.facebook.Facebook',
+        app_info_countries=['us'])
+
+    self.lookup_urls = []
+    self.updated = []
+
+    def fake_lookup_fetch(remote_url):
+      self.lookup_urls.append(remote_url)
+      # The lookup API returns trackId as a number.
+      return [{
+        'kind': 'software',
+        'trackId': 284882215,
+        'bundleId': 'com.facebook.Facebook',
+        'trackName': 'Facebook',
+        'version': '1.0',
+        'artistId': 284882218,
+        'artistName': 'Facebook, Inc.',
+      }]
+
+    self.patches = [
+      (appstore_fetch, '_lookup_fetch', fake_lookup_fetch),
+      (appstore_app_info, 'update_app_infos_with_fetched_data', self.updated.extend),
+      (appstore_app_info.time, 'sleep', lambda seconds: None),
+      (appstore_app_info, 'APP_INFO_INGESTION_QUEUE', FakeWorkQueue([str(self.app.id)])),
+    ]
+    self.originals = [(module, name, getattr(module, name)) for module, name, _ in self.patches]
+    for module, name, value in self.patches:
+      setattr(module, name, value)
+
+  def tearDown(self):
+    for module, name, value in self.originals:
+      setattr(module, name, value)
+
+  def test_batched_lookup_matches_apps(self):
+    appstore_app_info.maybe_ingest_app_info()
+
+    self.assertEqual(len(self.lookup_urls), 1)
+    self.assertEqual(len(self.updated), 1)
+    app, fetched_app_info = self.updated[0]
+    self.assertEqual(app.id, self.app.id)
+    self.assertEqual(fetched_app_info.bundle_id, 'com.facebook.Facebook')
+    self.assertEqual(appstore_app_info.APP_INFO_INGESTION_QUEUE.acked, [self.app.id])
@@ -100,6 +100,27 @@ def api_view(*methods):
   return wrapped
 
 
+def count_statements(fn):
+  """Reports the number of SQL statements a view executed in the
+  X-API-Statements response header.
+  """
+  @functools.wraps(fn)
+  def _count_statements(request, *args, **kwargs):
+    previous_use_debug_cursor = connection.use_debug_cursor
+    # This makes the connection record queries even when DEBUG is off.
+    connection.use_debug_cursor = True
+    statements_before = len(connection.queries)
+    try:
+      response = fn(request, *args, **kwargs)
+      statements = len(connection.queries) - statements_before
+    finally:
+      connection.use_debug_cursor = previous_use_debug_cursor
+
+    response['X-API-Statements'] = '%d' % statements
+    return response
+  return _count_statements
+
+
 def api_user_view(*methods, **dkwargs):
   enable_logged_out = dkwargs.get('enable_logged_out', False)
   def wrapped(fn):
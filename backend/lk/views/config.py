@@ -18,6 +18,7 @@ import re
 import logging
 
 from django import forms
+from django.http import HttpResponseNotModified
 
 from backend.lk.logic import runtime_config
 from backend.lk.logic import tokens
@@ -284,9 +285,16 @@ def config_interpolated_view(request):
       debug=form.cleaned_data['debug'],
       sdk_user_labels=user_labels)
 
-  return api_response({
-    'config': config,
-  })
+  etag = '"%s"' % runtime_config.config_hash(config)
+  if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+    response = HttpResponseNotModified()
+  else:
+    response = api_response({
+      'config': config,
+    })
+
+  response['ETag'] = etag
+  return response
 
 
 @api_user_view('POST')
@@ -79,6 +79,11 @@ class ReviewsFilter(forms.Form):
   rating = forms.IntegerField(required=False, min_value=1, max_value=5)
   limit = forms.IntegerField(required=False, min_value=1, max_value=200)
 
+  q = lkforms.LKSingleLineCharField(required=False, max_length=256)
+  version = forms.CharField(required=False, max_length=16)
+  start_time = lkforms.LKDateTimeField(required=False)
+  end_time = lkforms.LKDateTimeField(required=False)
+
 
 @api_user_view('GET')
 def reviews_view(request):
@@ -93,7 +98,11 @@ def reviews_view(request):
       country=filters.get('country'),
       rating=filters.get('rating'),
       start_review=start_review,
-      limit=filters.get('limit'))
+      limit=filters.get('limit'),
+      query=filters.get('q'),
+      version=filters.get('version'),
+      start_time=filters.get('start_time'),
+      end_time=filters.get('end_time'))
 
   # TODO(Taylor): Remove app id:app 1:1 relationship; move to app id + country
   apps = set()
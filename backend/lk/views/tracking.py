@@ -20,11 +20,15 @@ from collections import namedtuple
 from datetime import datetime
 from datetime import timedelta
 
+from django.conf import settings
+
 from backend.lk.logic import runtime_config
+from backend.lk.logic import session_track_queue
 from backend.lk.logic import sessions
 from backend.lk.logic import tokens
 from backend.lk.models import SDKApp
 from backend.lk.views.base import api_view
+from backend.lk.views.base import count_statements
 from backend.lk.views.base import api_response
 from backend.util import text
 
@@ -213,19 +217,29 @@ def _filter_taps(raw_taps, commands):
 
 
 @api_view('POST')
+@count_statements
 def track_view(request):
   config = {}
   commands = []
   sdk_user = None
 
+  config_hash = None
+
   def response():
-    return api_response({
+    response_dict = {
       'do': [c.to_dict() for c in commands],
       'config': config,
       'user': (sdk_user and sdk_user.to_client_dict()) or DEFAULT_USER_DICT,
-    })
+    }
+    if config_hash:
+      response_dict['configHash'] = config_hash
+      if config_hash == client_config_hash:
+        # Client already has these rules; only send the per-request values.
+        response_dict['configUnchanged'] = True
+    return api_response(response_dict)
 
   post_data = request.DATA or {}
+  client_config_hash = post_data.get('config_hash')
   bundle_id = post_data.get('bundle') or post_data.get('bundle_id')
   # TODO(Taylor): Validation.
   version = post_data.get('version')
@@ -255,12 +269,18 @@ def track_view(request):
   if not user.flags.has_sent_tracking_data:
     user.set_flags(['has_sent_tracking_data'])
 
+  track_command = post_data.get('command', 'track')
+  handler = EVENT_TO_HANDLER.get(track_command)
+  # Commands with handlers change the session's user, so they are always
+  # applied inline against a locked session.
+  write_behind = settings.TRACK_WRITE_BEHIND and not handler
+
   session_data = post_data.get('session', {})
   session_id = session_data.get('session_id')
 
   session = None
   if session_id:
-    session = sessions.get_session_by_encrypted_id(user, session_id)
+    session = sessions.get_session_by_encrypted_id(user, session_id, for_update=not write_behind)
 
   if not session:
     if not bundle_id:
@@ -303,7 +323,7 @@ def track_view(request):
     sdk_platform = 'iOS'
     sdk_version = ios_sdk_match.group(1)
 
-  sessions.update_attributes(session, request.remote_addr,
+  attributes = dict(
     version=version,
     build=build,
     debug=debug,
@@ -316,8 +336,9 @@ def track_view(request):
     sdk_platform=sdk_platform,
     sdk_version=sdk_version)
 
-  track_command = post_data.get('command', 'track')
-  handler = EVENT_TO_HANDLER.get(track_command)
+  if not write_behind:
+    sessions.update_attributes(session, request.remote_addr, **attributes)
+
   if handler:
     handler(session, request.remote_addr, post_data)
 
@@ -334,10 +355,17 @@ def track_view(request):
   else:
     filtered_taps = _filter_taps(post_data.get('taps'), commands)
 
-  sessions.track(session, track_command, raw_taps=filtered_taps, raw_screens=filtered_screens)
+  if write_behind:
+    session_track_queue.enqueue_track(session, request.remote_addr, attributes,
+        filtered_taps, filtered_screens)
+  else:
+    sessions.track(session, track_command, raw_taps=filtered_taps, raw_screens=filtered_screens)
 
   # This sets config above and is included in the response.
   config = runtime_config.interpolated_config_for_session(session)
+  config_hash = runtime_config.config_hash(config)
+  if config_hash == client_config_hash:
+    config = {}
 
   if session.last_upgrade_time:
     config['io.launchkit.currentVersionDuration'] = (now - session.last_upgrade_time).total_seconds()
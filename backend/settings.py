@@ -232,6 +232,46 @@ DATABASES = {
 REDIS_URL = "redis://localhost:6379/0"
 
 
+#
+# SDK TRACKING
+#
+
+# If enabled, /track queues taps & screens in redis and responds right away;
+# process_queued_tracking (in the "sessions" celery queue) writes them later.
+TRACK_WRITE_BEHIND = False
+
+# If enabled, SDKSession/SDKUser counter increments are summed in redis and
+# flushed by process_coalesced_counters with one UPDATE per table.
+TRACK_COALESCE_COUNTERS = False
+
+# If enabled, raw taps & screens are stored in lk_sdktap/lk_sdkscreen,
+# buffered in redis and loaded with COPY by process_buffered_events.
+TRACK_STORE_EVENTS = False
+
+# How many workers each lk_sdkuser sweep (see sharded_sweeps) runs at once.
+SWEEP_WORKERS_PER_SWEEP = 1
+
+
+#
+# REVIEW INGESTION
+#
+
+# How many ingestions review_ingester.py runs at once. Each thread can hold
+# its own database connection, and postgres allows 100 in all, shared with
+# web and celery.
+REVIEW_INGESTION_CONCURRENCY = 16
+
+
+#
+# ITUNES CONNECT
+#
+
+# Daily sales report fetches start at most this many times per second, with
+# at most this many talking to reportingitc.apple.com at once.
+ITUNES_CONNECT_FETCHES_PER_SECOND = 5.0
+ITUNES_CONNECT_MAX_CONCURRENT_FETCHES = 20
+
+
 #
 # APP ENGINE PHOTOS
 #
@@ -293,11 +333,21 @@ CELERYBEAT_SCHEDULE = {
     'schedule': timedelta(seconds=30),
   },
 
+  'backfill-review-search-vectors': {
+    # Does nothing once it has reached the end of lk_appstorereview.
+    'task': 'backend.lk.logic.appstore_review_search.backfill_search_vectors',
+    'schedule': timedelta(minutes=1),
+  },
+
   'sales-report-ingestion': {
     'task': 'backend.lk.logic.itunes_connect.ingest_new_sales_reports',
     # daily at 6:30 AM US/Pacific time
     'schedule': crontab(minute=30, hour=6),
   },
+  'sales-report-dispatch': {
+    'task': 'backend.lk.logic.itunes_connect.dispatch_sales_report_fetches',
+    'schedule': timedelta(seconds=10),
+  },
 
   # SDK user info.
 
@@ -305,22 +355,36 @@ CELERYBEAT_SCHEDULE = {
     'task': 'backend.lk.logic.sessions.process_session_data',
     'schedule': timedelta(seconds=DEBUG and 60 or 5),
   },
+  'process-queued-tracking': {
+    'task': 'backend.lk.logic.session_track_queue.process_queued_tracking',
+    'schedule': timedelta(seconds=1),
+  },
+  'process-coalesced-counters': {
+    'task': 'backend.lk.logic.session_counters.process_coalesced_counters',
+    'schedule': timedelta(seconds=1),
+  },
+  'process-buffered-events': {
+    'task': 'backend.lk.logic.session_events.process_buffered_events',
+    'schedule': timedelta(seconds=5),
+  },
   'process-dirty-user-labels': {
     'task': 'backend.lk.logic.session_user_labels.process_dirty_sdk_user_labels',
     'schedule': timedelta(minutes=1),
   },
-  'process-weekly-inactive-labels': {
-    'task': 'backend.lk.logic.session_user_labels.process_weekly_inactive_sessions',
-    'schedule': timedelta(seconds=95),
-  },
   'record-tracking-stats': {
     'task': 'backend.lk.logic.session_user_labels.save_hourly_label_counts',
     'schedule': crontab(minute=5),
   },
-  'process-labels-periodically': {
-    'task': 'backend.lk.logic.session_user_labels.process_sdkuser_labels_periodically',
+  'sdkuser-sweeps': {
+    # Days active, labels and weekly inactive labels.
+    'task': 'backend.lk.logic.sharded_sweeps.start_sweeps',
     'schedule': timedelta(minutes=1),
   },
+  'reconcile-label-counts': {
+    'task': 'backend.lk.logic.session_user_labels.reconcile_label_counts',
+    # daily at 3:15 AM US/Pacific time
+    'schedule': crontab(minute=15, hour=3),
+  },
 }
 
 
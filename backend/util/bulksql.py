@@ -0,0 +1,79 @@
+#
+# Copyright 2016 Cluster Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from cStringIO import StringIO
+
+
+def values_sql(num_rows, num_columns):
+  """Produces a placeholder string for a multi-row VALUES list.
+
+  >>> values_sql(2, 3)
+  '(%s,%s,%s),(%s,%s,%s)'
+  """
+  row = '(%s)' % ','.join(['%s'] * num_columns)
+  return ','.join([row] * num_rows)
+
+
+def update_from_values(cursor, table, columns, assignments, rows):
+  """Updates many rows of table in a single statement.
+
+  columns names each value in rows, and the first column must be "id";
+  assignments are SET clauses that can refer to the new values as "v.<column>".
+  """
+  params = [value for row in rows for value in row]
+  cursor.execute("""
+    UPDATE %s SET %s
+    FROM (VALUES %s) AS v(%s)
+    WHERE %s.id = v.id
+  """ % (table, ','.join(assignments), values_sql(len(rows), len(columns)),
+         ','.join(columns), table), params)
+
+
+def insert_returning_ids(cursor, table, columns, rows):
+  """Inserts many rows into table in a single statement and returns their
+  new ids, in the same order as rows.
+  """
+  params = [value for row in rows for value in row]
+  cursor.execute("""
+    INSERT INTO %s (%s) VALUES %s RETURNING id
+  """ % (table, ','.join(columns), values_sql(len(rows), len(columns))), params)
+  return [row_id for row_id, in cursor.fetchall()]
+
+
+def copy_value(value):
+  """Formats a value for COPY ... FROM in text format."""
+  if value is None:
+    return '\\N'
+  if isinstance(value, basestring):
+    if isinstance(value, unicode):
+      value = value.encode('utf-8')
+    return (value
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r'))
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
+
+
+def copy_line(values):
+  return '\t'.join(copy_value(v) for v in values)
+
+
+def copy_lines(cursor, table, columns, lines):
+  """Loads lines made by copy_line() into table with a single COPY."""
+  cursor.copy_from(StringIO('\n'.join(lines) + '\n'), table, columns=columns)
@@ -121,9 +121,13 @@ class HStoreProperty(object):
 
   def _name_on_class(self, obj):
     if not self._class_attr_name:
-      for k, v in obj.__class__.__dict__.items():
-        if v == self:
-          self._class_attr_name = k
+      # Look through base classes too, for properties declared on abstract models.
+      for cls in obj.__class__.__mro__:
+        for k, v in cls.__dict__.items():
+          if v == self:
+            self._class_attr_name = k
+            break
+        if self._class_attr_name:
           break
     return self._class_attr_name
 
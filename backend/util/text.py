@@ -105,12 +105,37 @@ def ellipsize_bytes(full_text, bytes):
 
 NON_NUMERIC_RE = re.compile(r'[^\d]+')
 
-def _version_string_to_int_array(version):
+def version_parts(version):
+  """Parses a version string into a tuple of ints for use with cmp_version_parts.
+
+  >>> version_parts('1.2.3')
+  (1, 2, 3)
+  >>> version_parts('1.0-alpha1')
+  (1, 0)
+  >>> version_parts('')
+  ()
+  """
   if not version:
-    return []
+    return ()
   # Strip away '-alpha1' on the end.
   primary_version = version.split('-')[0]
-  return [int(part) for part in NON_NUMERIC_RE.split(primary_version) if part]
+  return tuple(int(part) for part in NON_NUMERIC_RE.split(primary_version) if part)
+
+def cmp_version_parts(parts, other_parts):
+  """Compares two tuples from version_parts() the same way as cmp_version.
+
+  >>> cmp_version_parts((1,), (1, 0, 0))
+  0
+  >>> cmp_version_parts((1, 1), (1, 0, 9))
+  1
+  """
+  # Zero-pad the tuples so they're the same length.
+  len_diff = len(parts) - len(other_parts)
+  if len_diff < 0:
+    parts += (0,) * (-1 * len_diff)
+  else:
+    other_parts += (0,) * len_diff
+  return cmp(parts, other_parts)
 
 def cmp_version(version, other_version):
   """Tests two version strings to see if one is newer. Ignores 1.0-trailing1 sub-versions.
@@ -132,15 +157,7 @@ def cmp_version(version, other_version):
   >>> cmp_version('1.0.', '1.0')
   0
   """
-  parts = _version_string_to_int_array(version)
-  other_parts = _version_string_to_int_array(other_version)
-  # Zero-pad the tuples so they're the same length.
-  len_diff = len(parts) - len(other_parts)
-  if len_diff < 0:
-    parts += [0] * (-1 * len_diff)
-  else:
-    other_parts += [0] * len_diff
-  return cmp(parts, other_parts)
+  return cmp_version_parts(version_parts(version), version_parts(other_version))
 
 def cmp_build(build, other_build):
   if build and not other_build:
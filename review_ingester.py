@@ -17,17 +17,28 @@
 
 import logging
 import os
+import Queue
 import signal
+import threading
 import time
 
 import django
+from django.conf import settings
+from django.db import connection
 
+from backend.lk.logic import appstore_review_fetch
 from backend.lk.logic import appstore_review_ingestion
+from backend.lk.logic import redis_wrap
 
 # This sets up logging.
 django.setup()
 
 
+REPORT_INTERVAL_SECONDS = 60.0
+
+INGESTION_STATS_KEY = 'review-ingestion-stats'
+
+
 SHUTDOWN = False
 
 def handle_shutdown_signal(signum, frame):
@@ -36,27 +47,100 @@ def handle_shutdown_signal(signum, frame):
   SHUTDOWN = True
 
 
-def main():
-  logging.info('Looking for reviews to ingest...')
+class Counter(object):
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.value = 0
 
-  ingested_count = 0
+  def increment(self):
+    with self._lock:
+      self.value += 1
 
+  def reset(self):
+    with self._lock:
+      value, self.value = self.value, 0
+    return value
+
+
+def ingest_worker(work_queue, ingested_count):
   while not SHUTDOWN:
-    for app, country in appstore_review_ingestion.apps_countries_to_ingest(30):
+    try:
+      app, country = work_queue.get(timeout=1.0)
+    except Queue.Empty:
+      continue
+
+    try:
       appstore_review_ingestion.ingest_app(app, country)
-      ingested_count += 1
+      ingested_count.increment()
+
+    except appstore_review_fetch.RateLimitedError:
+      # fetch_reviews() has already paused all fetches to the host; try this
+      # one again once that's over.
+      logging.warn('Rate limited while ingesting app id: %s (%s), backing off...', app.id, country)
+      appstore_review_ingestion.reschedule_ingestion(app, country,
+          time.time() + appstore_review_fetch.RATE_LIMITED_BACKOFF_SECONDS)
+
+    except Exception:
+      logging.exception('Problem ingesting app id: %s (%s)', app.id, country)
+      appstore_review_ingestion.ingestion_failed(app, country)
 
-      if SHUTDOWN:
-        break
+    finally:
+      # Don't hold a connection per thread while waiting on the network.
+      connection.close()
+      work_queue.task_done()
 
-    if ingested_count >= 25:
-      logging.info('Ingested reviews for %d app(s)...', ingested_count)
-      ingested_count = 0
 
-    else:
-      # If the queue is empty, chill out.
+def report_queue_lag(ingested):
+  stats = appstore_review_ingestion.INGESTION_QUEUE.stats()
+  logging.info('Ingested reviews for %d app(s)... %d due, %d leased, %d dead, queue lag %.0fs',
+      ingested, stats['due'], stats['leased'], stats['dead'], stats['lag_seconds'])
+
+  redis = redis_wrap.client()
+  redis.hmset(INGESTION_STATS_KEY, {
+    'due_count': stats['due'],
+    'lag_seconds': stats['lag_seconds'],
+    'ingested_per_minute': ingested * 60.0 / REPORT_INTERVAL_SECONDS,
+    'report_time': time.time(),
+  })
+
+
+def main():
+  logging.info('Looking for reviews to ingest...')
+
+  concurrency = settings.REVIEW_INGESTION_CONCURRENCY
+  work_queue = Queue.Queue(maxsize=concurrency)
+  ingested_count = Counter()
+
+  workers = [threading.Thread(target=ingest_worker, args=(work_queue, ingested_count))
+             for _ in range(concurrency)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+
+  last_report = time.time()
+  while not SHUTDOWN:
+    # Only claim as much as idle workers can start on right away; anything
+    # claimed stays leased until its worker finishes with it.
+    # (unfinished_tasks counts both queued and in-progress ingestions.)
+    available = concurrency - work_queue.unfinished_tasks
+    claimed = 0
+    if available > 0:
+      for app, country in appstore_review_ingestion.apps_countries_to_ingest(available):
+        work_queue.put((app, country))
+        claimed += 1
+      connection.close()
+
+    if time.time() - last_report >= REPORT_INTERVAL_SECONDS:
+      report_queue_lag(ingested_count.reset())
+      last_report = time.time()
+
+    if not claimed:
+      # If the queue is empty (or the workers are all busy), chill out.
       time.sleep(1.0)
 
+  for worker in workers:
+    worker.join(10.0)
+
 
 if __name__ == '__main__':
   signal.signal(signal.SIGABRT, handle_shutdown_signal)